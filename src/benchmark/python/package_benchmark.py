@@ -0,0 +1,365 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Benchmark the packaging of lambda-zips with synthetic project trees
+
+    package_benchmark.py run [--scenario NAME] [--repeat N] [--scale X]
+                             [--workers N] [--output results.json]
+    package_benchmark.py compare baseline.json results.json [--threshold X]
+
+Every measurement runs in a fresh interpreter, so its peak RSS is not
+influenced by other measurements. No network access is needed, the trees
+are generated and the projects have no dependencies to install. The
+release_pipeline benchmark packages, uploads and releases the lambda-zip and
+a template to a local directory standing in for S3.
+"""
+
+import argparse
+import hashlib
+import json
+import os
+import platform
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import zipfile
+
+MAIN_PYTHON = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                           '..', '..', 'main', 'python')
+RESULTS_FORMAT_VERSION = 1
+BENCHMARKS = ['zip_recursive', 'write_version', 'package_lambda_code',
+              'release_pipeline']
+BUCKET_NAME = 'benchmark-bucket'
+WRITE_VERSION_CALLS = 200
+MIB = 1024 * 1024
+
+PYTHON_SOURCE = (b'import os\n\n\ndef handler(event, context):\n'
+                 b'    return {"statusCode": 200, "body": os.getcwd()}\n')
+TEMPLATE = (b"AWSTemplateFormatVersion: '2010-09-09'\n"
+            b"Description: benchmark\n"
+            b"Resources:\n"
+            b"  topic:\n"
+            b"    Type: AWS::SNS::Topic\n")
+
+
+def write_file(filename, data):
+    directory = os.path.dirname(filename)
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    with open(filename, 'wb') as output:
+        output.write(data)
+
+
+def text_data(seed, size):
+    """Compressible, source code like data of size bytes"""
+    line = '# {0} {1}\n'.format(
+            seed, hashlib.sha256(str(seed).encode('utf-8')).hexdigest())
+    data = (PYTHON_SOURCE + line.encode('utf-8')) * (size // 40 + 1)
+    return data[:size]
+
+
+def write_random_file(filename, size, seed):
+    """Write size bytes of incompressible, but reproducible data"""
+    directory = os.path.dirname(filename)
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    block = hashlib.sha256(str(seed).encode('utf-8')).digest()
+    with open(filename, 'wb') as output:
+        written = 0
+        counter = 0
+        while written < size:
+            chunk = []
+            for _ in range(2048):
+                chunk.append(hashlib.sha256(
+                        block + str(counter).encode('utf-8')).digest())
+                counter += 1
+            data = b''.join(chunk)[:size - written]
+            output.write(data)
+            written += len(data)
+
+
+def generate_small_files(tree, scale):
+    """Many small modules in many packages"""
+    packages = max(1, int(50 * scale))
+    for package in range(packages):
+        for module in range(100):
+            name = os.path.join(
+                    tree, 'target', 'lambda_dependencies',
+                    'package_{0}'.format(package), 'module_{0}.py'.format(
+                        module))
+            write_file(name, text_data(package * 1000 + module,
+                                       200 + (module * 397) % 4000))
+    for module in range(max(1, int(200 * scale))):
+        write_file(os.path.join(tree, 'src', 'main', 'python', 'app',
+                                'module_{0}.py'.format(module)),
+                   text_data(module, 1000))
+
+
+def generate_huge_binaries(tree, scale):
+    """A few large shared libraries, incompressible and compressible"""
+    dependencies = os.path.join(tree, 'target', 'lambda_dependencies')
+    size = max(MIB, int(32 * MIB * scale))
+    write_random_file(os.path.join(dependencies, 'native', 'random.so'),
+                      size, 1)
+    write_random_file(os.path.join(dependencies, 'native', 'random2.so'),
+                      size, 2)
+    write_file(os.path.join(dependencies, 'native', 'sparse.so'),
+               (b'\0' * 4096 + text_data(3, 512)) * (size // 4608))
+    write_file(os.path.join(tree, 'src', 'main', 'python', 'app.py'),
+               PYTHON_SOURCE)
+
+
+def generate_deep_nesting(tree, scale):
+    """Long chains of nested packages"""
+    for chain in range(max(1, int(10 * scale))):
+        path = os.path.join(tree, 'target', 'lambda_dependencies',
+                            'chain_{0}'.format(chain))
+        for depth in range(50):
+            path = os.path.join(path, 'level_{0}'.format(depth))
+            for module in range(5):
+                write_file(os.path.join(path, 'module_{0}.py'.format(module)),
+                           text_data(depth * 10 + module, 1500))
+            write_file(os.path.join(path, '__init__.py'), b'')
+    write_file(os.path.join(tree, 'src', 'main', 'python', 'app.py'),
+               PYTHON_SOURCE)
+
+
+SCENARIOS = {
+    'small_files': generate_small_files,
+    'huge_binaries': generate_huge_binaries,
+    'deep_nesting': generate_deep_nesting,
+}
+
+
+def tree_size(directory):
+    files = 0
+    size = 0
+    for root, _, filenames in os.walk(directory):
+        for filename in filenames:
+            files += 1
+            size += os.path.getsize(os.path.join(root, filename))
+    return files, size
+
+
+def create_project(tree, workers):
+    from pybuilder.core import Project
+    from pybuilder_aws_plugin import initialize_plugin
+
+    project = Project(basedir=tree, name='benchmark', version='1')
+    initialize_plugin(project)
+    project.set_property('dir_target', 'target')
+    project.set_property('dir_source_main_python', 'src/main/python')
+    project.set_property('dir_source_main_scripts', 'src/main/scripts')
+    project.set_property('lambda_zip_compression_workers', workers)
+    return project
+
+
+def run_release_pipeline(project, tree):
+    """Package, upload and release with a local directory as storage
+
+    Returns the size of all objects in the bucket.
+    """
+    from pybuilder.core import Logger
+    from pybuilder_aws_plugin import (package_lambda_code,
+                                      release_custom_resource,
+                                      upload_cfn_to_s3,
+                                      upload_zip_to_s3,
+                                      )
+
+    storage_dir = os.path.join(tree, 'storage')
+    shutil.rmtree(storage_dir, ignore_errors=True)
+    os.makedirs(os.path.join(storage_dir, BUCKET_NAME))
+    template_dir = os.path.join(tree, 'src', 'main', 'cfn')
+    write_file(os.path.join(template_dir, 'benchmark.yml'), TEMPLATE)
+    project.set_property('local_storage_dir', storage_dir)
+    project.set_property('bucket_name', BUCKET_NAME)
+    project.set_property('template_files', [(template_dir, 'benchmark.yml')])
+    logger = Logger()
+    package_lambda_code(project, logger)
+    upload_zip_to_s3(project, logger)
+    upload_cfn_to_s3(project, logger)
+    release_custom_resource(project, logger)
+    return tree_size(os.path.join(storage_dir, BUCKET_NAME))[1]
+
+
+def measure(benchmark, tree, workers):
+    """Run benchmark once in this interpreter, return the measurement"""
+    sys.path.insert(0, os.path.abspath(MAIN_PYTHON))
+    from pybuilder.core import Logger
+    from pybuilder_aws_plugin.lambda_tasks import (get_path_to_zipfile,
+                                                   package_lambda_code,
+                                                   write_version,
+                                                   zip_recursive,
+                                                   )
+
+    project = create_project(tree, workers)
+    dir_target = project.expand_path('$dir_target')
+    output = os.path.join(dir_target, '{0}.zip'.format(benchmark))
+    output_bytes = None
+    start = time.time()
+    if benchmark == 'zip_recursive':
+        archive = zipfile.ZipFile(output, 'w')
+        zip_recursive(archive, os.path.join(dir_target,
+                                            'lambda_dependencies'))
+        archive.close()
+    elif benchmark == 'write_version':
+        for _ in range(WRITE_VERSION_CALLS):
+            archive = zipfile.ZipFile(output, 'w')
+            write_version(project, archive)
+            archive.close()
+    elif benchmark == 'release_pipeline':
+        output_bytes = run_release_pipeline(project, tree)
+    else:
+        package_lambda_code(project, Logger())
+        output = get_path_to_zipfile(project)
+    seconds = time.time() - start
+    if output_bytes is None:
+        output_bytes = os.path.getsize(output)
+
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        peak_rss //= 1024
+    return {'seconds': seconds,
+            'output_bytes': output_bytes,
+            'peak_rss_kib': peak_rss}
+
+
+def measure_in_subprocess(benchmark, tree, workers):
+    process = subprocess.Popen(
+            [sys.executable, os.path.abspath(__file__), '_measure', benchmark,
+             tree, str(workers)],
+            stdout=subprocess.PIPE)
+    stdout = process.communicate()[0]
+    if process.returncode != 0:
+        raise SystemExit('Benchmark {0} failed'.format(benchmark))
+    return json.loads(stdout.decode('utf-8'))
+
+
+def median(values):
+    values = sorted(values)
+    middle = len(values) // 2
+    if len(values) % 2:
+        return values[middle]
+    return (values[middle - 1] + values[middle]) / 2.0
+
+
+def run(args):
+    workdir = tempfile.mkdtemp(prefix='package-benchmark-')
+    results = {}
+    try:
+        for scenario in args.scenario or sorted(SCENARIOS):
+            tree = os.path.join(workdir, scenario)
+            start = time.time()
+            SCENARIOS[scenario](tree, args.scale)
+            files, input_bytes = tree_size(tree)
+            print('Generated {0}: {1} files, {2:.1f} MiB in {3:.1f}s'.format(
+                    scenario, files, input_bytes / float(MIB),
+                    time.time() - start))
+            for benchmark in BENCHMARKS:
+                runs = [measure_in_subprocess(benchmark, tree, args.workers)
+                        for _ in range(args.repeat)]
+                seconds = median([result['seconds'] for result in runs])
+                result = {
+                    'seconds': seconds,
+                    'runs': [result['seconds'] for result in runs],
+                    'files': files,
+                    'input_bytes': input_bytes,
+                    'throughput_mib_s': (input_bytes / float(MIB) / seconds
+                                         if benchmark != 'write_version'
+                                         else None),
+                    'output_bytes': runs[-1]['output_bytes'],
+                    'peak_rss_kib': max(result['peak_rss_kib']
+                                        for result in runs),
+                }
+                results['{0}/{1}'.format(scenario, benchmark)] = result
+                print('  {0:<20} {1:>8.3f}s {2:>10} KiB peak RSS {3:>12} '
+                      'bytes'.format(benchmark, seconds,
+                                     result['peak_rss_kib'],
+                                     result['output_bytes']))
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    report = {
+        'format': RESULTS_FORMAT_VERSION,
+        'created': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpus': os.sysconf('SC_NPROCESSORS_ONLN'),
+        'scale': args.scale,
+        'repeat': args.repeat,
+        'workers': args.workers,
+        'results': results,
+    }
+    if args.output:
+        with open(args.output, 'w') as output:
+            json.dump(report, output, indent=1, sort_keys=True)
+        print('Results written to {0}'.format(args.output))
+    return 0
+
+
+def compare(args):
+    """Print the ratios of two result files, fail on regressions"""
+    with open(args.baseline) as baseline_file:
+        baseline = json.load(baseline_file)
+    with open(args.current) as current_file:
+        current = json.load(current_file)
+    if baseline.get('scale') != current.get('scale'):
+        print('Warning: comparing results of different scales')
+    regressions = []
+    print('{0:<36} {1:>10} {2:>10} {3:>7} {4:>9} {5:>9}'.format(
+            'benchmark', 'baseline s', 'current s', 'time', 'rss', 'size'))
+    for name in sorted(set(baseline['results']) & set(current['results'])):
+        old = baseline['results'][name]
+        new = current['results'][name]
+        time_ratio = new['seconds'] / max(old['seconds'], 1e-9)
+        rss_ratio = new['peak_rss_kib'] / float(max(old['peak_rss_kib'], 1))
+        size_ratio = new['output_bytes'] / float(max(old['output_bytes'], 1))
+        print('{0:<36} {1:>10.3f} {2:>10.3f} {3:>6.2f}x {4:>8.2f}x '
+              '{5:>8.2f}x'.format(name, old['seconds'], new['seconds'],
+                                  time_ratio, rss_ratio, size_ratio))
+        for metric, ratio in [('time', time_ratio), ('peak RSS', rss_ratio),
+                              ('output size', size_ratio)]:
+            if ratio > args.threshold:
+                regressions.append('{0}: {1} {2:.2f}x'.format(
+                        name, metric, ratio))
+    if regressions:
+        print('Regressions above {0:.2f}x:'.format(args.threshold))
+        for regression in regressions:
+            print('  {0}'.format(regression))
+        return 1
+    return 0
+
+
+def main(argv):
+    if argv[1:2] == ['_measure']:
+        benchmark, tree, workers = argv[2:5]
+        print(json.dumps(measure(benchmark, tree, int(workers))))
+        return 0
+
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    commands = parser.add_subparsers(dest='command')
+    run_parser = commands.add_parser('run', help='run the benchmarks')
+    run_parser.add_argument('--scenario', action='append',
+                            choices=sorted(SCENARIOS))
+    run_parser.add_argument('--repeat', type=int, default=3)
+    run_parser.add_argument('--scale', type=float, default=1.0)
+    run_parser.add_argument('--workers', type=int, default=1)
+    run_parser.add_argument('--output')
+    compare_parser = commands.add_parser(
+            'compare', help='compare two result files')
+    compare_parser.add_argument('baseline')
+    compare_parser.add_argument('current')
+    compare_parser.add_argument('--threshold', type=float, default=1.1)
+    args = parser.parse_args(argv[1:])
+    if args.command == 'run':
+        return run(args)
+    if args.command == 'compare':
+        return compare(args)
+    parser.print_help()
+    return 2
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
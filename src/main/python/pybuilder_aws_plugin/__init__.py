@@ -6,19 +6,43 @@ import sys
 
 from pybuilder.core import init, task, depends
 
-from .lambda_tasks import upload_zip_to_s3, package_lambda_code, lambda_release
+from .lambda_tasks import (upload_zip_to_s3,
+                           fill_lambda_wheelhouse,
+                           package_lambda_code,
+                           profile_lambda_imports,
+                           lambda_release,
+                           )
+from .helpers import (DEFAULT_MAX_POOL_CONNECTIONS,
+                      DEFAULT_PART_SIZE,
+                      DEFAULT_RELEASE_CONCURRENCY,
+                      DEFAULT_UPLOAD_CONCURRENCY,
+                      )
+from .cfn_tasks import DEFAULT_MAX_TEMPLATE_SIZE
+from .prune_helpers import DEFAULT_EXCLUDE_PATTERNS
+from .retry_helpers import DEFAULT_MAX_ATTEMPTS, DEFAULT_RETRY_DEADLINE
+from .zip_helpers import DEFAULT_MAX_UNZIPPED_SIZE
 
 
 if sys.version_info[0:2] >= (2, 7):
     # cfn-sphere needs Python 2.7, skip cfn handling for older Python versions
-    from .cfn_tasks import upload_cfn_to_s3, cfn_release
+    from .cfn_tasks import upload_cfn_to_s3, cfn_release, get_cfn_release_plan
 
-    from .helpers import teamcity_append_build_status
+    from .helpers import (teamcity_append_build_status,
+                          get_storage,
+                          publish_metrics,
+                          release_helper,
+                          )
+    from .lambda_tasks import get_lambda_release_plan
 
     @task(description='Release on S3 by copying everything to latest')
-    @depends('lambda_release',
-             'cfn_release')
-    def release_custom_resource(project):
+    def release_custom_resource(project, logger):
+        """Copy the lambda-zip and all templates to latest concurrently"""
+        release_helper(
+            logger,
+            get_lambda_release_plan(project) + get_cfn_release_plan(project),
+            concurrency=project.get_property('release_concurrency'),
+            storage=get_storage(logger, project))
+        publish_metrics(logger, project)
         if project.get_property('teamcity_output'):
             teamcity_append_build_status("Released {0} in {1}".format(
                 project.version,
@@ -38,8 +62,50 @@ def initialize_plugin(project):
     project.set_property(
             'lambda_file_access_control', 'bucket-owner-full-control')
     project.set_property('bucket_prefix', '')
+    project.set_property('lambda_dependencies_batch_install', False)
+    project.set_property('lambda_cache_dir', '')
+    project.set_property('lambda_wheelhouse_dir', '')
+    project.set_property('lambda_cache_max_entries', 10)
+    project.set_property('lambda_layer', False)
+    project.set_property('lambda_zip_incremental', False)
+    project.set_property('lambda_zip_compression_workers', 1)
+    project.set_property('lambda_zip_reproducible', False)
+    project.set_property('lambda_zip_store_incompressible', True)
+    project.set_property('lambda_zip_compression_levels', [])
+    project.set_property('lambda_zip_slim', False)
+    project.set_property('lambda_zip_exclude_patterns',
+                         list(DEFAULT_EXCLUDE_PATTERNS))
+    project.set_property('lambda_zip_strip_binaries', False)
+    project.set_property('lambda_zip_stream_wheels', False)
+    project.set_property('lambda_zip_max_size', DEFAULT_MAX_UNZIPPED_SIZE)
+    project.set_property('lambda_zip_max_compressed_size', 0)
+    project.set_property('lambda_zip_compile_bytecode', False)
+    project.set_property('lambda_runtime_python', '')
+    project.set_property('lambda_bytecode_interpreter', '')
+    project.set_property('lambda_bytecode_cache_max_entries', 50000)
+    project.set_property('lambda_zip_prune_imports', False)
+    project.set_property('lambda_zip_keep_modules', [])
+    project.set_property('lambda_import_profile_paths', [])
+    project.set_property('lambda_import_time_budget_ms', 0)
 
     project.set_property(
             'template_file_access_control', 'bucket-owner-full-control')
     project.set_property('template_key_prefix', '')
+    project.set_property('template_transform_workers', 1)
+    project.set_property('template_upload_concurrency', 4)
+    project.set_property('template_cache_dir', '')
+    project.set_property('template_cache_max_entries', 256)
+    project.set_property('template_json_compact', False)
+    project.set_property('template_max_size', DEFAULT_MAX_TEMPLATE_SIZE)
     project.set_property('teamcity_parameter', '')
+    project.set_property('teamcity_sha256_parameter', '')
+    project.set_property('teamcity_layer_parameter', '')
+    project.set_property('skip_unchanged_uploads', True)
+    project.set_property('upload_part_size', DEFAULT_PART_SIZE)
+    project.set_property('upload_max_concurrency', DEFAULT_UPLOAD_CONCURRENCY)
+    project.set_property('s3_max_pool_connections',
+                         DEFAULT_MAX_POOL_CONNECTIONS)
+    project.set_property('local_storage_dir', '')
+    project.set_property('s3_max_attempts', DEFAULT_MAX_ATTEMPTS)
+    project.set_property('s3_retry_deadline', DEFAULT_RETRY_DEADLINE)
+    project.set_property('release_concurrency', DEFAULT_RELEASE_CONCURRENCY)
@@ -0,0 +1,174 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import json
+import os
+import shutil
+import subprocess
+import sys
+from multiprocessing.pool import ThreadPool
+
+from pybuilder.errors import BuildFailedException
+
+from .cache_helpers import (evict_least_recently_used,
+                            hash_key,
+                            read_cache_file,
+                            write_cache_file,
+                            )
+from .zip_helpers import file_sha256
+
+# Runs in the target interpreter, compiles the (path, arcname) jobs read from
+# stdin below an output directory, at the place the target interpreter
+# loads bytecode from. Hash based pycs (Python >= 3.7) are not checked
+# against the source, so the mtimes of the extracted lambda-zip do not matter.
+COMPILE_SCRIPT = """
+import importlib.util, json, os, py_compile, sys
+jobs, output_dir = json.load(sys.stdin)
+kwargs = {}
+if hasattr(py_compile, 'PycInvalidationMode'):
+    kwargs['invalidation_mode'] = py_compile.PycInvalidationMode.UNCHECKED_HASH
+results = []
+for path, arcname in jobs:
+    cfile = importlib.util.cache_from_source(arcname)
+    try:
+        py_compile.compile(path, cfile=os.path.join(output_dir, cfile),
+                           dfile=arcname, doraise=True, **kwargs)
+        results.append([arcname, cfile, None])
+    except Exception as e:
+        results.append([arcname, cfile, str(e)])
+json.dump(results, sys.stdout)
+"""
+
+CACHE_TAG_SCRIPT = 'import sys; print(sys.implementation.cache_tag)'
+
+
+def get_bytecode_interpreter(project):
+    """The interpreter matching the Python version of the Lambda runtime"""
+    interpreter = project.get_property('lambda_bytecode_interpreter')
+    if interpreter:
+        return interpreter
+    version = project.get_property('lambda_runtime_python')
+    if not version or version == '{0}.{1}'.format(*sys.version_info[0:2]):
+        return sys.executable
+    return 'python{0}'.format(version)
+
+
+def run_interpreter(interpreter, script):
+    try:
+        process = subprocess.Popen(
+                [interpreter, '-c', script], stdin=subprocess.PIPE,
+                stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    except OSError as e:
+        raise BuildFailedException(
+                "Can not run interpreter '{0}' to compile bytecode: {1}".format(
+                    interpreter, e))
+    return process
+
+
+def get_cache_tag(interpreter):
+    process = run_interpreter(interpreter, CACHE_TAG_SCRIPT)
+    stdout, stderr = process.communicate()
+    if process.returncode != 0:
+        raise BuildFailedException(
+                "Interpreter '{0}' failed: {1}".format(
+                    interpreter, stderr.decode('utf-8', 'replace')))
+    return stdout.decode('utf-8').strip()
+
+
+def compile_files(interpreter, jobs, output_dir, workers):
+    """Compile jobs with workers interpreter processes running in parallel"""
+    workers = max(1, min(workers or 1, len(jobs)))
+
+    def compile_chunk(chunk):
+        process = run_interpreter(interpreter, COMPILE_SCRIPT)
+        stdout, stderr = process.communicate(
+                json.dumps([chunk, output_dir]).encode('utf-8'))
+        if process.returncode != 0:
+            raise BuildFailedException(
+                    "Compiling bytecode with '{0}' failed: {1}".format(
+                        interpreter, stderr.decode('utf-8', 'replace')))
+        return json.loads(stdout.decode('utf-8'))
+
+    pool = ThreadPool(workers)
+    try:
+        chunks = pool.map(compile_chunk,
+                          [jobs[i::workers] for i in range(workers)])
+    finally:
+        pool.close()
+        pool.join()
+    return [result for chunk in chunks for result in chunk]
+
+
+def compile_bytecode(logger, project, files):
+    """Compile the Python files of the (path, arcname) list files
+
+    Returns (path, arcname) of the compiled files, written below
+    $dir_target/lambda_bytecode. Compiled files are cached in
+    lambda_cache_dir, keyed by source hash, arcname and interpreter.
+    """
+    interpreter = get_bytecode_interpreter(project)
+    cache_tag = get_cache_tag(interpreter)
+    output_dir = os.path.join(
+            project.expand_path('$dir_target'), 'lambda_bytecode')
+    shutil.rmtree(output_dir, ignore_errors=True)
+    cache_dir = project.get_property('lambda_cache_dir')
+    if cache_dir:
+        cache_dir = os.path.join(os.path.expanduser(cache_dir), 'bytecode')
+
+    sources = [(path, arcname) for path, arcname in files
+               if arcname.endswith('.py')]
+    compiled = []
+    jobs = []
+    cache_keys = {}
+    for path, arcname in sources:
+        key = None
+        if cache_dir:
+            key = hash_key(file_sha256(path), arcname, cache_tag)
+            data = read_cache_file(cache_dir, key)
+            if data is not None:
+                cfile = cached_pyc_name(arcname, cache_tag)
+                write_file(os.path.join(output_dir, cfile), data)
+                compiled.append((os.path.join(output_dir, cfile), cfile))
+                continue
+        cache_keys[arcname] = key
+        jobs.append((path, arcname))
+    reused = len(compiled)
+
+    failed = 0
+    if jobs:
+        for arcname, cfile, error in compile_files(
+                interpreter, jobs, output_dir,
+                project.get_property('lambda_zip_compression_workers')):
+            if error:
+                logger.debug('Not compiling {0}: {1}'.format(arcname, error))
+                failed += 1
+                continue
+            path = os.path.join(output_dir, cfile)
+            if cache_keys.get(arcname):
+                with open(path, 'rb') as pyc:
+                    write_cache_file(cache_dir, cache_keys[arcname],
+                                     pyc.read())
+            compiled.append((path, cfile))
+    if cache_dir:
+        evict_least_recently_used(
+                logger, cache_dir,
+                project.get_property('lambda_bytecode_cache_max_entries'))
+    logger.info(
+            'Compiled {0} Python files for {1} ({2} from cache, {3} '
+            'failed).'.format(len(compiled), cache_tag, reused, failed))
+    return compiled
+
+
+def cached_pyc_name(arcname, cache_tag):
+    """Same as importlib.util.cache_from_source() of the target interpreter"""
+    directory, filename = os.path.split(arcname)
+    return os.path.join(directory, '__pycache__', '{0}.{1}.pyc'.format(
+            filename[:-len('.py')], cache_tag))
+
+
+def write_file(filename, data):
+    directory = os.path.dirname(filename)
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    with open(filename, 'wb') as output:
+        output.write(data)
@@ -0,0 +1,156 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import contextlib
+import errno
+import fcntl
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+
+
+def hash_key(*parts):
+    """Build a stable cache key out of JSON serializable parts"""
+    serialized = json.dumps(parts, sort_keys=True, separators=(',', ':'))
+    return hashlib.sha256(serialized.encode('utf-8')).hexdigest()
+
+
+def _makedirs(directory):
+    try:
+        os.makedirs(directory)
+    except OSError as e:
+        if e.errno != errno.EEXIST:
+            raise
+
+
+def _lock_path(cache_dir, name):
+    return os.path.join(cache_dir, '.locks', '{0}.lock'.format(name))
+
+
+@contextlib.contextmanager
+def file_lock(filename, blocking=True):
+    """Hold an exclusive lock on filename, yields False if it is taken"""
+    _makedirs(os.path.dirname(filename))
+    with open(filename, 'a') as lock_file:
+        flags = fcntl.LOCK_EX
+        if not blocking:
+            flags |= fcntl.LOCK_NB
+        try:
+            fcntl.flock(lock_file, flags)
+        except IOError as e:
+            if e.errno not in (errno.EAGAIN, errno.EACCES):
+                raise
+            yield False
+            return
+        try:
+            yield True
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+@contextlib.contextmanager
+def locked_cache_entry(cache_dir, key):
+    """Lock the entry key in cache_dir and yield its path
+
+    The entry may not exist yet, use populate_cache_entry to create it while
+    the lock is held. Using the entry marks it as recently used.
+    """
+    entry = os.path.join(cache_dir, key)
+    with file_lock(_lock_path(cache_dir, key)):
+        yield entry
+        if os.path.exists(entry):
+            os.utime(entry, None)
+
+
+def populate_cache_entry(entry, populate):
+    """Create entry by calling populate with a temporary directory
+
+    The directory is renamed to entry only after populate succeeded, so
+    readers never see a half written entry.
+    """
+    cache_dir = os.path.dirname(entry)
+    _makedirs(cache_dir)
+    temporary = tempfile.mkdtemp(prefix='.tmp-', dir=cache_dir)
+    try:
+        populate(temporary)
+        os.rename(temporary, entry)
+    except Exception:
+        shutil.rmtree(temporary, ignore_errors=True)
+        raise
+
+
+def read_cache_file(cache_dir, key):
+    """Return the content of the cache file key, None if there is none"""
+    entry = os.path.join(cache_dir, key)
+    try:
+        with open(entry, 'rb') as cache_file:
+            data = cache_file.read()
+    except IOError as e:
+        if e.errno != errno.ENOENT:
+            raise
+        return None
+    os.utime(entry, None)
+    return data
+
+
+def write_cache_file(cache_dir, key, data):
+    """Atomically store data as cache file key"""
+    _makedirs(cache_dir)
+    handle, temporary = tempfile.mkstemp(prefix='.tmp-', dir=cache_dir)
+    try:
+        with os.fdopen(handle, 'wb') as cache_file:
+            cache_file.write(data)
+        os.rename(temporary, os.path.join(cache_dir, key))
+    except Exception:
+        os.remove(temporary)
+        raise
+
+
+def link_tree(source, destination):
+    """Hardlink all files below source into destination, copy as fallback"""
+    for root, dirs, files in os.walk(source):
+        target_root = os.path.join(
+                destination, os.path.relpath(root, source))
+        _makedirs(target_root)
+        for filename in files:
+            target = os.path.join(target_root, filename)
+            if os.path.lexists(target):
+                os.remove(target)
+            try:
+                os.link(os.path.join(root, filename), target)
+            except OSError:
+                shutil.copy2(os.path.join(root, filename), target)
+
+
+def evict_least_recently_used(logger, cache_dir, max_entries):
+    """Remove the least recently used entries exceeding max_entries
+
+    Entries locked by a concurrent build are kept. Lock files are never
+    removed, a build waiting for a removed lock file would hold the lock of
+    the entry together with the next build creating it again.
+    """
+    if max_entries is None or not os.path.isdir(cache_dir):
+        return
+    with file_lock(_lock_path(cache_dir, '.evict')):
+        entries = [name for name in os.listdir(cache_dir)
+                   if not name.startswith('.')]
+        entries.sort(
+                key=lambda name: os.path.getmtime(
+                    os.path.join(cache_dir, name)),
+                reverse=True)
+        for name in entries[max_entries:]:
+            lock = _lock_path(cache_dir, name)
+            with file_lock(lock, blocking=False) as locked:
+                if not locked:
+                    logger.debug(
+                        'Cache entry {0} is in use, not evicting it.'.format(
+                            name))
+                    continue
+                logger.debug('Evicting cache entry {0}.'.format(name))
+                path = os.path.join(cache_dir, name)
+                if os.path.isdir(path):
+                    shutil.rmtree(path, ignore_errors=True)
+                else:
+                    os.remove(path)
@@ -1,9 +1,116 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
+import hashlib
+import json
+import multiprocessing
+import os
+import time
+from multiprocessing.pool import ThreadPool
+
 from pybuilder.core import task
+from pybuilder.errors import BuildFailedException
+
+from .cache_helpers import (evict_least_recently_used,
+                            hash_key,
+                            read_cache_file,
+                            write_cache_file,
+                            )
+from .helpers import (upload_helper,
+                      publish_metrics,
+                      release_helper,
+                      check_acl_parameter_validity,
+                      get_storage,
+                      get_transfer_config,
+                      )
+from .metrics_helpers import add_metric, measure
+
+# CloudFormation's limit for templates referenced by an S3 URL
+DEFAULT_MAX_TEMPLATE_SIZE = 1024 * 1024
+
+
+def get_json_filename(filename):
+    return filename.replace('.yml', '.json').replace('.yaml', '.json')
+
+
+def transform_template(template_file):
+    """Convert the CFN-Sphere template (path, filename) to JSON
+
+    Returns (template_file, json, error) so it can run in a worker process.
+    """
+    from cfn_sphere.file_loader import FileLoader
+    from cfn_sphere.template.transformer import CloudFormationTemplateTransformer
+
+    path, filename = template_file
+    try:
+        template = FileLoader.get_cloudformation_template(filename, path)
+        transformed = CloudFormationTemplateTransformer.transform_template(
+                template)
+        return template_file, transformed.get_template_json(), None
+    except Exception as e:
+        return template_file, None, 'Failed to transform {0}: {1}'.format(
+                filename, e)
+
+
+def start_transform_pool(template_files, workers):
+    """Start workers processes to transform template_files, None for one
+
+    Call it before starting any threads, forking a process while other
+    threads hold locks (e.g. of logging or boto) can deadlock the child.
+    """
+    if not workers or workers <= 1 or len(template_files) <= 1:
+        return None
+    return multiprocessing.Pool(min(workers, len(template_files)))
+
+
+def transform_templates(template_files, pool=None):
+    """Yield transform_template() results, using the processes of pool"""
+    if pool is None:
+        for template_file in template_files:
+            yield transform_template(template_file)
+        return
+    for result in pool.imap_unordered(transform_template, template_files):
+        yield result
 
-from .helpers import upload_helper, copy_helper, check_acl_parameter_validity
+
+def compact_template_json(output):
+    """Serialize the template JSON without whitespace and with sorted keys
+
+    Sorting the keys makes the output, and so its sha256, independent of
+    the order in which cfn-sphere emits them.
+    """
+    return json.dumps(json.loads(output), sort_keys=True,
+                      separators=(',', ':'))
+
+
+def log_template_sizes(logger, sizes):
+    """Log a table of (filename, original, uploaded bytes, seconds)"""
+    if not sizes:
+        return
+    width = max(len('Template'), max(len(size[0]) for size in sizes))
+    line = '{0:<{width}}  {1:>10}  {2:>10}  {3:>8}'
+    logger.info(line.format('Template', 'Original', 'Uploaded', 'Seconds',
+                            width=width))
+    for filename, original, uploaded, seconds in sorted(sizes):
+        logger.info(line.format(filename, original, uploaded,
+                                '{0:.2f}'.format(seconds), width=width))
+
+
+def get_template_cache_key(template_file):
+    """Hash the template source and the cfn-sphere version
+
+    Returns None for templates which are not local files.
+    """
+    import cfn_sphere
+
+    path, filename = template_file
+    filename = os.path.join(path, filename)
+    if not os.path.isfile(filename):
+        return None
+    with open(filename, 'rb') as template:
+        source_sha256 = hashlib.sha256(template.read()).hexdigest()
+    return hash_key(source_sha256,
+                    getattr(cfn_sphere, '__version__', 'unknown'))
 
 
 @task('upload_cfn_to_s3',
@@ -16,38 +123,135 @@ def upload_cfn_to_s3(project, logger):
 
     This means, when using Python<2.7, this task is not visible
     (see __init__.py).
-    """
-    from cfn_sphere.file_loader import FileLoader
-    from cfn_sphere.template.transformer import CloudFormationTemplateTransformer
 
-    for path, filename in project.get_property('template_files'):
-        template = FileLoader.get_cloudformation_template(filename, path)
-        transformed = CloudFormationTemplateTransformer.transform_template(
-                template)
-        output = transformed.get_template_json()
+    Templates are transformed in processes and uploaded in threads.
+    All errors are collected and reported together.
 
-        bucket_name = project.get_property('bucket_name')
-        key_prefix = project.get_property('template_key_prefix')
-        filename = filename.replace('.yml', '.json')
-        filename = filename.replace('.yaml', '.json')
+    With template_json_compact the JSON is uploaded without whitespace and
+    with sorted keys. Templates larger than template_max_size bytes fail.
+    """
+    bucket_name = project.get_property('bucket_name')
+    key_prefix = project.get_property('template_key_prefix')
+    acl = project.get_property('template_file_access_control')
+    check_acl_parameter_validity('template_file_access_control', acl)
+    skip_unchanged = project.get_property('skip_unchanged_uploads')
+    transfer_config = get_transfer_config(project)
+    storage = get_storage(logger, project)
+    # (path, filename) pairs may be given as lists, they are used as keys
+    template_files = [tuple(template_file) for template_file
+                      in project.get_property('template_files')]
+    cache_dir = project.get_property('template_cache_dir')
+    if cache_dir:
+        cache_dir = os.path.expanduser(cache_dir)
+    compact = project.get_property('template_json_compact')
+    max_size = project.get_property('template_max_size')
+    errors = []
+    sizes = []
+
+    def upload(filename, output):
+        json_filename = get_json_filename(filename)
         version_path = '{0}v{1}/{2}'.format(
-                key_prefix, project.version, filename)
-        # latest_path = '{0}latest/{1}'.format(key_prefix, filename)
+                key_prefix, project.version, json_filename)
+        try:
+            data = output.encode('utf-8')
+            original_size = len(data)
+            if compact:
+                data = compact_template_json(output).encode('utf-8')
+            add_metric('cfn.template.bytes', len(data))
+            add_metric('cfn.template.saved_bytes', original_size - len(data))
+            if max_size and len(data) > max_size:
+                errors.append('Template {0} takes {1} bytes, more than its '
+                              'limit of {2} bytes'.format(
+                                  json_filename, len(data), max_size))
+                return
+            start = time.time()
+            upload_helper(logger, bucket_name, version_path, data, acl,
+                          skip_unchanged=skip_unchanged,
+                          transfer_config=transfer_config,
+                          storage=storage)
+            sizes.append((json_filename, original_size, len(data),
+                          time.time() - start))
+        except Exception as e:
+            errors.append('Failed to upload {0}: {1}'.format(
+                    version_path, e))
 
-        acl = project.get_property('template_file_access_control')
-        check_acl_parameter_validity('template_file_access_control', acl)
-        upload_helper(logger, bucket_name, version_path, output, acl)
-        # upload_helper(logger, bucket_name, latest_path, output, acl)
+    cached = []
+    cache_keys = {}
+    to_transform = []
+    for template_file in template_files:
+        key = cache_dir and get_template_cache_key(template_file)
+        output = key and read_cache_file(cache_dir, key)
+        if output:
+            logger.debug('Using cached transformation of {0}'.format(
+                    template_file[1]))
+            add_metric('cfn.cache_hits')
+            cached.append((template_file[1], output.decode('utf-8')))
+            continue
+        cache_keys[template_file] = key
+        to_transform.append(template_file)
 
-@task('cfn_release', description='Copy CFN templates from versioned path to latest path in S3')
-def cfn_release(project, logger):
+    # Fork the workers before any thread of the upload pool exists
+    transform_pool = start_transform_pool(
+            to_transform,
+            project.get_property('template_transform_workers', 1))
+    upload_pool = ThreadPool(
+            project.get_property('template_upload_concurrency', 1) or 1)
+    try:
+        for filename, output in cached:
+            upload_pool.apply_async(upload, (filename, output))
+
+        with measure('cfn.transform.seconds'):
+            for template_file, output, error in transform_templates(
+                    to_transform, transform_pool):
+                if error:
+                    errors.append(error)
+                    continue
+                add_metric('cfn.transform.count')
+                if cache_keys[template_file]:
+                    write_cache_file(cache_dir, cache_keys[template_file],
+                                     output.encode('utf-8'))
+                upload_pool.apply_async(upload, (template_file[1], output))
+    finally:
+        if transform_pool is not None:
+            transform_pool.terminate()
+            transform_pool.join()
+        upload_pool.close()
+        upload_pool.join()
+    log_template_sizes(logger, sizes)
+    if cache_dir:
+        evict_least_recently_used(
+                logger, cache_dir,
+                project.get_property('template_cache_max_entries'))
+
+    publish_metrics(logger, project)
+
+    if errors:
+        for error in errors:
+            logger.error(error)
+        raise BuildFailedException(
+                '{0} of {1} templates failed:\n{2}'.format(
+                    len(errors), len(template_files), '\n'.join(errors)))
+
+
+def get_cfn_release_plan(project):
+    """The copies of the templates from the versioned to the latest path"""
     bucket_name = project.get_property('bucket_name')
     key_prefix = project.get_property('template_key_prefix')
     acl = project.get_property('template_file_access_control')
     check_acl_parameter_validity('template_file_access_control', acl)
 
+    plan = []
     for path, filename in project.get_property('template_files'):
-        filename = filename.replace('.yml', '.json').replace('.yaml', '.json')
+        filename = get_json_filename(filename)
         source_key = '{0}v{1}/{2}'.format(key_prefix, project.version, filename)
         destination_key = '{0}latest/{1}'.format(key_prefix, filename)
-        copy_helper(logger, bucket_name, source_key, destination_key, acl)
+        plan.append((bucket_name, source_key, destination_key, acl))
+    return plan
+
+
+@task('cfn_release', description='Copy CFN templates from versioned path to latest path in S3')
+def cfn_release(project, logger):
+    release_helper(logger, get_cfn_release_plan(project),
+                   concurrency=project.get_property('release_concurrency'),
+                   storage=get_storage(logger, project))
+    publish_metrics(logger, project)
@@ -1,10 +1,48 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
+import contextlib
+import hashlib
+import io
+import json
+import os
+import threading
+import time
+from multiprocessing.pool import ThreadPool
+
 import boto3
+from boto3.s3.transfer import TransferConfig
+from botocore.config import Config
+from botocore.exceptions import ClientError
 from pybuilder.ci_server_interaction import flush_text_line
 from pybuilder.errors import BuildFailedException
 
+from .metrics_helpers import (add_metric,
+                              get_metrics,
+                              get_unpublished_metrics,
+                              max_metric,
+                              )
+from .retry_helpers import (DEFAULT_MAX_ATTEMPTS,
+                            DEFAULT_RETRY_DEADLINE,
+                            register_retry_handler,
+                            )
+from .storage_helpers import LocalStorage, S3Storage, is_not_found
+
+SHA256_METADATA_KEY = 'sha256'
+METRICS_REPORT = 'aws_plugin_metrics.json'
+TEAMCITY_STATISTIC_PREFIX = 'pybuilder_aws_plugin.'
+HASH_BUFFER_SIZE = 1024 * 1024
+# S3 rejects multipart uploads with smaller parts (except the last one)
+MIN_PART_SIZE = 5 * 1024 * 1024
+DEFAULT_PART_SIZE = 8 * 1024 * 1024
+DEFAULT_UPLOAD_CONCURRENCY = 10
+DEFAULT_MAX_POOL_CONNECTIONS = 20
+DEFAULT_RELEASE_CONCURRENCY = 8
+
+# The boto3 session and S3 client shared by all tasks of a build
+_s3 = {}
+_s3_lock = threading.Lock()
+
 permissible_acl_values = [
     'private',
     'public-read',
@@ -15,25 +53,229 @@ permissible_acl_values = [
 ]
 
 
-def upload_helper(logger, bucket_name, keyname, data, acl):
-    s3 = boto3.resource('s3')
+@contextlib.contextmanager
+def log_duration(logger, description):
+    start = time.time()
+    yield
+    logger.debug('{0} took {1:.3f}s'.format(description, time.time() - start))
+
+
+def get_s3_client(logger, project=None):
+    """Return the S3 client shared by all tasks, create it on first use
+
+    The size of its connection pool and its retries are set by the
+    s3_max_pool_connections, s3_max_attempts and s3_retry_deadline
+    properties of the project creating the client. All calls share one
+    retry policy: exponential backoff with jitter and, once S3 throttles,
+    client side rate limiting.
+    """
+    with _s3_lock:
+        if 'client' not in _s3:
+            max_pool_connections = DEFAULT_MAX_POOL_CONNECTIONS
+            max_attempts = DEFAULT_MAX_ATTEMPTS
+            deadline = DEFAULT_RETRY_DEADLINE
+            if project is not None:
+                max_pool_connections = project.get_property(
+                        's3_max_pool_connections', max_pool_connections)
+                max_attempts = project.get_property(
+                        's3_max_attempts', max_attempts)
+                deadline = project.get_property('s3_retry_deadline', deadline)
+            with log_duration(logger, 'Creating boto3 session and S3 client'):
+                _s3['session'] = boto3.session.Session()
+                _s3['client'] = _s3['session'].client(
+                        's3',
+                        config=Config(
+                            max_pool_connections=max_pool_connections,
+                            retries={'mode': 'adaptive',
+                                     'total_max_attempts': max_attempts}))
+                register_retry_handler(_s3['client'], logger,
+                                       max_attempts=max_attempts,
+                                       deadline=deadline)
+        return _s3['client']
+
+
+def reset_s3_client():
+    """Forget the shared S3 client, the next use creates a new one"""
+    with _s3_lock:
+        _s3.clear()
+
+
+def get_storage(logger, project=None):
+    """Return the storage backend for the buckets of the project
+
+    This is S3, accessed through the shared client, unless the
+    local_storage_dir property points to a directory standing in for S3.
+    """
+    local_storage_dir = None
+    if project is not None:
+        local_storage_dir = project.get_property('local_storage_dir')
+    if local_storage_dir:
+        return LocalStorage(os.path.join(
+                project.basedir, os.path.expanduser(local_storage_dir)))
+    return S3Storage(get_s3_client(logger, project))
+
+
+def get_remote_sha256(logger, bucket_name, keyname, storage=None):
+    """Return the SHA-256 stored as metadata of an object, if any"""
+    storage = storage or get_storage(logger)
+    try:
+        with log_duration(logger, 'HEAD {0}/{1}'.format(
+                bucket_name, keyname)):
+            metadata = storage.head(bucket_name, keyname)
+    except ClientError:
+        return None
+    return (metadata or {}).get(SHA256_METADATA_KEY)
+
+
+def object_exists(logger, bucket_name, keyname, storage=None):
+    """Whether the object exists, missing and forbidden objects do not
+
+    Without s3:ListBucket S3 answers 403 instead of 404 for missing keys.
+    """
+    storage = storage or get_storage(logger)
+    try:
+        with log_duration(logger, 'HEAD {0}/{1}'.format(
+                bucket_name, keyname)):
+            return storage.head(bucket_name, keyname) is not None
+    except ClientError as e:
+        if is_not_found(e) or e.response.get('Error', {}).get('Code') in (
+                '403', 'AccessDenied'):
+            return False
+        raise
+
+
+def stream_sha256(fileobj):
+    """Hash fileobj from its current position and rewind it afterwards"""
+    position = fileobj.tell()
+    sha256 = hashlib.sha256()
+    for chunk in iter(lambda: fileobj.read(HASH_BUFFER_SIZE), b''):
+        sha256.update(chunk)
+    fileobj.seek(position)
+    return sha256.hexdigest()
+
+
+def get_transfer_config(project):
+    """Multipart upload settings from the project properties"""
+    part_size = project.get_property('upload_part_size', DEFAULT_PART_SIZE)
+    if part_size < MIN_PART_SIZE:
+        raise BuildFailedException(
+                "upload_part_size must be at least {0} bytes, got {1}".format(
+                    MIN_PART_SIZE, part_size))
+    return TransferConfig(
+            multipart_threshold=part_size,
+            multipart_chunksize=part_size,
+            max_concurrency=project.get_property(
+                'upload_max_concurrency', DEFAULT_UPLOAD_CONCURRENCY))
+
+
+def upload_helper(logger, bucket_name, keyname, data, acl,
+                  skip_unchanged=False, transfer_config=None, storage=None):
+    """Upload data, either bytes, text or a seekable binary file object
+
+    Files larger than the multipart threshold of transfer_config are
+    uploaded to S3 in parts, so memory use does not depend on the file size.
+    """
+    storage = storage or get_storage(logger)
+    if not hasattr(data, 'read'):
+        if not isinstance(data, bytes):
+            data = data.encode('utf-8')
+        data = io.BytesIO(data)
+    sha256 = stream_sha256(data)
+    if (skip_unchanged and
+            get_remote_sha256(logger, bucket_name, keyname,
+                              storage=storage) == sha256):
+        logger.info(
+                'Skipping upload to bucket "{0}" key {1}, content is '
+                'unchanged'.format(bucket_name, keyname))
+        # The acl may have changed since the object was uploaded
+        storage.set_acl(bucket_name, keyname, acl)
+        add_metric('s3.upload.skipped')
+        return False
     logger.info(
             'Uploading to bucket "{0}" key {1}'
                 .format(bucket_name, keyname))
-    s3.Bucket(bucket_name).put_object(Key=keyname, Body=data, ACL=acl)
+    position = data.tell()
+    data.seek(0, io.SEEK_END)
+    size = data.tell() - position
+    data.seek(position)
+    start = time.time()
+    with log_duration(logger, 'Upload {0}/{1}'.format(bucket_name, keyname)):
+        storage.put(bucket_name, keyname, data, acl,
+                    {SHA256_METADATA_KEY: sha256},
+                    transfer_config=transfer_config)
+    add_metric('s3.upload.count')
+    add_metric('s3.upload.bytes', size)
+    add_metric('s3.upload.seconds', time.time() - start)
+    return True
 
 
-def copy_helper(logger, bucket_name, source_key, destination_key, acl):
-    'Copy S3 source_key to destination_key in bucket_name applying acl'
+def upload_file_helper(logger, bucket_name, keyname, filename, acl,
+                       skip_unchanged=False, transfer_config=None,
+                       storage=None):
+    """Upload the file filename without reading it into memory"""
+    with open(filename, 'rb') as fileobj:
+        return upload_helper(logger, bucket_name, keyname, fileobj, acl,
+                             skip_unchanged=skip_unchanged,
+                             transfer_config=transfer_config,
+                             storage=storage)
+
+
+def copy_helper(logger, bucket_name, source_key, destination_key, acl,
+                storage=None):
+    'Copy source_key to destination_key in bucket_name applying acl'
     logger.info('Copying in {0} from {1} to {2}'.format(bucket_name, source_key, destination_key))
-    client = boto3.client('s3')
-    client.copy_object(ACL=acl,
-                       Bucket=bucket_name,
-                       CopySource={'Bucket': bucket_name,
-                                   'Key':    source_key
-                                   },
-                       Key=destination_key,
-                       MetadataDirective='COPY')
+    storage = storage or get_storage(logger)
+    with log_duration(logger, 'Copy {0}/{1}'.format(bucket_name, source_key)):
+        storage.copy(bucket_name, source_key, destination_key, acl)
+
+
+def release_helper(logger, plan, concurrency=1, storage=None):
+    """Run the S3 server side copies of plan concurrently
+
+    plan is a list of (bucket_name, source_key, destination_key, acl). All
+    copies are attempted, failures are reported together at the end.
+    """
+    storage = storage or get_storage(logger)
+    errors = []
+    latencies = []
+
+    def release(copy):
+        bucket_name, source_key, destination_key, acl = copy
+        start = time.time()
+        try:
+            copy_helper(logger, bucket_name, source_key, destination_key, acl,
+                        storage=storage)
+        except Exception as e:
+            errors.append('Failed to copy {0} to {1} in {2}: {3}'.format(
+                    source_key, destination_key, bucket_name, e))
+            return
+        latency = time.time() - start
+        latencies.append(latency)
+        add_metric('s3.copy.count')
+        add_metric('s3.copy.seconds', latency)
+        max_metric('s3.copy.max_seconds', latency)
+        logger.info('Released {0} in {1:.3f}s'.format(
+                destination_key, latency))
+
+    start = time.time()
+    pool = ThreadPool(max(1, min(concurrency or 1, len(plan))))
+    try:
+        pool.map(release, plan)
+    finally:
+        pool.close()
+        pool.join()
+    duration = time.time() - start
+    add_metric('release.seconds', duration)
+    logger.info(
+            'Released {0} of {1} objects in {2:.3f}s (slowest copy: '
+            '{3:.3f}s)'.format(len(latencies), len(plan), duration,
+                               max(latencies or [0])))
+    if errors:
+        for error in errors:
+            logger.error(error)
+        raise BuildFailedException(
+                '{0} of {1} copies failed:\n{2}'.format(
+                    len(errors), len(plan), '\n'.join(errors)))
 
 
 def check_acl_parameter_validity(property_, acl_value):
@@ -49,6 +291,57 @@ def teamcity_helper(tc_param, keyname):
                     tc_param, keyname
             ))
 
+
+def teamcity_statistic(key, value):
+    flush_text_line(
+            "##teamcity[buildStatisticValue key='{0}' value='{1}']".format(
+                _teamcity_escape_value(key), value))
+
+
+def publish_metrics(logger, project):
+    """Write the metrics of the build so far to the JSON build report
+
+    The report in $dir_target/reports is updated, so it collects the metrics
+    of all tasks. On TeamCity the metrics which changed since the last call
+    are also reported as build statistics.
+    """
+    metrics = dict((name, round(value, 3))
+                   for name, value in get_metrics().items())
+    changed = get_unpublished_metrics()
+    if not metrics:
+        return
+    if metrics.get('s3.retries'):
+        logger.info('S3 calls were retried {0} times after {1:.1f}s of '
+                    'backoff so far.'.format(
+                        int(metrics['s3.retries']),
+                        metrics.get('s3.retry_backoff_seconds', 0)))
+    if project.get_property('dir_target'):
+        write_metrics_report(logger, project, metrics)
+    if project.get_property('teamcity_output'):
+        for name in sorted(changed):
+            teamcity_statistic(TEAMCITY_STATISTIC_PREFIX + name,
+                               metrics[name])
+
+
+def write_metrics_report(logger, project, metrics):
+    reports_dir = os.path.join(project.expand_path('$dir_target'), 'reports')
+    if not os.path.isdir(reports_dir):
+        os.makedirs(reports_dir)
+    report = os.path.join(reports_dir, METRICS_REPORT)
+    previous = {}
+    if os.path.isfile(report):
+        with open(report) as report_file:
+            try:
+                previous = json.load(report_file)
+            except ValueError:
+                logger.warn('Replacing unreadable build report "{0}".'.format(
+                        report))
+    previous.update(metrics)
+    with open(report, 'w') as report_file:
+        json.dump(previous, report_file, indent=1, sort_keys=True)
+    logger.debug('Metrics written to "{0}".'.format(report))
+
+
 # copied from https://github.com/JetBrains/teamcity-messages/blob/942584909b2ce51e62a7c3360c5e1d1af6e1ef5a/teamcity/messages.py#L13
 _quote = {"'": "|'", "|": "||", "\n": "|n", "\r": "|r", '[': '|[', ']': '|]'}
 
@@ -0,0 +1,165 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import ast
+import os
+
+# Calls whose constant string argument names a module imported at runtime
+_DYNAMIC_IMPORT_CALLS = ('import_module', '__import__')
+_EXTENSION_SUFFIXES = ('.so', '.pyd')
+
+
+def module_name(arcname):
+    """The module arcname defines as (name, is_package), None if none"""
+    parts = arcname.replace(os.sep, '/').split('/')
+    filename = parts.pop()
+    if filename.endswith('.py'):
+        name = filename[:-len('.py')]
+    elif filename.endswith(_EXTENSION_SUFFIXES):
+        name = filename.split('.')[0]
+    else:
+        return None
+    if not all(is_identifier(part) for part in parts + [name]):
+        return None
+    if name == '__init__':
+        return '.'.join(parts), True
+    return '.'.join(parts + [name]), False
+
+
+def is_identifier(name):
+    return bool(name) and name.replace('_', 'a').isalnum() and \
+        not name[0].isdigit()
+
+
+def parents(name):
+    """'a.b.c' -> ['a', 'a.b']"""
+    parts = name.split('.')
+    return ['.'.join(parts[:i]) for i in range(1, len(parts))]
+
+
+def find_imports(source, name, is_package):
+    """Names of the modules the source of module name may import
+
+    Imports anywhere in the module count, also inside functions and try
+    blocks, as well as importlib.import_module() and __import__() with a
+    constant name. Returned names may also be attributes, not modules.
+    """
+    package = name if is_package else name.rpartition('.')[0]
+    imports = set()
+    for node in ast.walk(ast.parse(source)):
+        if isinstance(node, ast.Import):
+            imports.update(alias.name for alias in node.names)
+        elif isinstance(node, ast.ImportFrom):
+            base = node.module or ''
+            if node.level:
+                package_parts = package.split('.') if package else []
+                if node.level - 1 > len(package_parts):
+                    continue
+                prefix = package_parts[:len(package_parts) - node.level + 1]
+                base = '.'.join(prefix + ([base] if base else []))
+            if not base:
+                continue
+            imports.add(base)
+            for alias in node.names:
+                imports.add('{0}.{1}'.format(base, alias.name))
+        elif isinstance(node, ast.Call):
+            function = node.func
+            function_name = getattr(function, 'attr', None) or \
+                getattr(function, 'id', None)
+            if function_name in _DYNAMIC_IMPORT_CALLS and node.args:
+                argument = node.args[0]
+                value = getattr(argument, 'value', getattr(argument, 's',
+                                                           None))
+                if isinstance(value, str):
+                    imports.add(value)
+    return imports
+
+
+def reachable_modules(logger, modules, roots):
+    """Names of all modules reachable from roots
+
+    modules maps module names to (path, is_package), path is None for
+    extension modules and namespace packages.
+    """
+    reachable = set()
+    pending = list(roots)
+    while pending:
+        name = pending.pop()
+        if name in reachable or name not in modules:
+            continue
+        reachable.add(name)
+        pending.extend(parents(name))
+        path, is_package = modules[name]
+        if path is None:
+            continue
+        with open(path, 'rb') as source_file:
+            source = source_file.read()
+        try:
+            imports = find_imports(source, name, is_package)
+        except (SyntaxError, ValueError) as e:
+            logger.warn('Can not parse module {0}, not following its '
+                        'imports: {1}'.format(name, e))
+            continue
+        for imported in imports:
+            if imported.endswith('.*'):
+                continue
+            pending.append(imported)
+            pending.extend(parents(imported))
+            if imported + '.*' in imports:
+                pending.extend(submodules(modules, imported))
+    return reachable
+
+
+def submodules(modules, name):
+    prefix = name + '.'
+    return [other for other in modules
+            if other.startswith(prefix) and '.' not in other[len(prefix):]]
+
+
+def prune_unreachable(logger, files, roots, keep=(), context=()):
+    """Split the (path, arcname) list files into reachable and dropped files
+
+    Modules are reachable from the root modules through imports, modules in
+    keep and their submodules are always reachable. Other files are kept if
+    the nearest package containing them is reachable or if they are not part
+    of any package. The imports of the (path, arcname) list context, e.g. the
+    files of a layer, are followed too, but context is never pruned.
+    """
+    modules = {}
+    for path, arcname in list(context) + list(files):
+        found = module_name(arcname)
+        if found is None:
+            continue
+        name, is_package = found
+        source = path if arcname.endswith('.py') else None
+        modules[name] = (source, is_package)
+        for parent in parents(name):
+            modules.setdefault(parent, (None, True))
+
+    kept_roots = list(roots)
+    for name in modules:
+        for prefix in keep:
+            if name == prefix or name.startswith(prefix + '.'):
+                kept_roots.append(name)
+    reachable = reachable_modules(logger, modules, kept_roots)
+
+    kept = []
+    dropped = []
+    for path, arcname in files:
+        found = module_name(arcname)
+        if found is not None:
+            is_reachable = found[0] in reachable
+        else:
+            is_reachable = True
+            parts = arcname.replace(os.sep, '/').split('/')[:-1]
+            while parts:
+                package = '.'.join(parts)
+                if package in modules:
+                    is_reachable = package in reachable
+                    break
+                parts.pop()
+        if is_reachable:
+            kept.append((path, arcname))
+        else:
+            dropped.append((path, arcname))
+    return kept, dropped
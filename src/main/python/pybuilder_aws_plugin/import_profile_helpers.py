@@ -0,0 +1,175 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import json
+import os
+import shutil
+import subprocess
+import tempfile
+import zipfile
+
+from pybuilder.errors import BuildFailedException
+
+# Title, blank line and column names preceding the modules in the text table
+PROFILE_HEADER_LINES = 3
+
+# Runs in a clean interpreter (no site, no environment), imports the handler
+# module with sys.path limited to the extracted lambda-zip, extra paths and
+# the standard library. Every loader is wrapped to measure the time and the
+# resident memory each module needs, both with and without the modules it
+# imports itself.
+PROFILE_SCRIPT = """
+import json, os, sys, time
+
+output, task_dir, handler = sys.argv[1:4]
+sys.path[:] = [task_dir] + sys.argv[4:] + [p for p in sys.path if p]
+
+def rss():
+    try:
+        with open('/proc/self/statm') as statm:
+            return int(statm.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (IOError, OSError):
+        import resource
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+clock = getattr(time, 'perf_counter', time.time)
+records = []
+stack = []
+
+
+class ProfilingLoader(object):
+    def __init__(self, loader):
+        self.loader = loader
+
+    def __getattr__(self, name):
+        return getattr(self.loader, name)
+
+    def create_module(self, spec):
+        return self.loader.create_module(spec)
+
+    def exec_module(self, module):
+        stack.append([0.0, 0])
+        start_memory = rss()
+        start = clock()
+        try:
+            self.loader.exec_module(module)
+        finally:
+            duration = clock() - start
+            memory = rss() - start_memory
+            children_duration, children_memory = stack.pop()
+            if stack:
+                stack[-1][0] += duration
+                stack[-1][1] += memory
+            records.append({
+                'module': module.__name__,
+                'cumulative_ms': duration * 1000,
+                'self_ms': (duration - children_duration) * 1000,
+                'cumulative_kib': memory / 1024.0,
+                'self_kib': (memory - children_memory) / 1024.0,
+                'origin': getattr(module.__spec__, 'origin', None),
+            })
+            module.__loader__ = self.loader
+            if getattr(module, '__spec__', None) is not None:
+                module.__spec__.loader = self.loader
+
+
+class ProfilingFinder(object):
+    @staticmethod
+    def find_spec(name, path=None, target=None):
+        for finder in sys.meta_path:
+            if finder is ProfilingFinder or not hasattr(finder, 'find_spec'):
+                continue
+            spec = finder.find_spec(name, path, target)
+            if spec is not None:
+                if spec.loader is not None and hasattr(spec.loader,
+                                                       'exec_module'):
+                    spec.loader = ProfilingLoader(spec.loader)
+                return spec
+        return None
+
+
+sys.meta_path.insert(0, ProfilingFinder)
+start_memory = rss()
+start = clock()
+error = None
+try:
+    for name in handler.split(','):
+        __import__(name)
+except BaseException as e:
+    error = '{0}: {1}'.format(type(e).__name__, e)
+result = {
+    'handler': handler,
+    'python': sys.version.split()[0],
+    'total_ms': (clock() - start) * 1000,
+    'total_kib': (rss() - start_memory) / 1024.0,
+    'error': error,
+    'modules': records,
+}
+with open(output, 'w') as output_file:
+    json.dump(result, output_file)
+"""
+
+
+def extract_zipfile(path_to_zipfile, directory):
+    archive = zipfile.ZipFile(path_to_zipfile)
+    try:
+        archive.extractall(directory)
+    finally:
+        archive.close()
+
+
+def profile_imports(interpreter, path_to_zipfile, handler, extra_paths=(),
+                    path_to_layer=None):
+    """Import handler from the extracted lambda-zip in a clean interpreter
+
+    The python/ directory of the layer zip path_to_layer follows the
+    lambda-zip on sys.path, like /opt/python in the Lambda runtime. Returns
+    the result of PROFILE_SCRIPT, modules ranked by their own import time.
+    """
+    workdir = tempfile.mkdtemp(prefix='lambda-import-profile-')
+    try:
+        task_dir = os.path.join(workdir, 'task')
+        extract_zipfile(path_to_zipfile, task_dir)
+        paths = [os.path.abspath(path) for path in extra_paths]
+        if path_to_layer:
+            opt_dir = os.path.join(workdir, 'opt')
+            extract_zipfile(path_to_layer, opt_dir)
+            paths.insert(0, os.path.join(opt_dir, 'python'))
+        output = os.path.join(workdir, 'profile.json')
+        command = [interpreter, '-B', '-E', '-s', '-S', '-c', PROFILE_SCRIPT,
+                   output, task_dir, handler] + paths
+        try:
+            process = subprocess.Popen(command, cwd=workdir,
+                                       stdout=subprocess.PIPE,
+                                       stderr=subprocess.STDOUT)
+        except OSError as e:
+            raise BuildFailedException(
+                    "Can not run interpreter '{0}' to profile imports: "
+                    "{1}".format(interpreter, e))
+        stdout = process.communicate()[0]
+        if process.returncode != 0 or not os.path.isfile(output):
+            raise BuildFailedException(
+                    'Profiling the imports of {0} failed: {1}'.format(
+                        handler, stdout.decode('utf-8', 'replace')))
+        with open(output) as output_file:
+            result = json.load(output_file)
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+    result['modules'].sort(key=lambda record: record['self_ms'], reverse=True)
+    return result
+
+
+def format_import_profile(result):
+    """Render the ranked result of profile_imports() as a text table"""
+    lines = ['Import profile of {0} (Python {1}): {2:.1f} ms, {3:.0f} KiB'
+             .format(result['handler'], result['python'], result['total_ms'],
+                     result['total_kib']),
+             '',
+             '{0:>5} {1:>10} {2:>10} {3:>10} {4:>10}  {5}'.format(
+                 'rank', 'self ms', 'cum ms', 'self KiB', 'cum KiB', 'module')]
+    for rank, record in enumerate(result['modules'], 1):
+        lines.append('{0:>5} {1:>10.2f} {2:>10.2f} {3:>10.0f} {4:>10.0f}  '
+                     '{5}'.format(rank, record['self_ms'],
+                                  record['cumulative_ms'], record['self_kib'],
+                                  record['cumulative_kib'], record['module']))
+    return '\n'.join(lines) + '\n'
@@ -2,50 +2,230 @@
 # -*- coding: utf-8 -*-
 
 import ast
+import json
 import os
+import platform
+import re
+import shutil
 import subprocess
+import sys
+import tempfile
 import zipfile
 
 from pybuilder.core import depends, task
+from pybuilder.errors import BuildFailedException
 from pybuilder.plugins.python.distutils_plugin import build_install_dependencies_string
 
-from .helpers import (upload_helper,
-                      copy_helper,
+from .bytecode_helpers import compile_bytecode, get_bytecode_interpreter
+from .cache_helpers import (hash_key,
+                            evict_least_recently_used,
+                            file_lock,
+                            link_tree,
+                            locked_cache_entry,
+                            populate_cache_entry,
+                            )
+from .helpers import (upload_file_helper,
+                      publish_metrics,
+                      object_exists,
+                      release_helper,
+                      get_storage,
+                      get_transfer_config,
                       teamcity_helper,
                       check_acl_parameter_validity,
                       )
+from .import_graph_helpers import module_name, prune_unreachable
+from .import_profile_helpers import (PROFILE_HEADER_LINES,
+                                     extract_zipfile,
+                                     format_import_profile,
+                                     profile_imports,
+                                     )
+from .metrics_helpers import add_metric, get_metrics, measure
+from .prune_helpers import (DEFAULT_EXCLUDE_PATTERNS,
+                            matches_any,
+                            slim_dependencies,
+                            )
+from .wheelhouse_helpers import (fill_wheelhouse,
+                                 find_missing_pinned_wheels,
+                                 is_install_only_metadata,
+                                 is_pure_wheel,
+                                 prune_wheelhouse,
+                                 resolve_requirements,
+                                 run_pip,
+                                 )
+from .zip_helpers import (collect_files,
+                          copy_members,
+                          file_sha256,
+                          make_compression_policy,
+                          normalize_zip_info,
+                          read_manifest,
+                          SizeBudget,
+                          write_files,
+                          write_files_incremental,
+                          write_manifest,
+                          )
+
+# Provided by the Lambda runtime, never packaged
+RUNTIME_DEPENDENCIES = ['boto', 'boto3']
+# Number of the slowest imports logged, the full profile is in the report
+LOGGED_PROFILE_MODULES = 10
+
+pip_error_pattern = re.compile(
+        r'(?:satisfies the requirement|distribution found for|wheels? for|'
+        r'cannot install|error installing) ([^\s(),]+)', re.IGNORECASE)
+
+# Resolved versions by dependencies and index options, see
+# get_resolved_dependencies
+_resolved_dependencies = {}
 
 
 def zip_recursive(archive, directory, folder=''):
     """Zip directories recursively"""
-    for item in os.listdir(directory):
-        if os.path.isfile(os.path.join(directory, item)):
-            archive.write(
-                    os.path.join(directory, item), os.path.join(folder, item),
-                    zipfile.ZIP_DEFLATED)
-        elif os.path.isdir(os.path.join(directory, item)):
-            zip_recursive(
-                    archive, os.path.join(directory, item),
-                    folder=os.path.join(folder, item))
-
-
-def prepare_dependencies_dir(logger, project, target_directory, excludes=None):
-    """Get all dependencies from project and install them to given dir"""
+    write_files(archive, collect_files(directory, folder))
+
+
+def get_lambda_dependencies(logger, project, excludes=None):
+    """Get all dependencies from project which are not excluded"""
     excludes = excludes or []
-    dependencies = ast.literal_eval(build_install_dependencies_string(project))
+    dependencies = []
+    for dependency in ast.literal_eval(
+            build_install_dependencies_string(project)):
+        if dependency in excludes:
+            logger.debug("Not installing dependency {0}.".format(dependency))
+            continue
+        dependencies.append(dependency)
+    return dependencies
+
 
+def get_index_url_option(project):
+    wheelhouse = get_wheelhouse_dir(project)
+    if wheelhouse:
+        return "--no-index --find-links {0}".format(wheelhouse)
     index_url = project.get_property('install_dependencies_index_url')
     if index_url:
-        index_url = "--index-url {0}".format(index_url)
-    else:
-        index_url = ""
+        return "--index-url {0}".format(index_url)
+    return ""
+
+
+def get_wheelhouse_dir(project):
+    wheelhouse = project.get_property('lambda_wheelhouse_dir')
+    if wheelhouse:
+        return os.path.abspath(os.path.expanduser(wheelhouse))
+    return None
+
+
+def get_resolved_dependencies(logger, project, dependencies):
+    """Pin all packages pip would install for dependencies
+
+    Returns None if pip cannot resolve them, e.g. because it is older than
+    22.2. The result is kept for the rest of the build.
+    """
+    index_options = get_index_url_option(project).split()
+    key = hash_key(dependencies, index_options)
+    if key not in _resolved_dependencies:
+        handle, requirements_file = tempfile.mkstemp(
+                prefix='lambda_requirements-', suffix='.txt')
+        os.close(handle)
+        try:
+            write_requirements_file(requirements_file, dependencies)
+            _resolved_dependencies[key] = resolve_requirements(
+                    logger, requirements_file, index_options)
+        except (BuildFailedException, OSError, ValueError) as e:
+            logger.warn('Could not resolve the versions of {0}: {1}'.format(
+                    ', '.join(dependencies), e))
+            _resolved_dependencies[key] = None
+        finally:
+            os.remove(requirements_file)
+    return _resolved_dependencies[key]
+
+
+def reset_resolved_dependencies():
+    """Forget the resolved versions, the next use resolves them again"""
+    _resolved_dependencies.clear()
+
+
+def get_dependencies_cache_key(project, dependencies, resolved):
+    """Hash everything which influences the result of installing dependencies
+
+    resolved are the pinned versions of get_resolved_dependencies, so a new
+    release matching an unpinned dependency gives a new key.
+    """
+    return hash_key(dependencies,
+                    resolved,
+                    project.get_property('install_dependencies_index_url'),
+                    get_wheelhouse_dir(project),
+                    platform.python_version(),
+                    sys.platform,
+                    platform.machine())
+
+
+def prepare_dependencies_dir(logger, project, target_directory, excludes=None,
+                             install=None, cache_name='dependencies'):
+    """Get all dependencies from project and install them to given dir
+
+    install(logger, project, directory, dependencies) does the installation,
+    install_dependencies by default. Its results are cached in the
+    cache_name directory of lambda_cache_dir.
+    """
+    install = install or install_dependencies
+    dependencies = get_lambda_dependencies(logger, project, excludes=excludes)
+    cache_dir = project.get_property('lambda_cache_dir')
+    with measure('lambda.dependencies.seconds'):
+        if cache_dir and dependencies:
+            install_dependencies_cached(
+                    logger, project, target_directory, dependencies,
+                    os.path.join(os.path.expanduser(cache_dir), cache_name),
+                    install=install)
+        else:
+            install(logger, project, target_directory, dependencies)
+
+
+def install_dependencies_cached(logger, project, target_directory,
+                                dependencies, cache_dir, install=None):
+    """Install dependencies via a cache shared between builds"""
+    install = install or install_dependencies
+    resolved = get_resolved_dependencies(logger, project, dependencies)
+    if resolved is None:
+        logger.warn('Not caching dependencies with unknown versions.')
+        install(logger, project, target_directory, dependencies)
+        return
+    key = get_dependencies_cache_key(project, dependencies, resolved)
+    with locked_cache_entry(cache_dir, key) as entry:
+        if os.path.isdir(entry):
+            logger.info('Using cached dependencies {0}.'.format(key))
+            add_metric('lambda.dependencies.cache_hits')
+        else:
+            logger.info('Caching dependencies as {0}.'.format(key))
+            populate_cache_entry(entry, lambda directory: install(
+                    logger, project, directory, dependencies))
+        link_tree(entry, target_directory)
+    evict_least_recently_used(
+            logger, cache_dir,
+            project.get_property('lambda_cache_max_entries'))
+
+
+def check_wheelhouse(project, dependencies):
+    """Fail if a pinned dependency has no wheel in the wheelhouse"""
+    wheelhouse = get_wheelhouse_dir(project)
+    if wheelhouse:
+        missing = find_missing_pinned_wheels(wheelhouse, dependencies)
+        if missing:
+            raise BuildFailedException(
+                    'No wheels for {0} in wheelhouse "{1}", run the '
+                    'fill_lambda_wheelhouse task.'.format(
+                        ', '.join(missing), wheelhouse))
+
+
+def install_dependencies(logger, project, target_directory, dependencies):
+    check_wheelhouse(project, dependencies)
+    index_url = get_index_url_option(project)
+
+    if project.get_property('lambda_dependencies_batch_install'):
+        install_dependencies_batch(
+                logger, target_directory, index_url, dependencies)
+        return
 
     pip_cmd = 'pip install --target {0} {1} {2}'
     for dependency in dependencies:
-        if dependency in excludes:
-            logger.debug("Not installing dependency {0}.".format(dependency))
-            continue
-
         cmd = pip_cmd.format(target_directory, index_url, dependency)
         logger.debug("Installing dependency {0}: '{1}'".format(dependency, cmd))
 
@@ -57,17 +237,489 @@ def prepare_dependencies_dir(logger, project, target_directory, excludes=None):
             raise Exception(msg)
 
 
+def install_dependency_wheels(logger, project, target_directory,
+                              dependencies):
+    """Download the dependencies, install only those pip has to build
+
+    Pure Python wheels are kept in target_directory/wheels, to be copied
+    into the lambda-zip as they are. Source distributions and all other
+    wheels are installed into target_directory/installed.
+    """
+    wheels_dir = os.path.join(target_directory, 'wheels')
+    installed_dir = os.path.join(target_directory, 'installed')
+    for directory in [wheels_dir, installed_dir]:
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+    if not dependencies:
+        return
+    check_wheelhouse(project, dependencies)
+    index_options = get_index_url_option(project).split()
+    requirements_file = os.path.join(target_directory, 'requirements.txt')
+    write_requirements_file(requirements_file, dependencies)
+    run_pip(logger, ['download', '--dest', wheels_dir] + index_options +
+            ['--requirement', requirements_file])
+    os.remove(requirements_file)
+
+    to_install = [os.path.join(wheels_dir, filename)
+                  for filename in sorted(os.listdir(wheels_dir))
+                  if not is_pure_wheel(os.path.join(wheels_dir, filename))]
+    logger.info('Downloaded {0} distributions, {1} of them need pip to '
+                'install.'.format(len(os.listdir(wheels_dir)),
+                                  len(to_install)))
+    if to_install:
+        run_pip(logger, ['install', '--target', installed_dir, '--no-deps'] +
+                index_options + to_install)
+        for path in to_install:
+            os.remove(path)
+
+
+def use_streamed_wheels(logger, project):
+    if not project.get_property('lambda_zip_stream_wheels'):
+        return False
+    conflicts = [name for name in ['lambda_zip_compile_bytecode',
+                                   'lambda_zip_prune_imports']
+                 if project.get_property(name)]
+    if conflicts:
+        logger.warn('Installing the wheels instead of streaming them into '
+                    'the lambda-zip, {0} needs them unpacked.'.format(
+                        ' and '.join(conflicts)))
+        return False
+    return True
+
+
+def list_streamed_wheels(dependencies_dir):
+    wheels_dir = os.path.join(dependencies_dir, 'wheels')
+    if not os.path.isdir(wheels_dir):
+        return []
+    return [os.path.join(wheels_dir, filename)
+            for filename in sorted(os.listdir(wheels_dir))]
+
+
+def write_streamed_wheels(logger, project, archive, wheels, files,
+                          budget=None):
+    """Copy the members of the pure Python wheels into archive
+
+    The compressed data is copied as it is. Install-only metadata and files
+    which are packaged already are skipped, like the excluded files of
+    slimmed dependencies.
+    """
+    excludes = []
+    if project.get_property('lambda_zip_slim'):
+        excludes = project.get_property('lambda_zip_exclude_patterns',
+                                        DEFAULT_EXCLUDE_PATTERNS)
+    reproducible = project.get_property('lambda_zip_reproducible')
+    packaged = set(arcname.replace(os.sep, '/') for _, arcname in files)
+    copied = 0
+    copied_bytes = 0
+    for wheel in wheels:
+        source = zipfile.ZipFile(wheel)
+        try:
+            members = []
+            for member in source.infolist():
+                arcname = member.filename
+                if (arcname.endswith('/') or arcname in packaged or
+                        is_install_only_metadata(arcname) or
+                        matches_any(arcname, excludes)):
+                    continue
+                packaged.add(arcname)
+                members.append(member)
+            if reproducible:
+                members.sort(key=lambda member: member.filename)
+            copy_members(archive, source, members, reproducible=reproducible,
+                         budget=budget)
+        finally:
+            source.close()
+        copied += len(members)
+        copied_bytes += sum(member.compress_size for member in members)
+    add_metric('lambda.zip.streamed_wheels', len(wheels))
+    add_metric('lambda.zip.streamed_files', copied)
+    logger.info('Copied {0} files ({1} bytes) from {2} wheels into the '
+                'lambda-zip without recompressing.'.format(
+                    copied, copied_bytes, len(wheels)))
+
+
+def write_requirements_file(filename, dependencies):
+    directory = os.path.dirname(filename)
+    if directory and not os.path.isdir(directory):
+        os.makedirs(directory)
+    with open(filename, 'w') as requirements_file:
+        for dependency in dependencies:
+            requirements_file.write('{0}\n'.format(dependency))
+
+
+def canonical_requirement_name(requirement):
+    name = re.split(r'[<>=!~;\[\s(]', requirement.strip(), 1)[0]
+    return re.sub(r'[-_.]+', '-', name).lower()
+
+
+def find_failed_dependencies(dependencies, pip_output):
+    """Name the dependencies mentioned in the error lines of pip's output"""
+    mentioned = set()
+    for line in pip_output.splitlines():
+        for match in pip_error_pattern.finditer(line):
+            mentioned.add(canonical_requirement_name(match.group(1)))
+        if 'error' in line.lower():
+            for match in re.finditer(r'\(line (\d+)\)', line):
+                index = int(match.group(1)) - 1
+                if 0 <= index < len(dependencies):
+                    mentioned.add(
+                        canonical_requirement_name(dependencies[index]))
+    return [dependency for dependency in dependencies
+            if canonical_requirement_name(dependency) in mentioned]
+
+
+def install_dependencies_batch(logger, target_directory, index_url,
+                               dependencies):
+    """Install all dependencies with a single pip resolver run
+
+    The requirements file is private to this call, so builds sharing a
+    cache directory cannot overwrite each other's requirements.
+    """
+    if not dependencies:
+        return
+    handle, requirements_file = tempfile.mkstemp(
+            prefix='lambda_requirements-', suffix='.txt')
+    os.close(handle)
+    try:
+        write_requirements_file(requirements_file, dependencies)
+        cmd = 'pip install --target {0} {1} --requirement {2}'.format(
+                target_directory, index_url, requirements_file)
+        logger.debug("Installing {0} dependencies: '{1}'".format(
+                len(dependencies), cmd))
+
+        process = subprocess.Popen(cmd.split(), stdout=subprocess.PIPE,
+                                   stderr=subprocess.STDOUT)
+        output = process.communicate()[0]
+    finally:
+        os.remove(requirements_file)
+    if process.returncode != 0:
+        if isinstance(output, bytes):
+            output = output.decode('utf-8', 'replace')
+        failed = find_failed_dependencies(dependencies, output)
+        msg = "Command '{0}' failed to install dependencies {1}: {2}".format(
+                cmd, ', '.join(failed or dependencies), process.returncode)
+        raise Exception(msg)
+
+
 def get_path_to_zipfile(project):
     return os.path.join(
             project.expand_path('$dir_target'), '{0}.zip'.format(project.name))
 
 
+def get_path_to_manifest(path_to_zipfile):
+    return '{0}.manifest.json'.format(path_to_zipfile)
+
+
+def get_path_to_zip_baseline(project):
+    """Path of the lambda-zip the next incremental build starts from"""
+    cache_dir = project.get_property('lambda_cache_dir')
+    if cache_dir:
+        return os.path.join(os.path.expanduser(cache_dir), 'zips',
+                            '{0}.zip'.format(project.name))
+    return get_path_to_zipfile(project)
+
+
+def get_size_budget(project, name, file_size=0):
+    return SizeBudget(
+            name,
+            max_size=project.get_property('lambda_zip_max_size'),
+            max_compressed_size=project.get_property(
+                'lambda_zip_max_compressed_size'),
+            file_size=file_size)
+
+
+def get_uncompressed_size(path_to_zipfile):
+    archive = zipfile.ZipFile(path_to_zipfile)
+    try:
+        return sum(zinfo.file_size for zinfo in archive.infolist())
+    finally:
+        archive.close()
+
+
+def get_compression_policy(project):
+    return make_compression_policy(
+            levels=project.get_property('lambda_zip_compression_levels'),
+            store_incompressible=project.get_property(
+                'lambda_zip_store_incompressible'))
+
+
 def write_version(project, archive):
     """Get the current version and write it to a version file"""
     filename = os.path.join(project.expand_path('$dir_target'), 'VERSION')
     with open(filename, 'w') as version_file:
         version_file.write(project.version)
-    archive.write(filename, 'VERSION')
+    if project.get_property('lambda_zip_reproducible'):
+        zinfo = normalize_zip_info(zipfile.ZipInfo('VERSION'), 0o644)
+        zinfo.compress_type = zipfile.ZIP_DEFLATED
+        with open(filename, 'rb') as version_file:
+            archive.writestr(zinfo, version_file.read())
+    else:
+        archive.write(filename, 'VERSION')
+
+
+def write_zip_sha256(logger, project, path_to_zipfile):
+    """Write the SHA-256 of the lambda-zip next to it"""
+    sha256 = file_sha256(path_to_zipfile)
+    with open('{0}.sha256'.format(path_to_zipfile), 'w') as sha256_file:
+        sha256_file.write('{0}  {1}\n'.format(
+                sha256, os.path.basename(path_to_zipfile)))
+    logger.info('Lambda-zip SHA-256: {0}'.format(sha256))
+    tc_param = project.get_property('teamcity_sha256_parameter')
+    if project.get_property('teamcity_output') and tc_param:
+        teamcity_helper(tc_param, sha256)
+    return sha256
+
+
+def collect_own_files(project):
+    """List (path, arcname) of the modules and scripts of project"""
+    sources = project.expand_path('$dir_source_main_python')
+    own_files = collect_files(sources)
+    scripts = project.expand_path('$dir_source_main_scripts')
+    if os.path.exists(scripts) and os.path.isdir(scripts):
+        own_files.extend(collect_files(scripts))
+    return own_files
+
+
+def collect_dependency_files(logger, project, lambda_dependencies_dir,
+                             own_files):
+    """List (path, arcname) of the installed dependencies to package"""
+    dependency_files = []
+    if os.path.isdir(lambda_dependencies_dir):
+        dependency_files = collect_files(lambda_dependencies_dir)
+    if project.get_property('lambda_zip_slim'):
+        strip_directory = None
+        if project.get_property('lambda_zip_strip_binaries'):
+            strip_directory = os.path.join(
+                    project.expand_path('$dir_target'), 'lambda_stripped')
+        dependency_files = slim_dependencies(
+                logger, dependency_files, own_files,
+                project.get_property('lambda_zip_exclude_patterns',
+                                     DEFAULT_EXCLUDE_PATTERNS),
+                strip_directory=strip_directory,
+                workers=project.get_property(
+                    'lambda_zip_compression_workers'))
+    return dependency_files
+
+
+def collect_lambda_files(logger, project, lambda_dependencies_dir):
+    """List (path, arcname) of all files going into the lambda-zip"""
+    own_files = collect_own_files(project)
+    return collect_dependency_files(
+            logger, project, lambda_dependencies_dir, own_files) + own_files
+
+
+def get_handler_modules(project):
+    """The handler module(s), lambda_handler_module is a name or a list"""
+    handlers = project.get_mandatory_property('lambda_handler_module')
+    if isinstance(handlers, (list, tuple)):
+        return list(handlers)
+    return [handler.strip() for handler in handlers.split(',')]
+
+
+def prune_lambda_files(logger, project, files, path_to_layer=None):
+    """Drop the modules the handler module(s) can not import
+
+    Imports are followed through the modules of the layer zip path_to_layer.
+    """
+    handlers = get_handler_modules(project)
+    names = set(found[0] for found in map(module_name, (
+            arcname for _, arcname in files)) if found is not None)
+    missing = [handler for handler in handlers if handler not in names]
+    if missing:
+        raise BuildFailedException(
+                'Handler module(s) {0} not found in $dir_source_main_scripts '
+                'or $dir_source_main_python.'.format(', '.join(missing)))
+    layer_dir = None
+    context = []
+    if path_to_layer:
+        layer_dir = tempfile.mkdtemp(prefix='lambda-layer-')
+        extract_zipfile(path_to_layer, layer_dir)
+        if os.path.isdir(os.path.join(layer_dir, 'python')):
+            context = collect_files(os.path.join(layer_dir, 'python'))
+    try:
+        kept, dropped = prune_unreachable(
+                logger, files, handlers,
+                project.get_property('lambda_zip_keep_modules') or [],
+                context=context)
+    finally:
+        if layer_dir:
+            shutil.rmtree(layer_dir, ignore_errors=True)
+
+    reports_dir = os.path.join(project.expand_path('$dir_target'), 'reports')
+    if not os.path.isdir(reports_dir):
+        os.makedirs(reports_dir)
+    report = os.path.join(reports_dir, 'lambda_pruned_files.txt')
+    dropped_bytes = 0
+    with open(report, 'w') as report_file:
+        for path, arcname in sorted(dropped, key=lambda item: item[1]):
+            size = os.path.getsize(path)
+            dropped_bytes += size
+            report_file.write('{0:>10}  {1}\n'.format(size, arcname))
+    logger.info('Pruning unreachable modules dropped {0} of {1} files ({2} '
+                'bytes), see "{3}".'.format(len(dropped), len(files),
+                                            dropped_bytes, report))
+    return kept
+
+
+def get_layer_hash(logger, project, dependencies):
+    """Hash everything which influences the content of the layer zip
+
+    Without resolved versions every project version gets its own layer.
+    """
+    resolved = get_resolved_dependencies(logger, project, dependencies)
+    return hash_key(get_dependencies_cache_key(project, dependencies,
+                                               resolved),
+                    project.version if resolved is None else None,
+                    project.get_property('lambda_zip_slim'),
+                    project.get_property('lambda_zip_exclude_patterns'),
+                    project.get_property('lambda_zip_strip_binaries'),
+                    project.get_property('lambda_zip_compile_bytecode'),
+                    project.get_property('lambda_runtime_python'),
+                    project.get_property('lambda_zip_reproducible'))
+
+
+def get_path_to_layer_zipfile(logger, project):
+    """Path of the layer zip named by its hash, None without dependencies"""
+    dependencies = get_lambda_dependencies(
+            logger, project, excludes=RUNTIME_DEPENDENCIES)
+    if not dependencies:
+        return None
+    layer_hash = get_layer_hash(logger, project, dependencies)
+    return os.path.join(
+            project.expand_path('$dir_target'), '{0}-layer-{1}.zip'.format(
+                project.name, layer_hash[:16]))
+
+
+def build_layer(logger, project, path_to_layer):
+    """Install the dependencies and pack them below python/ into a zip"""
+    lambda_dependencies_dir = os.path.join(
+            project.expand_path('$dir_target'), 'lambda_dependencies')
+    logger.info('Going to prepare dependencies.')
+    prepare_dependencies_dir(logger, project, lambda_dependencies_dir,
+                             excludes=RUNTIME_DEPENDENCIES)
+    files = collect_dependency_files(
+            logger, project, lambda_dependencies_dir, [])
+    if project.get_property('lambda_zip_compile_bytecode'):
+        files.extend(compile_bytecode(logger, project, files))
+    files = [(path, os.path.join('python', arcname))
+             for path, arcname in files]
+    reproducible = project.get_property('lambda_zip_reproducible')
+    if reproducible:
+        files.sort(key=lambda item: item[1])
+    temporary = '{0}.tmp'.format(path_to_layer)
+    archive = zipfile.ZipFile(temporary, 'w', allowZip64=True)
+    try:
+        write_files(archive, files,
+                    workers=project.get_property(
+                        'lambda_zip_compression_workers'),
+                    reproducible=reproducible,
+                    policy=get_compression_policy(project),
+                    budget=get_size_budget(project, 'layer zip'))
+    except Exception:
+        archive.close()
+        os.remove(temporary)
+        raise
+    archive.close()
+    os.rename(temporary, path_to_layer)
+
+
+def package_layer(logger, project, path_to_layer):
+    """Build the layer zip, or take it from lambda_cache_dir"""
+    cache_dir = project.get_property('lambda_cache_dir')
+    if not cache_dir:
+        build_layer(logger, project, path_to_layer)
+        return
+    cache_dir = os.path.join(os.path.expanduser(cache_dir), 'layers')
+    with locked_cache_entry(
+            cache_dir, os.path.basename(path_to_layer)) as entry:
+        if os.path.isfile(entry):
+            logger.info('Using cached layer zip "{0}".'.format(entry))
+            add_metric('lambda.layer.cache_hits')
+        else:
+            build_layer(logger, project, path_to_layer)
+            temporary = '{0}.{1}.tmp'.format(entry, os.getpid())
+            shutil.copyfile(path_to_layer, temporary)
+            os.rename(temporary, entry)
+        if not os.path.isfile(path_to_layer):
+            if not os.path.isdir(os.path.dirname(path_to_layer)):
+                os.makedirs(os.path.dirname(path_to_layer))
+            shutil.copyfile(entry, path_to_layer)
+    evict_least_recently_used(
+            logger, cache_dir,
+            project.get_property('lambda_cache_max_entries'))
+
+
+def open_zip_baseline(project):
+    """Open the previous lambda-zip and its manifest for reuse"""
+    baseline = get_path_to_zip_baseline(project)
+    if not os.path.isfile(baseline):
+        return None, {}
+    with file_lock('{0}.lock'.format(baseline)):
+        try:
+            return (zipfile.ZipFile(baseline),
+                    read_manifest(get_path_to_manifest(baseline)))
+        except zipfile.BadZipfile:
+            return None, {}
+
+
+def save_zip_baseline(project, path_to_zipfile, manifest):
+    """Keep the lambda-zip and its manifest for the next build"""
+    baseline = get_path_to_zip_baseline(project)
+    if baseline == path_to_zipfile:
+        return
+    directory = os.path.dirname(baseline)
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    temporary = '{0}.{1}.tmp'.format(baseline, os.getpid())
+    shutil.copyfile(path_to_zipfile, temporary)
+    with file_lock('{0}.lock'.format(baseline)):
+        os.rename(temporary, baseline)
+        write_manifest(get_path_to_manifest(baseline), manifest)
+
+
+def write_lambda_files_incremental(logger, project, archive, files,
+                                   budget=None):
+    previous_archive, previous_manifest = open_zip_baseline(project)
+    try:
+        manifest, reused = write_files_incremental(
+                archive, files, previous_archive, previous_manifest,
+                workers=project.get_property(
+                    'lambda_zip_compression_workers'),
+                reproducible=project.get_property('lambda_zip_reproducible'),
+                policy=get_compression_policy(project),
+                budget=budget)
+    finally:
+        if previous_archive is not None:
+            previous_archive.close()
+    logger.info('Reused {0} of {1} compressed files from the previous '
+                'lambda-zip.'.format(reused, len(files)))
+    return manifest
+
+
+@task('fill_lambda_wheelhouse',
+      description='Download or build wheels of all dependencies into the '
+                  'wheelhouse for offline builds')
+def fill_lambda_wheelhouse(project, logger):
+    wheelhouse = get_wheelhouse_dir(project)
+    if not wheelhouse:
+        raise BuildFailedException(
+                'Set lambda_wheelhouse_dir to fill a wheelhouse.')
+    dependencies = get_lambda_dependencies(
+            logger, project, excludes=RUNTIME_DEPENDENCIES)
+    dir_target = project.expand_path('$dir_target')
+    if not os.path.isdir(dir_target):
+        os.makedirs(dir_target)
+    requirements_file = os.path.join(
+            dir_target, 'lambda_wheelhouse_requirements.txt')
+    write_requirements_file(requirements_file, dependencies)
+    index_url = project.get_property('install_dependencies_index_url')
+    logger.info('Going to fill wheelhouse "{0}" with {1} dependencies.'.format(
+            wheelhouse, len(dependencies)))
+    with measure('lambda.wheelhouse.seconds'):
+        fill_wheelhouse(logger, wheelhouse, requirements_file,
+                        ['--index-url', index_url] if index_url else [])
+        prune_wheelhouse(logger, wheelhouse, requirements_file)
+    publish_metrics(logger, project)
 
 
 @task('package_lambda_code',
@@ -80,23 +732,164 @@ def write_version(project, archive):
 def package_lambda_code(project, logger):
     dir_target = project.expand_path('$dir_target')
     lambda_dependencies_dir = os.path.join(dir_target, 'lambda_dependencies')
-    excludes = ['boto', 'boto3']
-    logger.info('Going to prepare dependencies.')
-    prepare_dependencies_dir(
-            logger, project, lambda_dependencies_dir, excludes=excludes)
-    logger.info('Going to assemble the lambda-zip.')
+    wheels = []
+    budget = get_size_budget(project, 'lambda-zip')
+    path_to_layer = None
+    if project.get_property('lambda_layer'):
+        path_to_layer = get_path_to_layer_zipfile(logger, project)
+        if path_to_layer:
+            package_layer(logger, project, path_to_layer)
+            logger.info('Layer zip is available at: "{0}".'.format(
+                    path_to_layer))
+            budget = get_size_budget(
+                    project, 'lambda-zip with its layer',
+                    file_size=get_uncompressed_size(path_to_layer))
+        logger.info('Going to assemble the lambda-zip.')
+        files = collect_own_files(project)
+    elif use_streamed_wheels(logger, project):
+        logger.info('Going to prepare dependencies.')
+        dependencies_dir = os.path.join(dir_target,
+                                        'lambda_dependency_wheels')
+        prepare_dependencies_dir(logger, project, dependencies_dir,
+                                 excludes=RUNTIME_DEPENDENCIES,
+                                 install=install_dependency_wheels,
+                                 cache_name='dependency_wheels')
+        logger.info('Going to assemble the lambda-zip.')
+        files = collect_lambda_files(
+                logger, project, os.path.join(dependencies_dir, 'installed'))
+        wheels = list_streamed_wheels(dependencies_dir)
+    else:
+        logger.info('Going to prepare dependencies.')
+        prepare_dependencies_dir(logger, project, lambda_dependencies_dir,
+                                 excludes=RUNTIME_DEPENDENCIES)
+        logger.info('Going to assemble the lambda-zip.')
+        files = collect_lambda_files(
+                logger, project, lambda_dependencies_dir)
     path_to_zipfile = get_path_to_zipfile(project)
-    archive = zipfile.ZipFile(path_to_zipfile, 'w')
-    if os.path.isdir(lambda_dependencies_dir):
-        zip_recursive(archive, lambda_dependencies_dir)
-    sources = project.expand_path('$dir_source_main_python')
-    zip_recursive(archive, sources)
-    scripts = project.expand_path('$dir_source_main_scripts')
-    if os.path.exists(scripts) and os.path.isdir(scripts):
-        zip_recursive(archive, scripts)
-    write_version(project, archive)
-    archive.close()
+    if project.get_property('lambda_zip_prune_imports'):
+        files = prune_lambda_files(logger, project, files, path_to_layer)
+    if project.get_property('lambda_zip_compile_bytecode'):
+        with measure('lambda.bytecode.seconds'):
+            files.extend(compile_bytecode(logger, project, files))
+    reproducible = project.get_property('lambda_zip_reproducible')
+    if reproducible:
+        files.sort(key=lambda item: item[1])
+    incremental = project.get_property('lambda_zip_incremental')
+    manifest = None
+    cpu_seconds = get_metrics().get('lambda.zip.compress_cpu_seconds', 0)
+    path_to_written = path_to_zipfile
+    if incremental:
+        path_to_written = '{0}.tmp'.format(path_to_zipfile)
+    with measure('lambda.zip.seconds'):
+        archive = zipfile.ZipFile(path_to_written, 'w', allowZip64=True)
+        try:
+            if incremental:
+                manifest = write_lambda_files_incremental(
+                        logger, project, archive, files, budget=budget)
+            else:
+                write_files(archive, files,
+                            workers=project.get_property(
+                                'lambda_zip_compression_workers'),
+                            reproducible=reproducible,
+                            policy=get_compression_policy(project),
+                            budget=budget)
+            if wheels:
+                write_streamed_wheels(logger, project, archive, wheels,
+                                      files, budget=budget)
+            write_version(project, archive)
+        except Exception:
+            archive.close()
+            os.remove(path_to_written)
+            raise
+        archive.close()
+    add_zip_metrics(archive)
+    log_size(logger, budget)
+    log_compression(logger, archive, get_metrics().get(
+            'lambda.zip.compress_cpu_seconds', 0) - cpu_seconds)
+    if incremental:
+        os.rename('{0}.tmp'.format(path_to_zipfile), path_to_zipfile)
+        write_manifest(get_path_to_manifest(path_to_zipfile), manifest)
+        save_zip_baseline(project, path_to_zipfile, manifest)
     logger.info('Lambda-zip is available at: "{0}".'.format(path_to_zipfile))
+    write_zip_sha256(logger, project, path_to_zipfile)
+    publish_metrics(logger, project)
+
+
+def add_zip_metrics(archive):
+    """Count the members and bytes of the written archive"""
+    members = archive.infolist()
+    add_metric('lambda.zip.files', len(members))
+    add_metric('lambda.zip.bytes', sum(zinfo.file_size for zinfo in members))
+    add_metric('lambda.zip.compressed_bytes',
+               sum(zinfo.compress_size for zinfo in members))
+
+
+def log_size(logger, budget):
+    if budget.max_size:
+        logger.info('The {0} takes {1} bytes unzipped, {2:.1f}% of the '
+                    'limit of {3} bytes.'.format(
+                        budget.name, budget.file_size,
+                        100.0 * budget.file_size / budget.max_size,
+                        budget.max_size))
+
+
+def log_compression(logger, archive, cpu_seconds):
+    """Log the CPU time spent compressing against the bytes it saved"""
+    members = archive.infolist()
+    stored = [zinfo for zinfo in members
+              if zinfo.compress_type == zipfile.ZIP_STORED]
+    saved = sum(zinfo.file_size - zinfo.compress_size for zinfo in members)
+    add_metric('lambda.zip.stored_files', len(stored))
+    logger.info('Compression took {0:.2f}s of CPU time and saved {1} bytes, '
+                '{2} of {3} files ({4} bytes) are stored uncompressed.'.format(
+                    cpu_seconds, saved, len(stored), len(members),
+                    sum(zinfo.file_size for zinfo in stored)))
+
+
+@task('profile_lambda_imports',
+      description='Profile the imports of the lambda handler from the '
+                  'lambda-zip')
+@depends('package_lambda_code')
+def profile_lambda_imports(project, logger):
+    handler = ','.join(get_handler_modules(project))
+    path_to_zipfile = get_path_to_zipfile(project)
+    path_to_layer = None
+    if project.get_property('lambda_layer'):
+        path_to_layer = get_path_to_layer_zipfile(logger, project)
+    logger.info('Going to profile the imports of {0} from "{1}".'.format(
+            handler, path_to_zipfile))
+    result = profile_imports(
+            get_bytecode_interpreter(project), path_to_zipfile, handler,
+            project.get_property('lambda_import_profile_paths') or [],
+            path_to_layer=path_to_layer)
+    if result['error']:
+        raise BuildFailedException('Importing {0} failed: {1}'.format(
+                handler, result['error']))
+
+    reports_dir = os.path.join(project.expand_path('$dir_target'), 'reports')
+    if not os.path.isdir(reports_dir):
+        os.makedirs(reports_dir)
+    report = os.path.join(reports_dir, 'lambda_import_profile')
+    with open('{0}.json'.format(report), 'w') as report_file:
+        json.dump(result, report_file, indent=1, sort_keys=True)
+    text = format_import_profile(result)
+    with open('{0}.txt'.format(report), 'w') as report_file:
+        report_file.write(text)
+    logged_lines = PROFILE_HEADER_LINES + LOGGED_PROFILE_MODULES
+    for line in text.splitlines()[:logged_lines]:
+        logger.info(line)
+    logger.info('Import profile written to "{0}.json" and "{0}.txt".'.format(
+            report))
+
+    budget = project.get_property('lambda_import_time_budget_ms')
+    if budget and result['total_ms'] > budget:
+        slowest = ', '.join('{0} ({1:.1f} ms)'.format(
+                record['module'], record['self_ms'])
+                for record in result['modules'][:5])
+        raise BuildFailedException(
+                'Importing {0} took {1:.1f} ms, more than the budget of {2} '
+                'ms. Slowest modules: {3}'.format(
+                    handler, result['total_ms'], budget, slowest))
 
 
 @task('upload_zip_to_s3', description='Upload a packaged lambda-zip to S3')
@@ -104,21 +897,51 @@ def package_lambda_code(project, logger):
 def upload_zip_to_s3(project, logger):
     path_to_zipfile = get_path_to_zipfile(project)
     logger.info('Found lambda-zip at: "{0}".'.format(path_to_zipfile))
-    with open(path_to_zipfile, 'rb') as fp:
-        data = fp.read()
     bucket_prefix = project.get_property('bucket_prefix')
     bucket_name = project.get_mandatory_property('bucket_name')
     keyname_version = '{0}v{1}/{2}.zip'.format(
             bucket_prefix, project.version, project.name)
     acl = project.get_property('lambda_file_access_control')
     check_acl_parameter_validity('lambda_file_access_control', acl)
-    upload_helper(logger, bucket_name, keyname_version, data, acl)
+    upload_file_helper(
+            logger, bucket_name, keyname_version, path_to_zipfile, acl,
+            skip_unchanged=project.get_property('skip_unchanged_uploads'),
+            transfer_config=get_transfer_config(project),
+            storage=get_storage(logger, project))
     tc_param = project.get_property('teamcity_parameter')
     if project.get_property("teamcity_output") and tc_param:
         teamcity_helper(tc_param, keyname_version)
+    if project.get_property('lambda_layer'):
+        upload_layer_to_s3(logger, project, bucket_name, acl)
+    publish_metrics(logger, project)
 
-@task('lambda_release', description='Copy lambda zip file from versioned path to latest path in S3')
-def lambda_release(project,logger):
+
+def upload_layer_to_s3(logger, project, bucket_name, acl):
+    """Upload the layer zip unless a layer with its hash is in the bucket"""
+    path_to_layer = get_path_to_layer_zipfile(logger, project)
+    if path_to_layer is None:
+        logger.info('No dependencies, there is no layer zip to upload.')
+        return
+    if not os.path.isfile(path_to_layer):
+        raise BuildFailedException(
+                'Layer zip "{0}" not found, run package_lambda_code '
+                'first.'.format(path_to_layer))
+    keyname = '{0}layers/{1}'.format(project.get_property('bucket_prefix'),
+                                     os.path.basename(path_to_layer))
+    storage = get_storage(logger, project)
+    if object_exists(logger, bucket_name, keyname, storage=storage):
+        logger.info('Layer zip is already in bucket "{0}" as {1}.'.format(
+                bucket_name, keyname))
+    else:
+        upload_file_helper(
+                logger, bucket_name, keyname, path_to_layer, acl,
+                transfer_config=get_transfer_config(project), storage=storage)
+    tc_param = project.get_property('teamcity_layer_parameter')
+    if project.get_property('teamcity_output') and tc_param:
+        teamcity_helper(tc_param, keyname)
+
+def get_lambda_release_plan(project):
+    """The copy of the lambda-zip from the versioned to the latest path"""
     bucket_prefix = project.get_property('bucket_prefix')
     bucket_name = project.get_mandatory_property('bucket_name')
     acl = project.get_property('lambda_file_access_control')
@@ -126,5 +949,12 @@ def lambda_release(project,logger):
 
     source_key = '{0}v{1}/{2}.zip'.format(bucket_prefix, project.version, project.name)
     destination_key = '{0}latest/{1}.zip'.format(bucket_prefix, project.name)
-    copy_helper(logger, bucket_name, source_key, destination_key, acl)
+    return [(bucket_name, source_key, destination_key, acl)]
 
+
+@task('lambda_release', description='Copy lambda zip file from versioned path to latest path in S3')
+def lambda_release(project, logger):
+    release_helper(logger, get_lambda_release_plan(project),
+                   concurrency=project.get_property('release_concurrency'),
+                   storage=get_storage(logger, project))
+    publish_metrics(logger, project)
@@ -0,0 +1,54 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import contextlib
+import threading
+import time
+
+# Timings and counters of all tasks of a build, by metric name
+_metrics = {}
+_metrics_lock = threading.Lock()
+# Values of the metrics when get_unpublished_metrics returned them last
+_published = {}
+
+
+def add_metric(name, value=1):
+    """Add value to the counter or total duration name"""
+    with _metrics_lock:
+        _metrics[name] = _metrics.get(name, 0) + value
+
+
+def max_metric(name, value):
+    """Keep the largest value reported for name"""
+    with _metrics_lock:
+        _metrics[name] = max(_metrics.get(name, value), value)
+
+
+@contextlib.contextmanager
+def measure(name):
+    """Add the duration of the block to name in seconds"""
+    start = time.time()
+    try:
+        yield
+    finally:
+        add_metric(name, time.time() - start)
+
+
+def get_metrics():
+    with _metrics_lock:
+        return dict(_metrics)
+
+
+def get_unpublished_metrics():
+    """The metrics which changed since the last call"""
+    with _metrics_lock:
+        changed = dict((name, value) for name, value in _metrics.items()
+                       if _published.get(name) != value)
+        _published.update(changed)
+        return changed
+
+
+def reset_metrics():
+    with _metrics_lock:
+        _metrics.clear()
+        _published.clear()
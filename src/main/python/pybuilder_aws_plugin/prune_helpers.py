@@ -0,0 +1,127 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import fnmatch
+import os
+import subprocess
+from multiprocessing.pool import ThreadPool
+
+# Patterns match the path inside the lambda-zip or any trailing part of it,
+# patterns starting with / only match from the top of the lambda-zip
+DEFAULT_EXCLUDE_PATTERNS = [
+    '__pycache__/*',
+    '*.pyc',
+    '*.pyo',
+    # Metadata only describing the installation, the rest is read at runtime
+    # by importlib.metadata and pkg_resources, e.g. versions and entry points
+    '*.dist-info/RECORD',
+    '*.dist-info/RECORD.jws',
+    '*.dist-info/RECORD.p7s',
+    '*.dist-info/INSTALLER',
+    '*.dist-info/REQUESTED',
+    '*.dist-info/direct_url.json',
+    '*.egg-info/SOURCES.txt',
+    '*.egg-info/installed-files.txt',
+    # Only top level directories, packages like numpy need include at runtime
+    '/tests/*',
+    '/test/*',
+    '/docs/*',
+    '/doc/*',
+    '/include/*',
+    '*.h',
+    '*.hpp',
+    '*.c',
+    '*.pyx',
+    '*.pxd',
+]
+
+
+def matches_any(arcname, patterns):
+    arcname = arcname.replace(os.sep, '/')
+    for pattern in patterns:
+        if pattern.startswith('/'):
+            if fnmatch.fnmatch(arcname, pattern[1:]):
+                return True
+        elif (fnmatch.fnmatch(arcname, pattern) or
+                fnmatch.fnmatch(arcname, '*/' + pattern)):
+            return True
+    return False
+
+
+def strip_binary(item):
+    """Strip the symbols of the shared library of item into a copy
+
+    item is (path, arcname, stripped_path). Returns the path to use.
+    """
+    path, arcname, stripped_path = item
+    directory = os.path.dirname(stripped_path)
+    if not os.path.isdir(directory):
+        try:
+            os.makedirs(directory)
+        except OSError:
+            pass
+    try:
+        process = subprocess.Popen(
+                ['strip', '--strip-unneeded', '-o', stripped_path, path],
+                stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        process.communicate()
+    except OSError:
+        return path
+    if process.returncode != 0 or not os.path.isfile(stripped_path):
+        return path
+    return stripped_path
+
+
+def slim_dependencies(logger, dependency_files, own_files, patterns,
+                      strip_directory=None, workers=1):
+    """Drop dead weight from the (path, arcname) list dependency_files
+
+    Files matching patterns and files which also exist in own_files are
+    removed. If strip_directory is given, shared libraries are replaced by
+    copies without symbols written below it. Returns the remaining files.
+    """
+    own_arcnames = set(arcname for _, arcname in own_files)
+    excluded_bytes = 0
+    duplicate_bytes = 0
+    remaining = []
+    for path, arcname in dependency_files:
+        if arcname in own_arcnames:
+            logger.warn('Dependency file {0} is shadowed by a project file '
+                        'with the same name, not packaging it.'.format(
+                            arcname))
+            duplicate_bytes += os.path.getsize(path)
+        elif matches_any(arcname, patterns):
+            excluded_bytes += os.path.getsize(path)
+        else:
+            remaining.append((path, arcname))
+
+    stripped_bytes = 0
+    if strip_directory:
+        binaries = [(path, arcname, os.path.join(strip_directory, arcname))
+                    for path, arcname in remaining
+                    if fnmatch.fnmatch(arcname, '*.so') or
+                    fnmatch.fnmatch(arcname, '*.so.*')]
+        pool = ThreadPool(max(1, workers or 1))
+        try:
+            stripped = dict(
+                (arcname, result) for (_, arcname, _), result in
+                zip(binaries, pool.map(strip_binary, binaries)))
+        finally:
+            pool.close()
+            pool.join()
+        slimmed = []
+        for path, arcname in remaining:
+            if arcname in stripped:
+                stripped_bytes += (os.path.getsize(path) -
+                                   os.path.getsize(stripped[arcname]))
+                path = stripped[arcname]
+            slimmed.append((path, arcname))
+        remaining = slimmed
+
+    logger.info(
+            'Slimming the dependencies saved {0} bytes: {1} bytes of '
+            'excluded files, {2} bytes of duplicates, {3} bytes of '
+            'symbols.'.format(excluded_bytes + duplicate_bytes +
+                              stripped_bytes, excluded_bytes,
+                              duplicate_bytes, stripped_bytes))
+    return remaining
@@ -0,0 +1,122 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import random
+import time
+
+from botocore.exceptions import ConnectionError, HTTPClientError
+
+from .metrics_helpers import add_metric
+
+DEFAULT_MAX_ATTEMPTS = 8
+# Seconds after the first attempt of a call, in which it may be retried
+DEFAULT_RETRY_DEADLINE = 300
+RETRY_BASE_DELAY = 0.5
+MAX_RETRY_DELAY = 20
+
+THROTTLING_ERROR_CODES = frozenset([
+    'SlowDown',
+    'Throttling',
+    'ThrottlingException',
+    'ThrottledException',
+    'RequestThrottled',
+    'RequestThrottledException',
+    'RequestLimitExceeded',
+    'TooManyRequestsException',
+    'ProvisionedThroughputExceededException',
+])
+TRANSIENT_ERROR_CODES = frozenset([
+    'RequestTimeout',
+    'RequestTimeoutException',
+    'InternalError',
+    'ServiceUnavailable',
+])
+TRANSIENT_STATUS_CODES = frozenset([500, 502, 503, 504])
+
+# unique_id of the needs-retry handler botocore registers for S3
+_BOTOCORE_RETRY_HANDLER_ID = 'retry-config-s3'
+_CONTEXT_START_KEY = 'pybuilder_aws_plugin_start'
+
+
+def classify_response(response, caught_exception):
+    """Why a call may be retried: 'throttling', 'transient' or None"""
+    if caught_exception is not None:
+        if isinstance(caught_exception, (ConnectionError, HTTPClientError)):
+            return 'transient'
+        return None
+    if response is None:
+        return None
+    http_response, parsed = response
+    code = parsed.get('Error', {}).get('Code')
+    if code in THROTTLING_ERROR_CODES or http_response.status_code == 429:
+        return 'throttling'
+    if (code in TRANSIENT_ERROR_CODES or
+            http_response.status_code in TRANSIENT_STATUS_CODES):
+        return 'transient'
+    return None
+
+
+def backoff_delay(attempts):
+    """Exponential backoff with full jitter after attempts failed attempts"""
+    return random.uniform(
+            0, min(MAX_RETRY_DELAY, RETRY_BASE_DELAY * 2 ** (attempts - 1)))
+
+
+def describe_failure(response, caught_exception):
+    if caught_exception is not None:
+        return '"{0}"'.format(caught_exception)
+    http_response, parsed = response
+    return '{0} {1}'.format(http_response.status_code,
+                            parsed.get('Error', {}).get('Code', ''))
+
+
+def record_call_start(context, **kwargs):
+    context[_CONTEXT_START_KEY] = time.time()
+
+
+def make_retry_handler(logger, max_attempts=DEFAULT_MAX_ATTEMPTS,
+                       deadline=DEFAULT_RETRY_DEADLINE):
+    """Create a botocore needs-retry handler
+
+    It returns the seconds to wait before the next attempt, or None if the
+    call should not be retried.
+    """
+    def needs_retry(attempts, operation, request_dict, response=None,
+                    caught_exception=None, **kwargs):
+        reason = classify_response(response, caught_exception)
+        if reason is None:
+            return None
+        if reason == 'throttling':
+            add_metric('s3.throttled')
+        delay = backoff_delay(attempts)
+        start = request_dict.get('context', {}).get(_CONTEXT_START_KEY)
+        elapsed = time.time() - start if start else 0
+        if attempts >= max_attempts or elapsed + delay > deadline:
+            logger.warn('Giving up {0} after {1} attempts in {2:.1f}s.'.format(
+                    operation.name, attempts, elapsed))
+            add_metric('s3.retries_exhausted')
+            return None
+        add_metric('s3.retries')
+        add_metric('s3.retry_backoff_seconds', delay)
+        logger.warn('Retrying {0} in {1:.2f}s after {2} error {3} '
+                    '(attempt {4} of {5}).'.format(
+                        operation.name, delay, reason,
+                        describe_failure(response, caught_exception),
+                        attempts, max_attempts))
+        return delay
+    return needs_retry
+
+
+def register_retry_handler(client, logger, max_attempts=DEFAULT_MAX_ATTEMPTS,
+                           deadline=DEFAULT_RETRY_DEADLINE):
+    """Replace the retry decisions of botocore for client
+
+    The client should use the adaptive retry mode, so botocore keeps
+    limiting the request rate once S3 starts throttling.
+    """
+    events = client.meta.events
+    events.register('before-call.s3', record_call_start)
+    events.unregister('needs-retry.s3', unique_id=_BOTOCORE_RETRY_HANDLER_ID)
+    events.register('needs-retry.s3',
+                    make_retry_handler(logger, max_attempts, deadline),
+                    unique_id=_BOTOCORE_RETRY_HANDLER_ID)
@@ -0,0 +1,188 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import io
+import json
+import os
+import shutil
+import tempfile
+
+from boto3.s3.transfer import TransferConfig
+from botocore.exceptions import ClientError
+
+BUFFER_SIZE = 1024 * 1024
+# Directory of a LocalStorage root holding the ACL and metadata of objects
+LOCAL_METADATA_DIR = '.metadata'
+
+
+def storage_error(code, message, operation_name):
+    """A ClientError like the ones S3 raises, for backends other than S3"""
+    return ClientError({'Error': {'Code': code, 'Message': message}},
+                       operation_name)
+
+
+def is_not_found(error):
+    return error.response.get('Error', {}).get('Code') in (
+            '404', 'NoSuchKey')
+
+
+class S3Storage(object):
+    """Objects in S3 buckets, accessed through a boto3 client
+
+    Storage backends provide put, head, copy, set_acl and list with the
+    semantics of S3. Failures raise botocore's ClientError.
+    """
+
+    def __init__(self, client):
+        self.client = client
+
+    def put(self, bucket_name, keyname, fileobj, acl, metadata,
+            transfer_config=None):
+        """Upload the seekable binary file object fileobj"""
+        self.client.upload_fileobj(
+                fileobj, bucket_name, keyname,
+                ExtraArgs={'ACL': acl, 'Metadata': metadata},
+                Config=transfer_config or TransferConfig())
+
+    def head(self, bucket_name, keyname):
+        """Return the metadata of an object, None if it does not exist"""
+        try:
+            response = self.client.head_object(
+                    Bucket=bucket_name, Key=keyname)
+        except ClientError as e:
+            if is_not_found(e):
+                return None
+            raise
+        return response.get('Metadata', {})
+
+    def copy(self, bucket_name, source_key, destination_key, acl):
+        """Copy an object with its metadata, applying acl to the copy"""
+        self.client.copy_object(ACL=acl,
+                                Bucket=bucket_name,
+                                CopySource={'Bucket': bucket_name,
+                                            'Key': source_key},
+                                Key=destination_key,
+                                MetadataDirective='COPY')
+
+    def set_acl(self, bucket_name, keyname, acl):
+        """Apply the canned acl to an existing object"""
+        self.client.put_object_acl(ACL=acl, Bucket=bucket_name, Key=keyname)
+
+    def list(self, bucket_name, prefix=''):
+        """Return the sorted keys in bucket_name starting with prefix"""
+        keys = []
+        paginator = self.client.get_paginator('list_objects_v2')
+        for page in paginator.paginate(Bucket=bucket_name, Prefix=prefix):
+            keys.extend(item['Key'] for item in page.get('Contents', []))
+        return keys
+
+
+class LocalStorage(object):
+    """Objects in a local directory, one sub-directory per bucket
+
+    The object bucket/key is stored as root/bucket/key, its ACL and metadata
+    as JSON in root/.metadata/bucket/key. Buckets have to exist, like in S3.
+    """
+
+    def __init__(self, root):
+        self.root = root
+
+    def object_path(self, bucket_name, keyname, operation_name):
+        bucket_dir = os.path.join(self.root, bucket_name)
+        if not os.path.isdir(bucket_dir):
+            raise storage_error(
+                    'NoSuchBucket', 'The specified bucket does not exist',
+                    operation_name)
+        parts = keyname.split('/')
+        if not keyname or '..' in parts or '' in parts[:-1]:
+            raise storage_error(
+                    'InvalidKey', 'Key {0} cannot be stored locally'.format(
+                        keyname), operation_name)
+        return os.path.join(bucket_dir, *parts)
+
+    def metadata_path(self, bucket_name, keyname):
+        return os.path.join(self.root, LOCAL_METADATA_DIR, bucket_name,
+                            *keyname.split('/'))
+
+    def write(self, filename, fileobj):
+        """Replace filename atomically with the contents of fileobj"""
+        directory = os.path.dirname(filename)
+        if not os.path.isdir(directory):
+            try:
+                os.makedirs(directory)
+            except OSError:
+                pass
+        handle, temporary = tempfile.mkstemp(dir=directory, prefix='.tmp-')
+        try:
+            with os.fdopen(handle, 'wb') as output:
+                shutil.copyfileobj(fileobj, output, BUFFER_SIZE)
+            os.rename(temporary, filename)
+        except Exception:
+            os.remove(temporary)
+            raise
+
+    def write_metadata(self, bucket_name, keyname, acl, metadata):
+        data = json.dumps({'ACL': acl, 'Metadata': metadata},
+                          sort_keys=True).encode('utf-8')
+        self.write(self.metadata_path(bucket_name, keyname),
+                   io.BytesIO(data))
+
+    def read_metadata(self, bucket_name, keyname):
+        """Return the ACL and metadata of an object as a dict"""
+        with open(self.metadata_path(bucket_name, keyname)) as fp:
+            return json.load(fp)
+
+    def put(self, bucket_name, keyname, fileobj, acl, metadata,
+            transfer_config=None):
+        path = self.object_path(bucket_name, keyname, 'PutObject')
+        self.write(path, fileobj)
+        self.write_metadata(bucket_name, keyname, acl, metadata)
+
+    def head(self, bucket_name, keyname):
+        # S3 answers HEAD requests for a missing bucket with a plain 404
+        if not os.path.isdir(os.path.join(self.root, bucket_name)):
+            return None
+        path = self.object_path(bucket_name, keyname, 'HeadObject')
+        if not os.path.isfile(path):
+            return None
+        return self.read_metadata(bucket_name, keyname)['Metadata']
+
+    def copy(self, bucket_name, source_key, destination_key, acl):
+        source = self.object_path(bucket_name, source_key, 'CopyObject')
+        destination = self.object_path(
+                bucket_name, destination_key, 'CopyObject')
+        if not os.path.isfile(source):
+            raise storage_error(
+                    'NoSuchKey', 'The specified key does not exist.',
+                    'CopyObject')
+        metadata = self.read_metadata(bucket_name, source_key)['Metadata']
+        with open(source, 'rb') as fileobj:
+            self.write(destination, fileobj)
+        self.write_metadata(bucket_name, destination_key, acl, metadata)
+
+    def set_acl(self, bucket_name, keyname, acl):
+        path = self.object_path(bucket_name, keyname, 'PutObjectAcl')
+        if not os.path.isfile(path):
+            raise storage_error(
+                    'NoSuchKey', 'The specified key does not exist.',
+                    'PutObjectAcl')
+        metadata = self.read_metadata(bucket_name, keyname)['Metadata']
+        self.write_metadata(bucket_name, keyname, acl, metadata)
+
+    def list(self, bucket_name, prefix=''):
+        bucket_dir = os.path.join(self.root, bucket_name)
+        if not os.path.isdir(bucket_dir):
+            raise storage_error(
+                    'NoSuchBucket', 'The specified bucket does not exist',
+                    'ListObjectsV2')
+        keys = []
+        for root, _, filenames in os.walk(bucket_dir):
+            for filename in filenames:
+                if filename.startswith('.tmp-'):
+                    continue
+                keyname = os.path.relpath(
+                        os.path.join(root, filename),
+                        bucket_dir).replace(os.sep, '/')
+                if keyname.startswith(prefix):
+                    keys.append(keyname)
+        return sorted(keys)
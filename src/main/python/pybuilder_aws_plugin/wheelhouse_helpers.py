@@ -0,0 +1,174 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import json
+import os
+import re
+import subprocess
+import tempfile
+import zipfile
+
+try:
+    from urllib.parse import unquote
+except ImportError:
+    from urllib import unquote
+
+from pybuilder.errors import BuildFailedException
+
+# Files pip writes into the dist-info directory when installing, or which
+# only describe the installation
+INSTALL_ONLY_METADATA = frozenset(['RECORD', 'RECORD.jws', 'RECORD.p7s',
+                                   'INSTALLER', 'REQUESTED',
+                                   'direct_url.json'])
+
+# name==version, optionally with extras and environment markers
+pinned_requirement_pattern = re.compile(
+        r'^\s*([A-Za-z0-9][A-Za-z0-9._-]*)\s*(?:\[[^\]]*\])?\s*==\s*'
+        r'([^\s;,*=][^\s;,*]*)\s*(?:;.*)?$')
+
+
+def canonical_name(name):
+    return re.sub(r'[-_.]+', '-', name).lower()
+
+
+def normalize_version(version):
+    """Make 1.0 and 1.0.0 compare equal"""
+    version = version.lower()
+    while version.endswith('.0') and version.count('.') > 0:
+        version = version[:-len('.0')]
+    return version
+
+
+def wheel_name_and_version(filename):
+    """Canonical name and version of a wheel file, None for other files"""
+    if not filename.endswith('.whl'):
+        return None
+    parts = filename[:-len('.whl')].split('-')
+    if len(parts) not in (5, 6):
+        return None
+    return canonical_name(parts[0]), normalize_version(parts[1])
+
+
+def list_wheels(wheelhouse):
+    if not os.path.isdir(wheelhouse):
+        return []
+    return sorted(filename for filename in os.listdir(wheelhouse)
+                  if wheel_name_and_version(filename) is not None)
+
+
+def find_missing_pinned_wheels(wheelhouse, dependencies):
+    """The pinned dependencies without a matching wheel in wheelhouse"""
+    available = set(wheel_name_and_version(filename)
+                    for filename in list_wheels(wheelhouse))
+    missing = []
+    for dependency in dependencies:
+        match = pinned_requirement_pattern.match(dependency)
+        if match is None:
+            continue
+        name, version = match.groups()
+        if (canonical_name(name), normalize_version(version)) not in available:
+            missing.append(dependency)
+    return missing
+
+
+def run_pip(logger, arguments):
+    cmd = ['pip'] + arguments
+    logger.debug("Running '{0}'".format(' '.join(cmd)))
+    process = subprocess.Popen(cmd, stdout=subprocess.PIPE,
+                               stderr=subprocess.STDOUT)
+    output = process.communicate()[0]
+    if isinstance(output, bytes):
+        output = output.decode('utf-8', 'replace')
+    if process.returncode != 0:
+        raise BuildFailedException("Command '{0}' failed: {1}\n{2}".format(
+                ' '.join(cmd), process.returncode, output))
+    return output
+
+
+def fill_wheelhouse(logger, wheelhouse, requirements_file, index_options):
+    """Build or download wheels of all requirements into wheelhouse
+
+    Wheels already in the wheelhouse are reused, sdists are built to wheels.
+    """
+    if not os.path.isdir(wheelhouse):
+        os.makedirs(wheelhouse)
+    run_pip(logger, ['wheel', '--wheel-dir', wheelhouse,
+                     '--find-links', wheelhouse] + index_options +
+            ['--requirement', requirements_file])
+
+
+def read_install_report(logger, arguments):
+    """The packages pip install with arguments would install, as reported"""
+    handle, report = tempfile.mkstemp(suffix='.json')
+    os.close(handle)
+    try:
+        run_pip(logger, ['install', '--dry-run', '--ignore-installed',
+                         '--report', report] + arguments)
+        with open(report) as report_file:
+            return json.load(report_file).get('install', [])
+    finally:
+        os.remove(report)
+
+
+def referenced_wheels(logger, wheelhouse, requirements_file):
+    """The wheels an offline install of the requirements would use"""
+    installs = read_install_report(
+            logger, ['--no-index', '--find-links', wheelhouse,
+                     '--requirement', requirements_file])
+    return set(unquote(os.path.basename(item['download_info']['url']))
+               for item in installs)
+
+
+def resolve_requirements(logger, requirements_file, index_options):
+    """Pin every package an install of the requirements would use"""
+    installs = read_install_report(
+            logger, index_options + ['--requirement', requirements_file])
+    return sorted('{0}=={1}'.format(canonical_name(item['metadata']['name']),
+                                    item['metadata']['version'])
+                  for item in installs)
+
+
+def prune_wheelhouse(logger, wheelhouse, requirements_file):
+    """Remove the wheels the requirements do not reference any more"""
+    referenced = referenced_wheels(logger, wheelhouse, requirements_file)
+    removed = 0
+    removed_bytes = 0
+    for filename in list_wheels(wheelhouse):
+        if filename in referenced:
+            continue
+        path = os.path.join(wheelhouse, filename)
+        removed_bytes += os.path.getsize(path)
+        os.remove(path)
+        removed += 1
+        logger.debug('Removed unreferenced wheel {0}.'.format(filename))
+    logger.info('Wheelhouse "{0}" holds {1} wheels, removed {2} unreferenced '
+                'wheels ({3} bytes).'.format(wheelhouse, len(referenced),
+                                             removed, removed_bytes))
+
+
+def is_install_only_metadata(arcname):
+    directory, _, filename = arcname.rpartition('/')
+    return (directory.endswith('.dist-info') and '/' not in directory and
+            filename in INSTALL_ONLY_METADATA)
+
+
+def is_pure_wheel(path):
+    """Whether the wheel at path unpacks as it is, without pip
+
+    That is a wheel of pure Python code without a .data directory, whose
+    scripts, headers or data files pip would have to move into place.
+    """
+    if wheel_name_and_version(os.path.basename(path)) is None:
+        return False
+    with zipfile.ZipFile(path) as wheel:
+        names = wheel.namelist()
+        wheel_files = [name for name in names
+                       if name.endswith('.dist-info/WHEEL') and
+                       name.count('/') == 1]
+        if len(wheel_files) != 1:
+            return False
+        if any(name.split('/', 1)[0].endswith('.data') for name in names):
+            return False
+        wheel_metadata = wheel.read(wheel_files[0]).decode('utf-8', 'replace')
+    return bool(re.search(r'^Root-Is-Purelib:\s*true\s*$', wheel_metadata,
+                          re.IGNORECASE | re.MULTILINE))
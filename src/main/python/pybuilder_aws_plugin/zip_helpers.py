@@ -0,0 +1,442 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import collections
+import functools
+import hashlib
+import json
+import os
+import struct
+import tempfile
+import time
+import zipfile
+import zlib
+from multiprocessing.pool import ThreadPool
+
+from pybuilder.errors import BuildFailedException
+
+from .metrics_helpers import add_metric
+from .prune_helpers import matches_any
+
+BUFFER_SIZE = 64 * 1024
+# Compressed members up to this size are kept in memory until written
+SPOOL_SIZE = 1024 * 1024
+# Compressed members waiting to be written, per compression worker
+PENDING_PER_WORKER = 4
+# The limit of AWS Lambda for a function and its layers, unzipped
+DEFAULT_MAX_UNZIPPED_SIZE = 250 * 1024 * 1024
+
+# Formats which are compressed already, deflating them again gains nothing
+INCOMPRESSIBLE_EXTENSIONS = frozenset([
+    '.zip', '.whl', '.egg', '.jar', '.gz', '.tgz', '.bz2', '.xz', '.lzma',
+    '.zst', '.7z', '.png', '.jpg', '.jpeg', '.gif', '.webp', '.woff',
+    '.woff2', '.mp3', '.mp4',
+])
+# Files larger than this are stored, if their first SAMPLE_SIZE bytes do
+# not deflate below INCOMPRESSIBLE_RATIO of their size
+MIN_SAMPLE_SIZE = 4 * 1024
+SAMPLE_SIZE = 64 * 1024
+INCOMPRESSIBLE_RATIO = 0.95
+
+thread_time = getattr(time, 'thread_time', time.time)
+
+# Fields of zipfile.structFileHeader, the local header of an archive member
+_FH_FILENAME_LENGTH = 10
+_FH_EXTRA_FIELD_LENGTH = 11
+_MASK_USE_DATA_DESCRIPTOR = 0x08
+# ZipInfo.create_system of archives created on Unix
+_CREATE_SYSTEM_UNIX = 3
+
+
+def collect_files(directory, folder=''):
+    """List (path, arcname) of all files below directory"""
+    files = []
+    for item in os.listdir(directory):
+        path = os.path.join(directory, item)
+        if os.path.isfile(path):
+            files.append((path, os.path.join(folder, item)))
+        elif os.path.isdir(path):
+            files.extend(collect_files(path, os.path.join(folder, item)))
+    return files
+
+
+def file_sha256(path):
+    sha256 = hashlib.sha256()
+    with open(path, 'rb') as fp:
+        for chunk in iter(lambda: fp.read(BUFFER_SIZE), b''):
+            sha256.update(chunk)
+    return sha256.hexdigest()
+
+
+def reproducible_date_time():
+    """The timestamp of all members of a reproducible archive
+
+    Honours SOURCE_DATE_EPOCH, see https://reproducible-builds.org/
+    """
+    source_date_epoch = os.environ.get('SOURCE_DATE_EPOCH')
+    if source_date_epoch:
+        date_time = time.gmtime(int(source_date_epoch))[0:6]
+        if date_time[0] >= 1980:
+            return date_time
+    return (1980, 1, 1, 0, 0, 0)
+
+
+def normalize_zip_info(zinfo, mode):
+    """Make zinfo independent of the build host and time"""
+    zinfo.date_time = reproducible_date_time()
+    zinfo.create_system = _CREATE_SYSTEM_UNIX
+    permissions = 0o755 if mode & 0o111 else 0o644
+    zinfo.external_attr = (0o100000 | permissions) << 16
+    return zinfo
+
+
+def zip_info_for_file(path, arcname, reproducible=False):
+    """Create the ZipInfo archive.write() would use for path"""
+    st = os.stat(path)
+    date_time = time.localtime(st.st_mtime)[0:6]
+    if date_time[0] < 1980:
+        date_time = (1980, 1, 1, 0, 0, 0)
+    zinfo = zipfile.ZipInfo(arcname.replace(os.sep, '/').lstrip('/'),
+                            date_time)
+    zinfo.external_attr = (st.st_mode & 0xFFFF) << 16
+    zinfo.file_size = st.st_size
+    if reproducible:
+        normalize_zip_info(zinfo, st.st_mode)
+    return zinfo
+
+
+def default_compression(path, arcname):
+    return zipfile.ZIP_DEFLATED, zlib.Z_DEFAULT_COMPRESSION
+
+
+def is_incompressible(path):
+    """Guess from the extension and a sample whether path deflates well"""
+    if os.path.splitext(path)[1].lower() in INCOMPRESSIBLE_EXTENSIONS:
+        return True
+    if os.path.getsize(path) <= MIN_SAMPLE_SIZE:
+        return False
+    with open(path, 'rb') as fp:
+        sample = fp.read(SAMPLE_SIZE)
+    return len(zlib.compress(sample, 1)) > INCOMPRESSIBLE_RATIO * len(sample)
+
+
+def make_compression_policy(levels=None, store_incompressible=True):
+    """Create a policy choosing compress_type and level per file
+
+    levels is a list of (pattern, level) tuples, the first pattern matching
+    the arcname gives the deflate level, 0 stores the file. Otherwise files
+    which are detected as incompressible are stored, if store_incompressible
+    is set, and all other files are deflated at the default level.
+    """
+    levels = list(levels or [])
+
+    def policy(path, arcname):
+        for pattern, level in levels:
+            if matches_any(arcname, [pattern]):
+                if level == 0:
+                    return zipfile.ZIP_STORED, 0
+                return zipfile.ZIP_DEFLATED, level
+        if store_incompressible and is_incompressible(path):
+            return zipfile.ZIP_STORED, 0
+        return default_compression(path, arcname)
+    return policy
+
+
+def compress_file(item, reproducible=False, policy=None):
+    """Compress the file of item, a (path, arcname) tuple
+
+    policy chooses the compress_type and deflate level, by default all
+    files are deflated. Returns the ZipInfo, a file object with the
+    compressed data and the SHA-256 of the uncompressed data.
+    """
+    start = thread_time()
+    path, arcname = item
+    zinfo = zip_info_for_file(path, arcname, reproducible)
+    zinfo.compress_type, level = (policy or default_compression)(
+            path, arcname)
+    compressor = None
+    if zinfo.compress_type == zipfile.ZIP_DEFLATED:
+        compressor = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS)
+    compressed = tempfile.SpooledTemporaryFile(max_size=SPOOL_SIZE)
+    sha256 = hashlib.sha256()
+    crc = 0
+    file_size = 0
+    with open(path, 'rb') as fp:
+        for chunk in iter(lambda: fp.read(BUFFER_SIZE), b''):
+            file_size += len(chunk)
+            crc = zlib.crc32(chunk, crc)
+            sha256.update(chunk)
+            if compressor is not None:
+                chunk = compressor.compress(chunk)
+            compressed.write(chunk)
+    if compressor is not None:
+        compressed.write(compressor.flush())
+    zinfo.CRC = crc & 0xFFFFFFFF
+    zinfo.file_size = file_size
+    zinfo.compress_size = compressed.tell()
+    compressed.seek(0)
+    add_metric('lambda.zip.compress_cpu_seconds', thread_time() - start)
+    return zinfo, compressed, sha256.hexdigest()
+
+
+def compress_files(files, workers=1, reproducible=False, policy=None):
+    """Yield compress_file() of all files in order, using workers threads
+
+    Workers only run PENDING_PER_WORKER files ahead of the consumer, so
+    memory use does not grow with the number of files.
+    """
+    compress = functools.partial(compress_file, reproducible=reproducible,
+                                 policy=policy)
+    if not workers or workers <= 1:
+        for item in files:
+            yield compress(item)
+        return
+    pool = ThreadPool(workers)
+    pending = collections.deque()
+    try:
+        for item in files:
+            if len(pending) >= workers * PENDING_PER_WORKER:
+                yield pending.popleft().get()
+            pending.append(pool.apply_async(compress, (item,)))
+        while pending:
+            yield pending.popleft().get()
+    finally:
+        pool.terminate()
+        pool.join()
+
+
+class SizeBudget(object):
+    """Running totals of the members written to an archive
+
+    Adding a member which takes the uncompressed or compressed total beyond
+    max_size or max_compressed_size raises a BuildFailedException, 0 means
+    no limit. file_size is the uncompressed size used up already, e.g. by
+    the layers of a lambda.
+    """
+
+    def __init__(self, name, max_size=0, max_compressed_size=0, file_size=0):
+        self.name = name
+        self.max_size = max_size
+        self.max_compressed_size = max_compressed_size
+        self.files = 0
+        self.file_size = file_size
+        self.compress_size = 0
+
+    def add(self, zinfo):
+        file_size = self.file_size + zinfo.file_size
+        compress_size = self.compress_size + zinfo.compress_size
+        for total, limit, kind in [
+                (file_size, self.max_size, 'uncompressed'),
+                (compress_size, self.max_compressed_size, 'compressed')]:
+            if limit and total > limit:
+                raise BuildFailedException(
+                        'The {0} exceeds its limit of {1} bytes {2} with '
+                        '{3} ({4} bytes after {5} files).'.format(
+                            self.name, limit, kind, zinfo.filename, total,
+                            self.files + 1))
+        self.files += 1
+        self.file_size = file_size
+        self.compress_size = compress_size
+
+
+def can_write_raw_members(archive):
+    """Whether write_raw_member works for archive, Python 3.5 and newer
+
+    It needs the ZipFile internals start_dir and _writecheck, otherwise
+    members have to be written with write_file.
+    """
+    return hasattr(archive, 'start_dir') and hasattr(archive, '_writecheck')
+
+
+def write_file(archive, item, reproducible=False, policy=None, budget=None):
+    """Compress the file of item into archive with the public zipfile API
+
+    Only the compress_type of policy is used. The member is added to budget
+    after it is written. Returns the SHA-256 of the file.
+    """
+    start = thread_time()
+    path, arcname = item
+    zinfo = zip_info_for_file(path, arcname, reproducible)
+    zinfo.compress_type = (policy or default_compression)(path, arcname)[0]
+    with open(path, 'rb') as fp:
+        data = fp.read()
+    archive.writestr(zinfo, data)
+    add_metric('lambda.zip.compress_cpu_seconds', thread_time() - start)
+    if budget is not None:
+        budget.add(archive.getinfo(zinfo.filename))
+    return hashlib.sha256(data).hexdigest()
+
+
+def write_compressed(archive, zinfo, compressed, budget=None):
+    try:
+        write_raw_member(
+            archive, zinfo,
+            iter(lambda: compressed.read(BUFFER_SIZE), b''), budget=budget)
+    finally:
+        compressed.close()
+
+
+def iter_raw_member(fp, zinfo):
+    """Yield the still compressed bytes of the member zinfo of the zip fp"""
+    fp.seek(zinfo.header_offset)
+    header = struct.unpack(zipfile.structFileHeader,
+                           fp.read(zipfile.sizeFileHeader))
+    fp.seek(header[_FH_FILENAME_LENGTH] + header[_FH_EXTRA_FIELD_LENGTH], 1)
+    remaining = zinfo.compress_size
+    while remaining > 0:
+        chunk = fp.read(min(BUFFER_SIZE, remaining))
+        if not chunk:
+            raise zipfile.BadZipfile(
+                'Truncated member {0}'.format(zinfo.filename))
+        remaining -= len(chunk)
+        yield chunk
+
+
+def write_raw_member(archive, zinfo, chunks, budget=None):
+    """Add an already compressed member to archive
+
+    zinfo must carry CRC, compress_type, compress_size and file_size of the
+    compressed data which is given as an iterable of chunks. The member is
+    added to budget before anything is written.
+    """
+    if budget is not None:
+        budget.add(zinfo)
+    zinfo.flag_bits &= ~_MASK_USE_DATA_DESCRIPTOR
+    zip64 = (zinfo.file_size > zipfile.ZIP64_LIMIT or
+             zinfo.compress_size > zipfile.ZIP64_LIMIT)
+    archive.fp.seek(archive.start_dir)
+    zinfo.header_offset = archive.fp.tell()
+    archive._writecheck(zinfo)
+    archive._didModify = True
+    archive.fp.write(zinfo.FileHeader(zip64))
+    for chunk in chunks:
+        archive.fp.write(chunk)
+    archive.start_dir = archive.fp.tell()
+    archive.filelist.append(zinfo)
+    archive.NameToInfo[zinfo.filename] = zinfo
+
+
+def copy_member(archive, source, member, zinfo, budget=None):
+    """Add member of the zip source to archive as zinfo
+
+    zinfo must carry compress_type, CRC, compress_size and file_size of
+    member. The compressed data is copied as it is if the archive supports
+    it, otherwise it is decompressed and compressed again.
+    """
+    if can_write_raw_members(archive):
+        write_raw_member(archive, zinfo, iter_raw_member(source.fp, member),
+                         budget=budget)
+        return
+    zinfo.flag_bits &= ~_MASK_USE_DATA_DESCRIPTOR
+    archive.writestr(zinfo, source.read(member))
+    if budget is not None:
+        budget.add(archive.getinfo(zinfo.filename))
+
+
+def copy_members(archive, source, members, reproducible=False, budget=None):
+    """Copy members of the zip source into archive without recompressing"""
+    for member in members:
+        zinfo = zipfile.ZipInfo(member.filename, member.date_time)
+        zinfo.create_system = member.create_system
+        zinfo.external_attr = member.external_attr
+        if not zinfo.external_attr >> 16:
+            # Make files without Unix permissions readable in the Lambda
+            zinfo.create_system = _CREATE_SYSTEM_UNIX
+            zinfo.external_attr = (0o100644 << 16) | zinfo.external_attr
+        zinfo.compress_type = member.compress_type
+        zinfo.flag_bits = member.flag_bits
+        zinfo.CRC = member.CRC
+        zinfo.compress_size = member.compress_size
+        zinfo.file_size = member.file_size
+        if reproducible:
+            normalize_zip_info(zinfo, zinfo.external_attr >> 16)
+        copy_member(archive, source, member, zinfo, budget=budget)
+
+
+def read_manifest(filename):
+    if not os.path.isfile(filename):
+        return {}
+    with open(filename) as manifest_file:
+        return json.load(manifest_file)
+
+
+def write_manifest(filename, manifest):
+    with open(filename, 'w') as manifest_file:
+        json.dump(manifest, manifest_file, indent=1, sort_keys=True)
+
+
+def write_files(archive, files, workers=1, reproducible=False, policy=None,
+                budget=None):
+    """Compress files into archive using workers threads
+
+    Without can_write_raw_members the files are compressed one after the
+    other by archive itself.
+    """
+    if not can_write_raw_members(archive):
+        for item in files:
+            write_file(archive, item, reproducible, policy, budget)
+        return
+    for zinfo, compressed, _ in compress_files(files, workers, reproducible,
+                                               policy):
+        write_compressed(archive, zinfo, compressed, budget=budget)
+
+
+def write_files_incremental(archive, files, previous_archive,
+                            previous_manifest, workers=1, reproducible=False,
+                            policy=None, budget=None):
+    """Write files to archive reusing unchanged members of previous_archive
+
+    Unchanged members are copied still compressed. Returns the manifest of
+    the new archive and the number of reused members.
+    """
+    manifest = {}
+    previous_members = {}
+    if previous_archive is not None:
+        previous_members = dict(
+            (zinfo.filename, zinfo) for zinfo in previous_archive.infolist())
+
+    reusable = []
+    changed = []
+    for path, arcname in files:
+        st = os.stat(path)
+        entry = {'size': st.st_size, 'mtime': st.st_mtime}
+        previous = previous_manifest.get(arcname)
+        previous_member = previous_members.get(arcname)
+        if previous and previous_member is not None:
+            if (previous['size'] == st.st_size and
+                    previous['mtime'] == st.st_mtime):
+                entry['sha256'] = previous['sha256']
+            else:
+                entry['sha256'] = file_sha256(path)
+            if (previous['sha256'] != entry['sha256'] or
+                    previous_member.file_size != st.st_size):
+                previous_member = None
+        else:
+            previous_member = None
+        if previous_member is None:
+            changed.append((path, arcname))
+        reusable.append(previous_member)
+        manifest[arcname] = entry
+
+    compressed_files = None
+    if can_write_raw_members(archive):
+        compressed_files = compress_files(
+                changed, workers, reproducible, policy)
+    for (path, arcname), previous_member in zip(files, reusable):
+        if previous_member is None and compressed_files is None:
+            manifest[arcname]['sha256'] = write_file(
+                    archive, (path, arcname), reproducible, policy, budget)
+            continue
+        if previous_member is None:
+            zinfo, compressed, sha256 = next(compressed_files)
+            manifest[arcname]['sha256'] = sha256
+            write_compressed(archive, zinfo, compressed, budget=budget)
+            continue
+        zinfo = zip_info_for_file(path, arcname, reproducible)
+        zinfo.compress_type = previous_member.compress_type
+        zinfo.flag_bits = previous_member.flag_bits
+        zinfo.CRC = previous_member.CRC
+        zinfo.compress_size = previous_member.compress_size
+        copy_member(archive, previous_archive, previous_member, zinfo,
+                    budget=budget)
+    return manifest, len(files) - len(changed)
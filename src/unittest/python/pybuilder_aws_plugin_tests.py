@@ -1,6 +1,9 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
+import hashlib
+import io
+import json
 import os
 import shutil
 import subprocess
@@ -11,6 +14,8 @@ from unittest2 import TestCase
 
 import boto3
 import mock
+from botocore.awsrequest import AWSResponse
+from botocore.exceptions import ClientError
 from moto import mock_s3
 from pybuilder.core import Logger, Project
 from pybuilder.errors import BuildFailedException
@@ -18,11 +23,24 @@ from pybuilder.errors import BuildFailedException
 from pybuilder_aws_plugin import (package_lambda_code,
                                   upload_zip_to_s3,
                                   initialize_plugin,
+                                  profile_lambda_imports,
                                   lambda_release,
                                   )
-from pybuilder_aws_plugin.lambda_tasks import prepare_dependencies_dir
+from pybuilder_aws_plugin.cache_helpers import evict_least_recently_used
+from pybuilder_aws_plugin.import_graph_helpers import find_imports
+from pybuilder_aws_plugin.metrics_helpers import get_metrics, reset_metrics
+from pybuilder_aws_plugin.storage_helpers import LocalStorage, S3Storage
+from pybuilder_aws_plugin.zip_helpers import PENDING_PER_WORKER, compress_files
+from pybuilder_aws_plugin.wheelhouse_helpers import prune_wheelhouse
+from pybuilder_aws_plugin.lambda_tasks import (get_path_to_layer_zipfile,
+                                               prepare_dependencies_dir,
+                                               reset_resolved_dependencies,
+                                               )
 from pybuilder_aws_plugin.helpers import (check_acl_parameter_validity,
+                                          get_s3_client,
                                           permissible_acl_values,
+                                          publish_metrics,
+                                          reset_s3_client,
                                           )
 
 
@@ -50,9 +68,15 @@ class TestInitializePlugin(TestCase):
                          'bucket-owner-full-control')
         self.assertEqual(project.get_property('template_key_prefix'),
                          '')
+        self.assertEqual(
+                project.get_property('lambda_dependencies_batch_install'),
+                False)
+        self.assertEqual(project.get_property('lambda_cache_dir'), '')
+        self.assertEqual(project.get_property('lambda_cache_max_entries'), 10)
+        self.assertEqual(project.get_property('skip_unchanged_uploads'), True)
 
 
-class PackageLambdaCodeTest(TestCase):
+class LambdaProjectTestCase(TestCase):
     def setUp(self):
         self.tempdir = tempfile.mkdtemp(prefix='palp-')
         self.testdir = os.path.join(self.tempdir, 'package_lambda_code_test')
@@ -69,10 +93,13 @@ class PackageLambdaCodeTest(TestCase):
 
         self.dir_target = os.path.join(self.testdir, 'target')
         self.zipfile_name = os.path.join(self.dir_target, 'palp.zip')
+        reset_metrics()
 
     def tearDown(self):
         shutil.rmtree(self.tempdir)
 
+
+class PackageLambdaCodeTest(LambdaProjectTestCase):
     @mock.patch('pybuilder_aws_plugin.lambda_tasks.prepare_dependencies_dir')
     def test_package_lambda_assembles_zipfile_correctly(
             self, prepare_dependencies_dir_mock):
@@ -86,6 +113,463 @@ class PackageLambdaCodeTest(TestCase):
                            'VERSION'])
         self.assertEqual(sorted(zf.namelist()), expected)
 
+    @mock.patch('pybuilder_aws_plugin.lambda_tasks.prepare_dependencies_dir')
+    def test_package_lambda_writes_metrics_report(
+            self, prepare_dependencies_dir_mock):
+        package_lambda_code(self.project, mock.MagicMock(Logger))
+        with open(os.path.join(self.dir_target, 'reports',
+                               'aws_plugin_metrics.json')) as fp:
+            metrics = json.load(fp)
+        self.assertEqual(metrics['lambda.zip.files'], 6)
+        self.assertTrue(metrics['lambda.zip.compressed_bytes'] > 0)
+        self.assertTrue('lambda.zip.seconds' in metrics)
+
+    @mock.patch('pybuilder_aws_plugin.lambda_tasks.prepare_dependencies_dir')
+    def test_parallel_compression_gives_same_archive_order(
+            self, prepare_dependencies_dir_mock):
+        package_lambda_code(self.project, mock.MagicMock(Logger))
+        serial = zipfile.ZipFile(self.zipfile_name)
+        serial_members = [(i.filename, i.CRC, i.compress_size)
+                          for i in serial.infolist()]
+        serial.close()
+        self.project.set_property('lambda_zip_compression_workers', 4)
+        package_lambda_code(self.project, mock.MagicMock(Logger))
+        parallel = zipfile.ZipFile(self.zipfile_name)
+        self.assertEqual(parallel.testzip(), None)
+        self.assertEqual([(i.filename, i.CRC, i.compress_size)
+                          for i in parallel.infolist()], serial_members)
+
+    @mock.patch('pybuilder_aws_plugin.lambda_tasks.prepare_dependencies_dir')
+    def test_incompressible_files_are_stored(
+            self, prepare_dependencies_dir_mock):
+        dependencies = os.path.join(self.dir_target, 'lambda_dependencies')
+        random_data = os.urandom(64 * 1024)
+        for name, content in [('bundled.whl', b'PK' + b'x' * 8192),
+                              ('native.so', random_data),
+                              ('data.json', b'{"a": 1}' * 1024)]:
+            with open(os.path.join(dependencies, name), 'wb') as fp:
+                fp.write(content)
+        self.project.set_property('lambda_zip_store_incompressible', True)
+        self.project.set_property('lambda_zip_compression_levels',
+                                  [('*.json', 0), ('*.py', 9)])
+        logger = mock.MagicMock(Logger)
+
+        package_lambda_code(self.project, logger)
+
+        zf = zipfile.ZipFile(self.zipfile_name)
+        self.assertEqual(zf.testzip(), None)
+        compress_types = dict((zinfo.filename, zinfo.compress_type)
+                              for zinfo in zf.infolist())
+        self.assertEqual(compress_types['bundled.whl'], zipfile.ZIP_STORED)
+        self.assertEqual(compress_types['native.so'], zipfile.ZIP_STORED)
+        self.assertEqual(compress_types['data.json'], zipfile.ZIP_STORED)
+        self.assertEqual(compress_types['test_module_file.py'],
+                         zipfile.ZIP_DEFLATED)
+        self.assertEqual(zf.read('native.so'), random_data)
+        self.assertTrue(any(
+                call[0][0].startswith('Compression took ') and
+                '4 of 9 files' in call[0][0]
+                for call in logger.info.call_args_list))
+
+        self.project.set_property('lambda_zip_store_incompressible', False)
+        self.project.set_property('lambda_zip_compression_levels', [])
+        package_lambda_code(self.project, mock.MagicMock(Logger))
+        zf = zipfile.ZipFile(self.zipfile_name)
+        self.assertEqual(zf.getinfo('native.so').compress_type,
+                         zipfile.ZIP_DEFLATED)
+
+    def test_pure_wheels_are_streamed_into_zipfile(self):
+        wheelhouse = os.path.join(self.tempdir, 'wheelhouse')
+        os.mkdir(wheelhouse)
+        pure_wheel = write_wheel(wheelhouse, 'pure', '1.0')
+        write_wheel(wheelhouse, 'platlib', '1.0', purelib=False)
+        self.project.depends_on('pure', '==1.0')
+        self.project.depends_on('platlib', '==1.0')
+        self.project.set_property('lambda_wheelhouse_dir', wheelhouse)
+        self.project.set_property('lambda_zip_stream_wheels', True)
+        logger = mock.MagicMock(Logger)
+
+        package_lambda_code(self.project, logger)
+
+        logger.info.assert_any_call(
+                'Downloaded 2 distributions, 1 of them need pip to install.')
+        zf = zipfile.ZipFile(self.zipfile_name)
+        self.assertEqual(zf.testzip(), None)
+        names = zf.namelist()
+        self.assertTrue('pure-1.0.dist-info/METADATA' in names)
+        self.assertFalse('pure-1.0.dist-info/RECORD' in names)
+        self.assertTrue('platlib.py' in names)
+        self.assertFalse('test_dependency_module.py' in names)
+        self.assertEqual(zf.read('pure.py'), b'VALUE = 42\n' * 100)
+        with zipfile.ZipFile(pure_wheel) as wheel:
+            self.assertEqual(zf.getinfo('pure.py').compress_size,
+                             wheel.getinfo('pure.py').compress_size)
+
+    @mock.patch('pybuilder_aws_plugin.lambda_tasks.prepare_dependencies_dir')
+    def test_packaging_stops_when_size_budget_is_exceeded(
+            self, prepare_dependencies_dir_mock):
+        self.project.set_property('lambda_zip_max_size', 10)
+        with self.assertRaises(BuildFailedException) as context:
+            package_lambda_code(self.project, mock.MagicMock(Logger))
+        self.assertTrue(str(context.exception).startswith(
+                'The lambda-zip exceeds its limit of 10 bytes uncompressed'))
+        self.assertFalse(os.path.exists(self.zipfile_name))
+
+        self.project.set_property('lambda_zip_max_size', 1024 * 1024)
+        self.project.set_property('lambda_zip_max_compressed_size', 1)
+        self.assertRaises(BuildFailedException, package_lambda_code,
+                          self.project, mock.MagicMock(Logger))
+
+        self.project.set_property('lambda_zip_max_compressed_size', 0)
+        logger = mock.MagicMock(Logger)
+        package_lambda_code(self.project, logger)
+        self.assertTrue(any(
+                call[0][0].startswith('The lambda-zip takes ') and
+                'of the limit of 1048576 bytes' in call[0][0]
+                for call in logger.info.call_args_list))
+
+    def test_compression_runs_a_bounded_number_of_files_ahead(self):
+        source = os.path.join(self.testdir, 'src/main/python',
+                              'test_module_file.py')
+        consumed = []
+
+        def files():
+            for index in range(100):
+                consumed.append(index)
+                yield source, 'module_{0}.py'.format(index)
+
+        results = compress_files(files(), workers=2)
+        next(results)[1].close()
+        self.assertTrue(len(consumed) <= 2 * PENDING_PER_WORKER + 1)
+        self.assertEqual(len([result[1].close() for result in results]), 99)
+
+    @mock.patch('pybuilder_aws_plugin.zip_helpers.can_write_raw_members',
+                mock.Mock(return_value=False))
+    @mock.patch('pybuilder_aws_plugin.lambda_tasks.prepare_dependencies_dir')
+    def test_zipfile_is_written_without_zipfile_internals(
+            self, prepare_dependencies_dir_mock):
+        self.project.set_property('lambda_zip_compression_workers', 2)
+        package_lambda_code(self.project, mock.MagicMock(Logger))
+        zf = zipfile.ZipFile(self.zipfile_name)
+        self.assertEqual(zf.testzip(), None)
+        self.assertEqual(len(zf.namelist()), 6)
+        self.assertEqual(zf.getinfo('test_module_file.py').compress_type,
+                         zipfile.ZIP_DEFLATED)
+
+        self.project.set_property('lambda_zip_max_size', 10)
+        self.assertRaises(BuildFailedException, package_lambda_code,
+                          self.project, mock.MagicMock(Logger))
+
+    @mock.patch('pybuilder_aws_plugin.lambda_tasks.prepare_dependencies_dir')
+    def test_reproducible_builds_are_byte_identical(
+            self, prepare_dependencies_dir_mock):
+        self.project.set_property('lambda_zip_reproducible', True)
+        self.project.version = '42'
+        package_lambda_code(self.project, mock.MagicMock(Logger))
+        with open(self.zipfile_name + '.sha256') as fp:
+            first_sha256 = fp.read()
+
+        for root, dirs, files in os.walk(self.testdir):
+            for name in files:
+                os.utime(os.path.join(root, name), (1500000000, 1500000000))
+        package_lambda_code(self.project, mock.MagicMock(Logger))
+        with open(self.zipfile_name + '.sha256') as fp:
+            self.assertEqual(fp.read(), first_sha256)
+
+        zf = zipfile.ZipFile(self.zipfile_name)
+        names = zf.namelist()
+        self.assertEqual(names[:-1], sorted(names[:-1]))
+        self.assertEqual(zf.read('VERSION'), b'42')
+        for zinfo in zf.infolist():
+            self.assertEqual(zinfo.date_time, (1980, 1, 1, 0, 0, 0))
+            self.assertEqual(zinfo.external_attr >> 16 & 0o777, 0o644)
+
+    @mock.patch('pybuilder_aws_plugin.lambda_tasks.prepare_dependencies_dir')
+    def test_slimming_drops_dead_weight_from_dependencies(
+            self, prepare_dependencies_dir_mock):
+        dependencies = os.path.join(self.dir_target, 'lambda_dependencies')
+        for name, content in [('__pycache__/test_dependency_module.pyc', 'x'),
+                              ('dep-1.0.dist-info/RECORD', 'xx'),
+                              ('dep-1.0.dist-info/METADATA', 'Version'),
+                              ('tests/test_a.py', 'x'),
+                              ('test_dependency_package/include/a.py', 'x'),
+                              ('test_module_file.py', 'shadowed'),
+                              ('native.so', 'not really a binary')]:
+            filename = os.path.join(dependencies, name)
+            if not os.path.isdir(os.path.dirname(filename)):
+                os.makedirs(os.path.dirname(filename))
+            with open(filename, 'w') as fp:
+                fp.write(content)
+        self.project.set_property('lambda_zip_slim', True)
+        self.project.set_property('lambda_zip_strip_binaries', True)
+        logger = mock.MagicMock(Logger)
+
+        package_lambda_code(self.project, logger)
+
+        zf = zipfile.ZipFile(self.zipfile_name)
+        expected = sorted(['dep-1.0.dist-info/METADATA',
+                           'native.so',
+                           'test_dependency_module.py',
+                           'test_dependency_package/__init__.py',
+                           'test_dependency_package/include/a.py',
+                           'test_package_directory/__init__.py',
+                           'test_module_file.py',
+                           'test_script.py',
+                           'VERSION'])
+        self.assertEqual(sorted(zf.namelist()), expected)
+        self.assertNotEqual(zf.read('test_module_file.py'), b'shadowed')
+        logger.info.assert_any_call(
+            'Slimming the dependencies saved 12 bytes: 4 bytes of excluded '
+            'files, 8 bytes of duplicates, 0 bytes of symbols.')
+
+    @mock.patch('pybuilder_aws_plugin.lambda_tasks.prepare_dependencies_dir')
+    def test_incremental_build_reuses_unchanged_files(
+            self, prepare_dependencies_dir_mock):
+        self.project.set_property('lambda_zip_incremental', True)
+        self.project.set_property(
+                'lambda_cache_dir', os.path.join(self.tempdir, 'cache'))
+        package_lambda_code(self.project, mock.MagicMock(Logger))
+        self.assertTrue(os.path.isfile(self.zipfile_name + '.manifest.json'))
+
+        changed_file = os.path.join(
+                self.testdir, 'src/main/python/test_module_file.py')
+        with open(changed_file, 'w') as fp:
+            fp.write('changed = True\n')
+        logger = mock.MagicMock(Logger)
+        package_lambda_code(self.project, logger)
+
+        logger.info.assert_any_call(
+                'Reused 4 of 5 compressed files from the previous lambda-zip.')
+        zf = zipfile.ZipFile(self.zipfile_name)
+        self.assertEqual(zf.testzip(), None)
+        self.assertEqual(zf.read('test_module_file.py'), b'changed = True\n')
+        self.assertEqual(len(zf.namelist()), 6)
+
+    @mock.patch('pybuilder_aws_plugin.zip_helpers.can_write_raw_members',
+                mock.Mock(return_value=False))
+    @mock.patch('pybuilder_aws_plugin.lambda_tasks.prepare_dependencies_dir')
+    def test_incremental_build_without_zipfile_internals(
+            self, prepare_dependencies_dir_mock):
+        self.project.set_property('lambda_zip_incremental', True)
+        self.project.set_property(
+                'lambda_cache_dir', os.path.join(self.tempdir, 'cache'))
+        package_lambda_code(self.project, mock.MagicMock(Logger))
+        with open(os.path.join(self.testdir, 'src/main/python',
+                               'test_module_file.py'), 'w') as fp:
+            fp.write('changed = True\n')
+        logger = mock.MagicMock(Logger)
+        package_lambda_code(self.project, logger)
+
+        logger.info.assert_any_call(
+                'Reused 4 of 5 compressed files from the previous lambda-zip.')
+        zf = zipfile.ZipFile(self.zipfile_name)
+        self.assertEqual(zf.testzip(), None)
+        self.assertEqual(zf.read('test_module_file.py'), b'changed = True\n')
+
+    @mock.patch('pybuilder_aws_plugin.lambda_tasks.prepare_dependencies_dir')
+    def test_bytecode_is_compiled_into_zipfile_and_cached(
+            self, prepare_dependencies_dir_mock):
+        self.project.set_property('lambda_zip_compile_bytecode', True)
+        self.project.set_property(
+                'lambda_cache_dir', os.path.join(self.tempdir, 'cache'))
+        package_lambda_code(self.project, mock.MagicMock(Logger))
+
+        cache_tag = sys.implementation.cache_tag
+        zf = zipfile.ZipFile(self.zipfile_name)
+        pyc_name = 'test_package_directory/__pycache__/__init__.{0}.pyc'.format(
+                cache_tag)
+        self.assertIn(pyc_name, zf.namelist())
+        self.assertIn('__pycache__/test_script.{0}.pyc'.format(cache_tag),
+                      zf.namelist())
+        # flags of a hash based pyc which is not checked against the source
+        self.assertEqual(zf.read(pyc_name)[4:8], b'\x01\x00\x00\x00')
+
+        logger = mock.MagicMock(Logger)
+        package_lambda_code(self.project, logger)
+        logger.info.assert_any_call(
+                'Compiled 5 Python files for {0} (5 from cache, 0 '
+                'failed).'.format(cache_tag))
+
+    @mock.patch('pybuilder_aws_plugin.lambda_tasks.prepare_dependencies_dir')
+    def test_modules_unreachable_from_handler_are_pruned(
+            self, prepare_dependencies_dir_mock):
+        for name, content in [
+                ('src/main/scripts/handler.py',
+                 'import importlib\n'
+                 'from test_dependency_package import something\n'
+                 'importlib.import_module("test_package_directory")\n'),
+                ('target/lambda_dependencies/test_dependency_package/sub.py',
+                 ''),
+                ('target/lambda_dependencies/test_dependency_package/data.txt',
+                 'data'),
+                ('target/lambda_dependencies/unused/__init__.py', ''),
+                ('target/lambda_dependencies/unused/data.json', '{}')]:
+            filename = os.path.join(self.testdir, name)
+            if not os.path.isdir(os.path.dirname(filename)):
+                os.makedirs(os.path.dirname(filename))
+            with open(filename, 'w') as fp:
+                fp.write(content)
+        self.project.set_property('lambda_zip_prune_imports', True)
+        self.project.set_property('lambda_handler_module', 'handler')
+        self.project.set_property('lambda_zip_keep_modules',
+                                  ['test_module_file'])
+
+        package_lambda_code(self.project, mock.MagicMock(Logger))
+
+        zf = zipfile.ZipFile(self.zipfile_name)
+        self.assertEqual(sorted(zf.namelist()),
+                         sorted(['handler.py',
+                                 'test_dependency_package/__init__.py',
+                                 'test_dependency_package/data.txt',
+                                 'test_package_directory/__init__.py',
+                                 'test_module_file.py',
+                                 'VERSION']))
+        with open(os.path.join(self.dir_target, 'reports',
+                               'lambda_pruned_files.txt')) as fp:
+            report = fp.read()
+        self.assertIn('unused/data.json', report)
+        self.assertIn('test_dependency_package/sub.py', report)
+
+    @mock.patch('pybuilder_aws_plugin.lambda_tasks.resolve_requirements',
+                mock.Mock(return_value=['test-dependency-package==1.0']))
+    @mock.patch('pybuilder_aws_plugin.lambda_tasks.prepare_dependencies_dir')
+    def test_imports_are_followed_through_layer(
+            self, prepare_dependencies_dir_mock):
+        reset_resolved_dependencies()
+        self.addCleanup(reset_resolved_dependencies)
+        for name, content in [
+                ('src/main/scripts/handler.py',
+                 'import test_dependency_package\n'),
+                ('target/lambda_dependencies/test_dependency_package/'
+                 '__init__.py',
+                 'import importlib\n'
+                 'importlib.import_module("test_package_directory")\n')]:
+            with open(os.path.join(self.testdir, name), 'w') as fp:
+                fp.write(content)
+        self.project.depends_on('test_dependency_package')
+        self.project.set_property('lambda_layer', True)
+        self.project.set_property('lambda_zip_prune_imports', True)
+        self.project.set_property('lambda_handler_module', 'handler')
+
+        package_lambda_code(self.project, mock.MagicMock(Logger))
+
+        zf = zipfile.ZipFile(self.zipfile_name)
+        self.assertEqual(sorted(zf.namelist()),
+                         sorted(['handler.py',
+                                 'test_package_directory/__init__.py',
+                                 'VERSION']))
+
+    def test_relative_imports_are_resolved(self):
+        imports = find_imports(
+                'from . import a\nfrom ..b import c\nfrom .d.e import *\n',
+                'pkg.sub', True)
+        self.assertEqual(sorted(imports),
+                         ['pkg.b', 'pkg.b.c', 'pkg.sub', 'pkg.sub.a',
+                          'pkg.sub.d.e', 'pkg.sub.d.e.*'])
+
+    @mock.patch('pybuilder_aws_plugin.lambda_tasks.resolve_requirements',
+                mock.Mock(return_value=['test-dependency-package==1.0']))
+    @mock.patch('pybuilder_aws_plugin.lambda_tasks.prepare_dependencies_dir')
+    def test_dependencies_are_packaged_into_cached_layer(
+            self, prepare_dependencies_dir_mock):
+        reset_resolved_dependencies()
+        self.addCleanup(reset_resolved_dependencies)
+        self.project.depends_on('test_dependency_package')
+        self.project.set_property('lambda_layer', True)
+        self.project.set_property(
+                'lambda_cache_dir', os.path.join(self.tempdir, 'cache'))
+        package_lambda_code(self.project, mock.MagicMock(Logger))
+
+        zf = zipfile.ZipFile(self.zipfile_name)
+        self.assertEqual(sorted(zf.namelist()),
+                         sorted(['test_package_directory/__init__.py',
+                                 'test_module_file.py',
+                                 'test_script.py',
+                                 'VERSION']))
+        layers = [name for name in os.listdir(self.dir_target)
+                  if name.startswith('palp-layer-')]
+        self.assertEqual(len(layers), 1)
+        layer = zipfile.ZipFile(os.path.join(self.dir_target, layers[0]))
+        self.assertEqual(sorted(layer.namelist()),
+                         ['python/test_dependency_module.py',
+                          'python/test_dependency_package/__init__.py'])
+
+        shutil.rmtree(self.dir_target)
+        prepare_dependencies_dir_mock.reset_mock()
+        package_lambda_code(self.project, mock.MagicMock(Logger))
+        self.assertFalse(prepare_dependencies_dir_mock.called)
+        self.assertEqual(os.listdir(self.dir_target).count(layers[0]), 1)
+
+
+class ProfileLambdaImportsTest(LambdaProjectTestCase):
+    def setUp(self):
+        super(ProfileLambdaImportsTest, self).setUp()
+        self.project.set_property('lambda_handler_module', 'handler')
+        self.write_handler('import decimal\nimport test_dependency_package\n')
+
+    def write_handler(self, content):
+        with open(os.path.join(self.testdir, 'src/main/scripts/handler.py'),
+                  'w') as fp:
+            fp.write(content)
+
+    @mock.patch('pybuilder_aws_plugin.lambda_tasks.prepare_dependencies_dir')
+    def test_imports_are_profiled_from_zipfile(
+            self, prepare_dependencies_dir_mock):
+        package_lambda_code(self.project, mock.MagicMock(Logger))
+        profile_lambda_imports(self.project, mock.MagicMock(Logger))
+
+        report = os.path.join(self.dir_target, 'reports',
+                              'lambda_import_profile')
+        with open(report + '.json') as fp:
+            result = json.load(fp)
+        modules = [record['module'] for record in result['modules']]
+        self.assertIn('handler', modules)
+        self.assertIn('test_dependency_package', modules)
+        self.assertIn('decimal', modules)
+        self.assertEqual(
+                [record['self_ms'] for record in result['modules']],
+                sorted([record['self_ms'] for record in result['modules']],
+                       reverse=True))
+        with open(report + '.txt') as fp:
+            self.assertIn('test_dependency_package', fp.read())
+
+    @mock.patch('pybuilder_aws_plugin.lambda_tasks.resolve_requirements',
+                mock.Mock(return_value=['test-dependency-package==1.0']))
+    @mock.patch('pybuilder_aws_plugin.lambda_tasks.prepare_dependencies_dir')
+    def test_dependencies_are_imported_from_layer(
+            self, prepare_dependencies_dir_mock):
+        reset_resolved_dependencies()
+        self.addCleanup(reset_resolved_dependencies)
+        self.project.depends_on('test_dependency_package')
+        self.project.set_property('lambda_layer', True)
+        package_lambda_code(self.project, mock.MagicMock(Logger))
+        profile_lambda_imports(self.project, mock.MagicMock(Logger))
+
+        with open(os.path.join(self.dir_target, 'reports',
+                               'lambda_import_profile.json')) as fp:
+            result = json.load(fp)
+        self.assertIn('test_dependency_package',
+                      [record['module'] for record in result['modules']])
+
+    @mock.patch('pybuilder_aws_plugin.lambda_tasks.prepare_dependencies_dir')
+    def test_only_zipfile_contents_are_importable(
+            self, prepare_dependencies_dir_mock):
+        self.write_handler('import pybuilder\n')
+        package_lambda_code(self.project, mock.MagicMock(Logger))
+        self.assertRaisesRegexp(
+                BuildFailedException, 'Importing handler failed',
+                profile_lambda_imports, self.project, mock.MagicMock(Logger))
+
+    @mock.patch('pybuilder_aws_plugin.lambda_tasks.prepare_dependencies_dir')
+    def test_exceeded_import_time_budget_fails_build(
+            self, prepare_dependencies_dir_mock):
+        self.write_handler('import time\ntime.sleep(0.05)\n')
+        self.project.set_property('lambda_import_time_budget_ms', 10)
+        package_lambda_code(self.project, mock.MagicMock(Logger))
+        self.assertRaisesRegexp(
+                BuildFailedException, 'more than the budget of 10 ms',
+                profile_lambda_imports, self.project, mock.MagicMock(Logger))
+
 
 class TestsWithS3(TestCase):
     def setUp(self):
@@ -107,12 +591,167 @@ class TestsWithS3(TestCase):
 
         self.my_mock_s3 = mock_s3()
         self.my_mock_s3.start()
+        reset_s3_client()
+        reset_metrics()
         self.s3 = boto3.resource('s3')
         self.s3.create_bucket(Bucket=self.bucket_name)
 
     def tearDown(self):
         shutil.rmtree(self.tempdir)
         self.my_mock_s3.stop()
+        reset_s3_client()
+
+
+class SharedS3ClientTest(TestsWithS3):
+    def test_client_is_created_once_and_shared(self):
+        self.project.set_property('s3_max_pool_connections', 5)
+        logger = mock.MagicMock(Logger)
+        client = get_s3_client(logger, self.project)
+        upload_zip_to_s3(self.project, logger)
+        lambda_release(self.project, logger)
+        self.assertTrue(get_s3_client(logger) is client)
+        self.assertEqual(client.meta.config.max_pool_connections, 5)
+
+    def test_reset_creates_new_client(self):
+        logger = mock.MagicMock(Logger)
+        client = get_s3_client(logger)
+        reset_s3_client()
+        self.assertFalse(get_s3_client(logger) is client)
+
+
+class RawResponse(io.BytesIO):
+    def stream(self, **kwargs):
+        yield self.read()
+
+
+SLOW_DOWN = (b'<?xml version="1.0" encoding="UTF-8"?><Error>'
+             b'<Code>SlowDown</Code><Message>Reduce your request rate.'
+             b'</Message></Error>')
+
+
+@mock.patch('pybuilder_aws_plugin.retry_helpers.RETRY_BASE_DELAY', 0.001)
+class S3RetryTest(TestsWithS3):
+    def throttle_puts(self, client, count):
+        """Answer the next count PUT requests with SlowDown"""
+        throttled = []
+
+        def slow_down(request, **kwargs):
+            if request.method != 'PUT' or len(throttled) >= count:
+                return None
+            throttled.append(request.url)
+            return AWSResponse(request.url, 503, {},
+                               RawResponse(SLOW_DOWN))
+        client.meta.events.register_first('before-send.s3', slow_down)
+        return throttled
+
+    def test_throttled_upload_is_retried(self):
+        logger = mock.MagicMock(Logger)
+        client = get_s3_client(logger, self.project)
+        throttled = self.throttle_puts(client, 2)
+
+        upload_zip_to_s3(self.project, logger)
+
+        self.assertEqual(len(throttled), 2)
+        metrics = get_metrics()
+        self.assertEqual(metrics['s3.retries'], 2)
+        self.assertEqual(metrics['s3.throttled'], 2)
+        self.assertTrue('s3.retry_backoff_seconds' in metrics)
+        self.assertEqual(self.s3.Object(
+                self.bucket_name, 'v123/palp.zip').get()['Body'].read(),
+                self.test_data)
+
+    def test_retries_stop_after_max_attempts(self):
+        self.project.set_property('s3_max_attempts', 3)
+        logger = mock.MagicMock(Logger)
+        client = get_s3_client(logger, self.project)
+        throttled = self.throttle_puts(client, 10)
+
+        self.assertRaises(ClientError, client.put_object,
+                          Bucket=self.bucket_name, Key='key', Body=b'data')
+
+        self.assertEqual(len(throttled), 3)
+        self.assertEqual(get_metrics()['s3.retries_exhausted'], 1)
+        self.assertTrue(any(
+                call[0][0].startswith('Giving up PutObject after 3 attempts')
+                for call in logger.warn.call_args_list))
+
+    def test_retries_stop_at_deadline(self):
+        self.project.set_property('s3_retry_deadline', 0)
+        logger = mock.MagicMock(Logger)
+        client = get_s3_client(logger, self.project)
+        throttled = self.throttle_puts(client, 10)
+
+        self.assertRaises(ClientError, client.put_object,
+                          Bucket=self.bucket_name, Key='key', Body=b'data')
+        self.assertEqual(len(throttled), 1)
+
+
+class LocalStorageTest(TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp(prefix='palp-')
+        os.mkdir(os.path.join(self.tempdir, 'bucket'))
+        self.storage = LocalStorage(self.tempdir)
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def test_objects_keep_acl_and_metadata(self):
+        self.storage.put('bucket', 'v1/a.zip', io.BytesIO(b'zip'), 'private',
+                         {'sha256': 'abc'})
+        self.storage.copy('bucket', 'v1/a.zip', 'latest/a.zip',
+                          'bucket-owner-full-control')
+
+        self.assertEqual(self.storage.head('bucket', 'latest/a.zip'),
+                         {'sha256': 'abc'})
+        self.assertEqual(self.storage.head('bucket', 'v2/a.zip'), None)
+        self.assertEqual(self.storage.head('missing', 'v1/a.zip'), None)
+        self.assertEqual(
+                self.storage.read_metadata('bucket', 'latest/a.zip')['ACL'],
+                'bucket-owner-full-control')
+        self.assertEqual(self.storage.list('bucket'),
+                         ['latest/a.zip', 'v1/a.zip'])
+        self.assertEqual(self.storage.list('bucket', 'v1/'), ['v1/a.zip'])
+        with open(os.path.join(self.tempdir, 'bucket', 'latest',
+                               'a.zip'), 'rb') as fp:
+            self.assertEqual(fp.read(), b'zip')
+
+    def test_errors_look_like_s3_errors(self):
+        for call, code in [
+                (lambda: self.storage.put('missing', 'a', io.BytesIO(b''),
+                                          'private', {}), 'NoSuchBucket'),
+                (lambda: self.storage.copy('bucket', 'a', 'b', 'private'),
+                 'NoSuchKey'),
+                (lambda: self.storage.head('bucket', '../a'), 'InvalidKey')]:
+            with self.assertRaises(ClientError) as context:
+                call()
+            self.assertEqual(
+                    context.exception.response['Error']['Code'], code)
+
+    def test_upload_and_release_without_s3(self):
+        project = Project(basedir=self.tempdir, name='palp', version='123')
+        project.set_property('dir_target', 'target')
+        project.set_property('local_storage_dir', '.')
+        project.set_property('bucket_name', 'bucket')
+        project.set_property('bucket_prefix', 'palp/')
+        project.set_property('skip_unchanged_uploads', True)
+        project.set_property(
+                'lambda_file_access_control', 'bucket-owner-full-control')
+        os.mkdir(os.path.join(self.tempdir, 'target'))
+        with open(os.path.join(self.tempdir, 'target', 'palp.zip'),
+                  'wb') as fp:
+            fp.write(b'zip')
+        logger = mock.MagicMock(Logger)
+
+        upload_zip_to_s3(project, logger)
+        upload_zip_to_s3(project, logger)
+        lambda_release(project, logger)
+
+        self.assertEqual(self.storage.list('bucket'),
+                         ['palp/latest/palp.zip', 'palp/v123/palp.zip'])
+        self.assertEqual(
+                self.storage.head('bucket', 'palp/latest/palp.zip'),
+                {'sha256': hashlib.sha256(b'zip').hexdigest()})
+        self.assertEqual(get_metrics()['s3.upload.skipped'], 1)
 
 
 class UploadZipToS3Test(TestsWithS3):
@@ -141,10 +780,29 @@ class UploadZipToS3Test(TestsWithS3):
 
         upload_zip_to_s3(self.project, mock.MagicMock(Logger))
 
-        flush_text_line_mock.assert_called_with(
+        flush_text_line_mock.assert_any_call(
             ("##teamcity[setParameter "
              "name='palp_keyname' value='v123/palp.zip']"))
 
+    @mock.patch("pybuilder_aws_plugin.helpers.flush_text_line")
+    def test_upload_metrics_are_reported(self, flush_text_line_mock):
+        self.project.set_property('teamcity_output', True)
+
+        upload_zip_to_s3(self.project, mock.MagicMock(Logger))
+
+        flush_text_line_mock.assert_any_call(
+            "##teamcity[buildStatisticValue "
+            "key='pybuilder_aws_plugin.s3.upload.bytes' value='8']")
+        with open(os.path.join(self.dir_target, 'reports',
+                               'aws_plugin_metrics.json')) as fp:
+            metrics = json.load(fp)
+        self.assertEqual(metrics['s3.upload.count'], 1)
+        self.assertEqual(metrics['s3.upload.bytes'], 8)
+
+        flush_text_line_mock.reset_mock()
+        publish_metrics(mock.MagicMock(Logger), self.project)
+        self.assertFalse(flush_text_line_mock.called)
+
     @mock.patch("pybuilder_aws_plugin.helpers.flush_text_line")
     def test_teamcity_output_if_not_set(self, flush_text_line_mock):
         upload_zip_to_s3(self.project, mock.MagicMock(Logger))
@@ -163,6 +821,132 @@ class UploadZipToS3Test(TestsWithS3):
     def test_handle_failure_if_no_such_bucket(self):
         pass
 
+    def test_upload_stores_sha256_as_metadata(self):
+        upload_zip_to_s3(self.project, mock.MagicMock(Logger))
+        s3_object = self.s3.Object(self.bucket_name, 'v123/palp.zip')
+        self.assertEqual(s3_object.metadata['sha256'],
+                         hashlib.sha256(self.test_data).hexdigest())
+
+    def test_upload_skipped_if_content_unchanged(self):
+        self.project.set_property('skip_unchanged_uploads', True)
+        upload_zip_to_s3(self.project, mock.MagicMock(Logger))
+        logger = mock.MagicMock(Logger)
+        upload_zip_to_s3(self.project, logger)
+        logger.info.assert_any_call(
+            'Skipping upload to bucket "palp-lambda-zips" key v123/palp.zip, '
+            'content is unchanged')
+
+    def test_acl_is_applied_to_skipped_upload(self):
+        self.project.set_property('skip_unchanged_uploads', True)
+        self.project.set_property('lambda_file_access_control', 'private')
+        upload_zip_to_s3(self.project, mock.MagicMock(Logger))
+        self.project.set_property('lambda_file_access_control', 'public-read')
+        upload_zip_to_s3(self.project, mock.MagicMock(Logger))
+        grants = self.s3.Object(
+                self.bucket_name, 'v123/palp.zip').Acl().grants
+        self.assertTrue(any(grant['Permission'] == 'READ' and
+                            grant['Grantee'].get('URI', '').endswith(
+                                '/AllUsers')
+                            for grant in grants))
+        self.assertEqual(get_metrics()['s3.upload.skipped'], 1)
+
+    def test_large_file_is_uploaded_in_parts(self):
+        part_size = 5 * 1024 * 1024
+        self.project.set_property('upload_part_size', part_size)
+        with open(self.zipfile_name, 'wb') as fp:
+            for _ in range(3):
+                fp.write(os.urandom(part_size // 2))
+        upload_zip_to_s3(self.project, mock.MagicMock(Logger))
+        s3_object = self.s3.Object(self.bucket_name, 'v123/palp.zip')
+        self.assertEqual(s3_object.content_length, 3 * (part_size // 2))
+        self.assertTrue(s3_object.e_tag.endswith('-2"'))
+
+    def test_upload_fails_with_too_small_part_size(self):
+        self.project.set_property('upload_part_size', 1024)
+        self.assertRaises(BuildFailedException,
+                          upload_zip_to_s3,
+                          self.project,
+                          mock.MagicMock(Logger))
+
+    def test_upload_not_skipped_if_content_changed(self):
+        self.project.set_property('skip_unchanged_uploads', True)
+        upload_zip_to_s3(self.project, mock.MagicMock(Logger))
+        with open(self.zipfile_name, 'wb') as fp:
+            fp.write(b'changed')
+        upload_zip_to_s3(self.project, mock.MagicMock(Logger))
+        s3_object = self.s3.Object(self.bucket_name, 'v123/palp.zip')
+        self.assertEqual(s3_object.get()['Body'].read(), b'changed')
+
+    @mock.patch('pybuilder_aws_plugin.lambda_tasks.resolve_requirements',
+                mock.Mock(return_value=['some-dependency==1.0']))
+    def test_layer_is_uploaded_only_if_missing(self):
+        reset_resolved_dependencies()
+        self.addCleanup(reset_resolved_dependencies)
+        self.project.depends_on('some_dependency')
+        self.project.set_property('lambda_layer', True)
+        logger = mock.MagicMock(Logger)
+        layer_name = os.path.basename(
+                get_path_to_layer_zipfile(logger, self.project))
+        with open(os.path.join(self.dir_target, layer_name), 'wb') as fp:
+            fp.write(b'layer')
+
+        upload_zip_to_s3(self.project, logger)
+        layer_key = 'layers/{0}'.format(layer_name)
+        s3_object = self.s3.Object(self.bucket_name, layer_key)
+        self.assertEqual(s3_object.get()['Body'].read(), b'layer')
+
+        logger = mock.MagicMock(Logger)
+        with mock.patch('pybuilder_aws_plugin.lambda_tasks.'
+                        'upload_file_helper') as upload_file_helper_mock:
+            upload_zip_to_s3(self.project, logger)
+        self.assertEqual(upload_file_helper_mock.call_count, 1)
+        logger.info.assert_any_call(
+                'Layer zip is already in bucket "{0}" as {1}.'.format(
+                    self.bucket_name, layer_key))
+
+    @mock.patch('pybuilder_aws_plugin.lambda_tasks.resolve_requirements',
+                mock.Mock(return_value=['some-dependency==1.0']))
+    def test_layer_is_uploaded_if_head_is_forbidden(self):
+        reset_resolved_dependencies()
+        self.addCleanup(reset_resolved_dependencies)
+        self.project.depends_on('some_dependency')
+        self.project.set_property('lambda_layer', True)
+        logger = mock.MagicMock(Logger)
+        layer_name = os.path.basename(
+                get_path_to_layer_zipfile(logger, self.project))
+        with open(os.path.join(self.dir_target, layer_name), 'wb') as fp:
+            fp.write(b'layer')
+
+        for code, uploads in [('403', 1), ('InternalError', 0)]:
+            forbidden = ClientError(
+                    {'Error': {'Code': code, 'Message': 'Forbidden'}},
+                    'HeadObject')
+            with mock.patch.object(S3Storage, 'head',
+                                   side_effect=forbidden), \
+                    mock.patch('pybuilder_aws_plugin.lambda_tasks.'
+                               'upload_file_helper') as upload_file_helper:
+                if uploads:
+                    upload_zip_to_s3(self.project, logger)
+                else:
+                    self.assertRaises(ClientError, upload_zip_to_s3,
+                                      self.project, logger)
+            layer_uploads = [call for call in upload_file_helper.call_args_list
+                             if call[0][2].startswith('layers/')]
+            self.assertEqual(len(layer_uploads), uploads)
+
+    @mock.patch('pybuilder_aws_plugin.lambda_tasks.resolve_requirements')
+    def test_layer_name_depends_on_resolved_versions(self, resolve_mock):
+        reset_resolved_dependencies()
+        self.addCleanup(reset_resolved_dependencies)
+        self.project.depends_on('some_dependency>=1')
+        logger = mock.MagicMock(Logger)
+        resolve_mock.return_value = ['some-dependency==1.0']
+        first = get_path_to_layer_zipfile(logger, self.project)
+        reset_resolved_dependencies()
+        resolve_mock.return_value = ['some-dependency==1.1']
+        self.assertNotEqual(
+                get_path_to_layer_zipfile(logger, self.project), first)
+
 
 class LambdaReleaseTest(TestsWithS3):
     def test_release_successful(self):
@@ -276,8 +1060,228 @@ class TestPrepareDependenciesDir(TestCase):
                           self.mock_logger, self.input_project, 'targetdir')
 
 
+class TestPrepareDependenciesDirBatchInstall(TestCase):
+    """Testcases for prepare_dependencies_dir() with a single pip run"""
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp(prefix='palp-')
+        self.target_dir = os.path.join(self.tempdir, 'lambda_dependencies')
+        self.patch_popen = mock.patch(
+                'pybuilder_aws_plugin.lambda_tasks.subprocess.Popen')
+        self.mock_popen = self.patch_popen.start()
+        self.mock_process = mock.Mock()
+        self.mock_process.returncode = 0
+        self.mock_process.communicate.return_value = (b'', None)
+        self.mock_popen.return_value = self.mock_process
+        self.input_project = Project('.')
+        self.input_project.set_property(
+                'lambda_dependencies_batch_install', True)
+        self.mock_logger = mock.Mock()
+
+    def tearDown(self):
+        self.patch_popen.stop()
+        shutil.rmtree(self.tempdir)
+
+    def test_all_dependencies_installed_in_one_pip_call(self):
+        for dependency in ['a', 'b', 'c', 'd']:
+            self.input_project.depends_on(dependency)
+        requirements = []
+
+        def read_requirements(cmd, **kwargs):
+            with open(cmd[-1]) as requirements_file:
+                requirements.append(requirements_file.read())
+            return self.mock_process
+        self.mock_popen.side_effect = read_requirements
+        prepare_dependencies_dir(
+                self.mock_logger, self.input_project, self.target_dir,
+                excludes=['b'])
+        self.assertEqual(self.mock_popen.call_count, 1)
+        cmd = self.mock_popen.call_args[0][0]
+        self.assertEqual(cmd[:5], ['pip', 'install', '--target',
+                                   self.target_dir, '--requirement'])
+        self.assertEqual(requirements, ['a\nc\nd\n'])
+        self.assertFalse(os.path.exists(cmd[-1]))
+        self.assertEqual(os.listdir(self.tempdir), [])
+
+    def test_failing_dependency_is_named(self):
+        for dependency in ['a', 'nonexisting-dep', 'c']:
+            self.input_project.depends_on(dependency)
+        self.mock_process.returncode = 1
+        self.mock_process.communicate.return_value = (
+            b'Collecting a\n'
+            b'ERROR: Could not find a version that satisfies the requirement '
+            b'nonexisting-dep (from versions: none)\n'
+            b'ERROR: No matching distribution found for nonexisting-dep\n',
+            None)
+        with self.assertRaises(Exception) as context:
+            prepare_dependencies_dir(
+                    self.mock_logger, self.input_project, self.target_dir)
+        self.assertTrue(
+                'dependencies nonexisting-dep:' in str(context.exception))
+
+
+def write_wheel(wheelhouse, name, version, purelib=True):
+    """Write a minimal wheel with a single module"""
+    dist_info = '{0}-{1}.dist-info'.format(name, version)
+    filename = os.path.join(
+            wheelhouse, '{0}-{1}-py3-none-any.whl'.format(name, version))
+    with zipfile.ZipFile(filename, 'w', zipfile.ZIP_DEFLATED) as wheel:
+        wheel.writestr('{0}.py'.format(name), 'VALUE = 42\n' * 100)
+        wheel.writestr(dist_info + '/METADATA',
+                       'Metadata-Version: 2.1\nName: {0}\nVersion: {1}\n'
+                       .format(name, version))
+        wheel.writestr(dist_info + '/WHEEL',
+                       'Wheel-Version: 1.0\nRoot-Is-Purelib: {0}\n'
+                       'Tag: py3-none-any\n'.format(
+                           'true' if purelib else 'false'))
+        wheel.writestr(dist_info + '/RECORD', '')
+    return filename
+
+
+class TestWheelhouse(TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp(prefix='palp-')
+        self.wheelhouse = os.path.join(self.tempdir, 'wheelhouse')
+        os.mkdir(self.wheelhouse)
+        self.input_project = Project('.')
+        self.input_project.set_property('lambda_wheelhouse_dir',
+                                        self.wheelhouse)
+        self.mock_logger = mock.Mock()
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    @mock.patch('pybuilder_aws_plugin.lambda_tasks.subprocess.Popen')
+    def test_dependencies_are_installed_from_wheelhouse_only(
+            self, mock_popen):
+        write_wheel(self.wheelhouse, 'pinned', '1.0.0')
+        mock_popen.return_value.returncode = 0
+        self.input_project.depends_on('pinned', '==1.0')
+        prepare_dependencies_dir(
+                self.mock_logger, self.input_project, 'targetdir')
+        self.assertEqual(
+                list(mock_popen.call_args_list), [
+                    mock.call(['pip', 'install', '--target', 'targetdir',
+                               '--no-index', '--find-links', self.wheelhouse,
+                               'pinned==1.0'],
+                              stdout=subprocess.PIPE)])
+
+    @mock.patch('pybuilder_aws_plugin.lambda_tasks.subprocess.Popen')
+    def test_missing_pinned_wheel_fails_before_pip_runs(self, mock_popen):
+        write_wheel(self.wheelhouse, 'pinned', '1.0')
+        self.input_project.depends_on('pinned', '==2.0')
+        self.input_project.depends_on('unpinned')
+        self.assertRaisesRegexp(
+                BuildFailedException, 'No wheels for pinned==2.0 in',
+                prepare_dependencies_dir,
+                self.mock_logger, self.input_project, 'targetdir')
+        self.assertFalse(mock_popen.called)
+
+    def test_unreferenced_wheels_are_pruned(self):
+        write_wheel(self.wheelhouse, 'pinned', '1.0')
+        old_wheel = write_wheel(self.wheelhouse, 'pinned', '0.9')
+        requirements_file = os.path.join(self.tempdir, 'requirements.txt')
+        with open(requirements_file, 'w') as fp:
+            fp.write('pinned==1.0\n')
+
+        prune_wheelhouse(self.mock_logger, self.wheelhouse, requirements_file)
+
+        self.assertEqual(os.listdir(self.wheelhouse),
+                         ['pinned-1.0-py3-none-any.whl'])
+        self.assertFalse(os.path.exists(old_wheel))
+
+
+class TestDependenciesCache(TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp(prefix='palp-')
+        self.cache_dir = os.path.join(self.tempdir, 'cache')
+        self.project = Project('.')
+        self.project.set_property('lambda_cache_dir', self.cache_dir)
+        self.project.set_property('lambda_cache_max_entries', 2)
+        self.project.depends_on('a')
+        self.patch_install = mock.patch(
+                'pybuilder_aws_plugin.lambda_tasks.install_dependencies',
+                side_effect=self.fake_install)
+        self.mock_install = self.patch_install.start()
+        self.patch_resolve = mock.patch(
+                'pybuilder_aws_plugin.lambda_tasks.resolve_requirements',
+                return_value=['a==1.0'])
+        self.mock_resolve = self.patch_resolve.start()
+        reset_resolved_dependencies()
+
+    def tearDown(self):
+        self.patch_install.stop()
+        self.patch_resolve.stop()
+        reset_resolved_dependencies()
+        shutil.rmtree(self.tempdir)
+
+    @staticmethod
+    def fake_install(logger, project, target_directory, dependencies):
+        if not os.path.isdir(target_directory):
+            os.makedirs(target_directory)
+        for dependency in dependencies:
+            with open(os.path.join(target_directory, dependency), 'w') as fp:
+                fp.write(dependency)
+
+    def prepare(self, name):
+        target_directory = os.path.join(self.tempdir, name)
+        prepare_dependencies_dir(mock.Mock(), self.project, target_directory)
+        return sorted(os.listdir(target_directory))
+
+    def test_cache_hit_does_not_install_again(self):
+        self.assertEqual(self.prepare('first'), ['a'])
+        self.assertEqual(self.prepare('second'), ['a'])
+        self.assertEqual(self.mock_install.call_count, 1)
+
+    def test_cache_key_depends_on_index_url(self):
+        self.prepare('first')
+        self.project.set_property('install_dependencies_index_url',
+                                  'http://example.domain')
+        self.prepare('second')
+        self.assertEqual(self.mock_install.call_count, 2)
+
+    def test_cache_key_depends_on_resolved_versions(self):
+        self.prepare('first')
+        self.assertEqual(self.mock_resolve.call_count, 1)
+        reset_resolved_dependencies()
+        self.mock_resolve.return_value = ['a==1.1']
+        self.prepare('second')
+        self.assertEqual(self.mock_install.call_count, 2)
+
+    def test_dependencies_with_unknown_versions_are_not_cached(self):
+        self.mock_resolve.side_effect = BuildFailedException('no network')
+        self.assertEqual(self.prepare('first'), ['a'])
+        self.assertEqual(self.prepare('second'), ['a'])
+        self.assertEqual(self.mock_install.call_count, 2)
+        self.assertFalse(os.path.exists(self.cache_dir))
+
+    def test_failed_install_is_not_cached(self):
+        self.mock_install.side_effect = Exception('pip failed')
+        self.assertRaises(Exception, self.prepare, 'first')
+        self.assertEqual(
+                os.listdir(os.path.join(self.cache_dir, 'dependencies')),
+                ['.locks'])
+
+    def test_least_recently_used_entries_are_evicted(self):
+        cache_dir = os.path.join(self.tempdir, 'lru')
+        for age, name in enumerate(['new', 'middle', 'old']):
+            os.makedirs(os.path.join(cache_dir, name))
+            mtime = 1000000000 - age * 60
+            os.utime(os.path.join(cache_dir, name), (mtime, mtime))
+        evict_least_recently_used(mock.Mock(), cache_dir, 2)
+        self.assertEqual(
+                sorted(n for n in os.listdir(cache_dir) if n[0] != '.'),
+                ['middle', 'new'])
+        self.assertTrue(os.path.isfile(
+                os.path.join(cache_dir, '.locks', 'old.lock')))
+
+
 if sys.version_info[0:2] >= (2, 7):
-    from version_specific import UploadJSONToS3, CfnReleaseTests
+    from version_specific import (UploadJSONToS3,
+                                  CfnReleaseTests,
+                                  LocalStorageReleaseTests,
+                                  )
 
     UploadJSONToS3  # Linting purposes, no other use
     CfnReleaseTests
+    LocalStorageReleaseTests
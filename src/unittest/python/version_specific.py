@@ -3,7 +3,12 @@ These tests are separate since they only work with Python2 >2.6 for the time
 being. Python3 support is underway.
 """
 
+import io
+import json
 import os
+import shutil
+import tempfile
+
 import mock
 from unittest2 import TestCase
 
@@ -13,6 +18,8 @@ from pybuilder.core import Logger, Project
 from pybuilder.errors import BuildFailedException
 
 from pybuilder_aws_plugin import upload_cfn_to_s3, cfn_release, release_custom_resource
+from pybuilder_aws_plugin.helpers import reset_s3_client
+from pybuilder_aws_plugin.storage_helpers import LocalStorage
 
 
 class TestsWithS3(TestCase):
@@ -31,11 +38,13 @@ class TestsWithS3(TestCase):
                 'template_file_access_control', 'bucket-owner-full-control')
         self.my_mock_s3 = mock_s3()
         self.my_mock_s3.start()
+        reset_s3_client()
         self.s3 = boto3.resource('s3')
         self.s3.create_bucket(Bucket=self.bucket_name)
 
     def tearDown(self):
         self.my_mock_s3.stop()
+        reset_s3_client()
 
 
 class UploadJSONToS3(TestsWithS3):
@@ -61,6 +70,107 @@ class UploadJSONToS3(TestsWithS3):
                 {"Permission": "FULL_CONTROL"},
                 s3_grants[0])
 
+    def test_upload_cfn_files_in_parallel(self):
+        self.project.set_property('template_transform_workers', 2)
+        self.project.set_property('template_upload_concurrency', 2)
+        upload_cfn_to_s3(self.project, mock.MagicMock(Logger))
+        keys = [o.key for o in self.s3.Bucket(self.bucket_name).objects.all()]
+        self.assertEqual(sorted(keys), ['palp/v123/alarm-topic.json',
+                                        'palp/v123/ecs-simple-webapp.json'])
+
+    def test_template_files_may_be_lists(self):
+        self.project.set_property(
+                'template_files', [list(f) for f in self.test_files])
+        upload_cfn_to_s3(self.project, mock.MagicMock(Logger))
+        keys = [o.key for o in self.s3.Bucket(self.bucket_name).objects.all()]
+        self.assertEqual(sorted(keys), ['palp/v123/alarm-topic.json',
+                                        'palp/v123/ecs-simple-webapp.json'])
+
+    def test_transform_processes_start_before_upload_threads(self):
+        from pybuilder_aws_plugin import cfn_tasks
+        started = []
+
+        def start_transform_pool(*args):
+            started.append('processes')
+            return real_start_transform_pool(*args)
+
+        def thread_pool(*args):
+            started.append('threads')
+            return real_thread_pool(*args)
+        real_start_transform_pool = cfn_tasks.start_transform_pool
+        real_thread_pool = cfn_tasks.ThreadPool
+        self.project.set_property('template_transform_workers', 2)
+        with mock.patch.object(cfn_tasks, 'start_transform_pool',
+                               start_transform_pool), \
+                mock.patch.object(cfn_tasks, 'ThreadPool', thread_pool):
+            upload_cfn_to_s3(self.project, mock.MagicMock(Logger))
+        self.assertEqual(started, ['processes', 'threads'])
+        keys = [o.key for o in self.s3.Bucket(self.bucket_name).objects.all()]
+        self.assertEqual(len(keys), 2)
+
+    def test_all_template_errors_are_reported(self):
+        basedir = os.path.dirname(__file__)
+        self.project.set_property('template_files', self.test_files + [
+            (os.path.join(basedir, 'templates'), 'missing-one.yml'),
+            (os.path.join(basedir, 'templates'), 'missing-two.yml')])
+        self.project.set_property('template_transform_workers', 2)
+        with self.assertRaises(BuildFailedException) as context:
+            upload_cfn_to_s3(self.project, mock.MagicMock(Logger))
+        message = str(context.exception)
+        self.assertTrue('2 of 4 templates failed' in message)
+        self.assertTrue('missing-one.yml' in message)
+        self.assertTrue('missing-two.yml' in message)
+        keys = [o.key for o in self.s3.Bucket(self.bucket_name).objects.all()]
+        self.assertEqual(len(keys), 2)
+
+    def test_cached_transformations_skip_parsing(self):
+        cache_dir = tempfile.mkdtemp(prefix='palp-')
+        self.addCleanup(shutil.rmtree, cache_dir)
+        self.project.set_property('template_cache_dir', cache_dir)
+        upload_cfn_to_s3(self.project, mock.MagicMock(Logger))
+        self.assertEqual(
+                len([n for n in os.listdir(cache_dir) if n[0] != '.']), 2)
+        for o in self.s3.Bucket(self.bucket_name).objects.all():
+            o.delete()
+
+        with mock.patch('pybuilder_aws_plugin.cfn_tasks.transform_template'
+                        ) as transform_template:
+            upload_cfn_to_s3(self.project, mock.MagicMock(Logger))
+            transform_template.assert_not_called()
+        keys = [o.key for o in self.s3.Bucket(self.bucket_name).objects.all()]
+        self.assertEqual(sorted(keys), ['palp/v123/alarm-topic.json',
+                                        'palp/v123/ecs-simple-webapp.json'])
+
+    def test_compact_templates_are_smaller_and_key_stable(self):
+        self.project.set_property('template_json_compact', True)
+        logger = mock.MagicMock(Logger)
+        upload_cfn_to_s3(self.project, logger)
+        body = self.s3.Object(
+                self.bucket_name,
+                'palp/v123/ecs-simple-webapp.json').get()['Body'].read()
+        body = body.decode('utf-8')
+        template = json.loads(body)
+        self.assertEqual(body, json.dumps(template, sort_keys=True,
+                                          separators=(',', ':')))
+        lines = [call[0][0] for call in logger.info.call_args_list]
+        header = [line for line in lines if line.startswith('Template ')]
+        self.assertEqual(len(header), 1)
+        row = [line for line in lines
+               if line.startswith('ecs-simple-webapp.json ')][0]
+        original, uploaded = [int(size) for size in row.split()[1:3]]
+        self.assertEqual(uploaded, len(body))
+        self.assertTrue(uploaded < original)
+
+    def test_templates_over_their_size_limit_fail(self):
+        self.project.set_property('template_max_size', 2000)
+        with self.assertRaises(BuildFailedException) as context:
+            upload_cfn_to_s3(self.project, mock.MagicMock(Logger))
+        message = str(context.exception)
+        self.assertTrue('1 of 2 templates failed' in message)
+        self.assertTrue('ecs-simple-webapp.json takes' in message)
+        keys = [o.key for o in self.s3.Bucket(self.bucket_name).objects.all()]
+        self.assertEqual(keys, ['palp/v123/alarm-topic.json'])
+
     def test_upload_fails_with_invalid_acl_value(self):
         self.project.set_property('template_file_access_control',
                                   'no_such_value')
@@ -90,11 +200,77 @@ class CfnReleaseTests(TestsWithS3):
                 {"Permission": "FULL_CONTROL"},
                 s3_grants[0])
 
+    def upload_custom_resource(self):
+        self.project.set_property('bucket_prefix', 'palp/')
+        self.project.set_property(
+                'lambda_file_access_control', 'bucket-owner-full-control')
+        upload_cfn_to_s3(self.project, mock.MagicMock(Logger))
+        self.s3.Object(self.bucket_name, 'palp/v123/palp.zip').put(Body=b'zip')
+
     @mock.patch("pybuilder_aws_plugin.helpers.flush_text_line")
     def test_release_custom_resource_teamcity_build_status(self, flush_text_line_mock):
         self.project.set_property('teamcity_output', True)
+        self.upload_custom_resource()
 
-        release_custom_resource(self.project)
+        release_custom_resource(self.project, mock.MagicMock(Logger))
 
         flush_text_line_mock.assert_called_with(
                 ("##teamcity[buildStatus text='{build.status.text} Released 123 in palp-cfn-json']"))
+
+    def test_release_custom_resource_copies_everything_concurrently(self):
+        self.project.set_property('release_concurrency', 3)
+        self.upload_custom_resource()
+        logger = mock.MagicMock(Logger)
+
+        release_custom_resource(self.project, logger)
+
+        s3_keys = [o.key for o
+                   in self.s3.Bucket(self.bucket_name).objects.all()]
+        for key in ['palp/latest/palp.zip',
+                    'palp/latest/alarm-topic.json',
+                    'palp/latest/ecs-simple-webapp.json']:
+            self.assertTrue(key in s3_keys,
+                            "Key {0} not found in {1}".format(key, s3_keys))
+        summary = [c[0][0] for c in logger.info.call_args_list
+                   if c[0][0].startswith('Released 3 of 3 objects')]
+        self.assertEqual(len(summary), 1)
+
+    def test_release_reports_all_failed_copies(self):
+        self.project.set_property('bucket_prefix', 'palp/')
+        self.project.set_property(
+                'lambda_file_access_control', 'bucket-owner-full-control')
+        with self.assertRaises(BuildFailedException) as context:
+            release_custom_resource(self.project, mock.MagicMock(Logger))
+        self.assertTrue('3 of 3 copies failed' in str(context.exception))
+
+
+class LocalStorageReleaseTests(TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp(prefix='palp-')
+        basedir = os.path.dirname(__file__)
+        self.project = Project(basedir=basedir, name='palp', version='123')
+        self.project.set_property('local_storage_dir', self.tempdir)
+        self.project.set_property('bucket_name', 'palp-cfn-json')
+        self.project.set_property('bucket_prefix', 'palp/')
+        self.project.set_property('template_key_prefix', 'palp/')
+        self.project.set_property('template_files', [
+            (os.path.join(basedir, 'templates'), 'alarm-topic.yml')])
+        for acl_property in ['template_file_access_control',
+                             'lambda_file_access_control']:
+            self.project.set_property(acl_property, 'private')
+        self.storage = LocalStorage(self.tempdir)
+        os.mkdir(os.path.join(self.tempdir, 'palp-cfn-json'))
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def test_upload_and_release_custom_resource_without_s3(self):
+        upload_cfn_to_s3(self.project, mock.MagicMock(Logger))
+        self.storage.put('palp-cfn-json', 'palp/v123/palp.zip',
+                         io.BytesIO(b'zip'), 'private', {})
+
+        release_custom_resource(self.project, mock.MagicMock(Logger))
+
+        self.assertEqual(self.storage.list('palp-cfn-json', 'palp/latest/'),
+                         ['palp/latest/alarm-topic.json',
+                          'palp/latest/palp.zip'])